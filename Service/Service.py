@@ -1,66 +1,313 @@
 import os
 from functools import wraps
 from datetime import timedelta
-from flask import Flask, request, jsonify, session
+from flask import Blueprint, Flask, request, jsonify, session, g, Response
 from flask_cors import CORS
 
-from log_module import setup_logger
+from config_module import get_config
+from log_module import setup_logger, stop_logging
 import api_module
+import attachment_module
+import auth_module
+import cache_module
+import db_module
+import event_module
+import graph_module
+import job_module
+import log_module
+import metrics_module
+import profile_module
+import ratelimit_module
+import refresh_module
+import token_module
 from auth_module import auth_bp
+from lazy_module import is_loaded, lazy_import
 
-os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
-
-app = Flask(__name__)
-# In a real app, this should be a long, random, secret string
-app.secret_key = os.urandom(24)
+# Only loaded by workers that call Google APIs
+google_module = lazy_import("google_module")
 
-# --- End JWT Configuration ---
+os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"
 
-CORS(app, supports_credentials=True)
+service_bp = Blueprint('service_bp', __name__)
 
-# Register Blueprints
-app.register_blueprint(auth_bp, url_prefix='/api/auth')
+# Flask-CORS options; asgi_module applies the same ones to its native routes
+CORS_OPTIONS = {"supports_credentials": True}
 
 global LOGGER
 LOGGER = None
 
-def get_config():
-    import configparser
-    configs = configparser.ConfigParser()
-    configs.read("myConfig.ini", encoding="utf-8")
-    return configs
 
-@app.before_request
+def create_app():
+    """
+    Application factory. Builds the Flask app and initializes logging, config
+    and the process-wide clients once per worker; serve.py calls it in every
+    worker process, `python Service.py` once for the development server.
+    """
+    global LOGGER
+    LOGGER = setup_logger("service", "logs/service")
+    # Parse myConfig.ini once at startup; handlers share the cached snapshot
+    config = get_config()
+
+    app = Flask(__name__)
+    # Every worker must sign sessions with the same key, so it comes from the
+    # config ([SERVER] SECRET_KEY, or MYOAUTH__SERVER__SECRET_KEY set by serve.py)
+    secret_key = config.get("SERVER", "SECRET_KEY")
+    if not secret_key:
+        LOGGER.warning("[SERVER] SECRET_KEY is not set; sessions will not survive restarts or span workers")
+        secret_key = os.urandom(24)
+    app.secret_key = secret_key
+    # Attachment uploads beyond 500 KB are spooled to temporary files by the form parser
+    app.config['MAX_CONTENT_LENGTH'] = config.get_int("ATTACHMENTS", "MAX_REQUEST_BYTES", None)
+
+    CORS(app, **CORS_OPTIONS)
+
+    # Register Blueprints
+    app.register_blueprint(service_bp)
+    app.register_blueprint(auth_bp, url_prefix='/api/auth')
+
+    # Per-request profiling and the sampler endpoints; nothing is registered unless [PROFILING] ENABLED
+    profile_module.init_app(app)
+
+    refresh_module.start_scheduler()
+    LOGGER.info(f"Worker {os.getpid()} initialized")
+    return app
+
+
+def reset_after_fork():
+    """
+    Drops state inherited from the parent process: pooled DB connections and
+    HTTP sessions would share sockets with it, and threads (log listener,
+    schedulers, worker pools) do not survive fork().
+    """
+    db_module.reset_pool()
+    graph_module.reset_graph_client()
+    if is_loaded(google_module):
+        google_module.reset_clients()
+    auth_module.reset_msal_app()
+    log_module.reset_after_fork()
+    refresh_module.reset_after_fork()
+    job_module.reset_after_fork()
+
+
+def shutdown(timeout=10):
+    """Graceful shutdown: drain background work, then close pools and flush logs."""
+    if LOGGER:
+        LOGGER.info(f"Worker {os.getpid()} shutting down")
+    refresh_module.stop_scheduler(timeout)
+    job_module.shutdown(timeout)
+    db_module.dispose_pool()
+    stop_logging()
+
+
+@service_bp.before_app_request
 def log_request_info():
     user_ip = request.remote_addr
     request_path = request.path
     request_method = request.method
-    LOGGER.debug(f"Request by {user_ip} - {request_method} {request_path}")
+    LOGGER.debug("Request by %s - %s %s", user_ip, request_method, request_path)
+
+@service_bp.before_app_request
+def start_request_timer():
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_token = metrics_module.start_request(endpoint, request.method)
+
+@service_bp.before_app_request
+def reset_rate_limit_user():
+    # Threads serve many requests; calls are charged to a user once api_module resolves one
+    ratelimit_module.bind_user(None)
+
+@service_bp.app_errorhandler(ratelimit_module.RateLimitExceeded)
+def rate_limit_exceeded(error):
+    response = jsonify({"status": "warning", "data": "", "message": str(error)})
+    response.headers['Retry-After'] = str(max(1, round(error.retry_after)))
+    return response
+
+@service_bp.after_app_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
 
-@app.route("/")
+@service_bp.teardown_app_request
+def finish_request_timer(exc):
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        status = g.pop('response_status', 500)
+        metrics_module.finish_request(token, request.path, status, request.remote_addr)
+
+@service_bp.route("/")
 def index():
     """check server status"""
     return "server is running"
 
-@app.route("/api/send_google_email", methods=["POST"])
+@service_bp.route("/metrics")
+def metrics():
+    """Prometheus metrics: latency histograms/quantiles per endpoint and downstream component"""
+    gauges = {
+        "myoauth_db_pool": ("Database connection pool statistics.", db_module.get_pool_stats()),
+        "myoauth_token_refresh": ("Background token refresh statistics.", refresh_module.get_refresh_stats()),
+    }
+    for name, stats in cache_module.get_cache_stats().items():
+        gauges[f"myoauth_cache_{name}"] = (f"Hit/miss statistics of the {name} cache.", stats)
+    for provider, stats in ratelimit_module.get_provider_stats().items():
+        gauges[f"myoauth_ratelimit_{provider}"] = (f"Provider-wide outbound rate limiter for {provider}.", stats)
+    return Response(metrics_module.render(gauges), mimetype="text/plain; version=0.0.4")
+
+@service_bp.route("/api/db/pool_stats")
+def db_pool_stats():
+    """connection pool usage"""
+    return jsonify({"status": "success", "data": db_module.get_pool_stats(), "message": ""})
+
+@service_bp.route("/api/tokens/refresh_stats")
+def token_refresh_stats():
+    """background token refresh counters"""
+    return jsonify({"status": "success", "data": refresh_module.get_refresh_stats(), "message": ""})
+
+@service_bp.route("/api/ratelimit/stats")
+def rate_limit_stats():
+    """outbound rate limiters: current rate and queue depth per (provider, user)"""
+    return jsonify({"status": "success", "data": ratelimit_module.get_limiter_stats(), "message": ""})
+
+def enqueue_email(kind, data, user_id):
+    """Queues an email for the background workers and returns the job id envelope."""
+    if user_id is None:
+        return {"status": "warning", "data": "", "message": "Not logged in"}
+    payload = {'recipient': data['recipient'], 'subject': data['subject'], 'body': data['body'],
+               'user_id': user_id}
+    job_id = job_module.get_job_queue().enqueue(kind, payload)
+    if job_id is None:
+        return {"status": "warning", "data": "", "message": "Email queue is full, please retry later"}
+    return {"status": "success", "data": {"job_id": job_id}, "message": "Email queued"}
+
+def get_email_request():
+    """
+    Body of the send_*_email endpoints: JSON {"recipient", "subject", "body"},
+    or multipart/form-data with those fields and any number of "attachments"
+    files. Returns (data, attachments); attachments is None for JSON bodies.
+    """
+    if request.mimetype == 'multipart/form-data':
+        return request.form, attachment_module.from_files(request.files)
+    return request.get_json(), None
+
+@service_bp.route("/api/send_google_email", methods=["POST"])
 def send_google_email():
-    data = request.get_json()
-    result = api_module.send_google_email(data['recipient'], data['subject'], data['body'])
+    data, attachments = get_email_request()
+    # Queued jobs carry JSON only, so multipart requests are always sent inline
+    if attachments is None and job_module.is_async_enabled(data):
+        return jsonify(enqueue_email("google_email", data, session.get('google_user_id')))
+    result = api_module.send_google_email(data['recipient'], data['subject'], data['body'],
+                                          attachments=attachments)
     return jsonify(result)
 
-@app.route("/api/send_microsoft_email", methods=["POST"])
+@service_bp.route("/api/send_microsoft_email", methods=["POST"])
 def send_microsoft_email():
-    data = request.get_json()
-    result = api_module.send_microsoft_email(data['recipient'], data['subject'], data['body'])
+    data, attachments = get_email_request()
+    if attachments is None and job_module.is_async_enabled(data):
+        return jsonify(enqueue_email("microsoft_email", data, session.get('microsoft_user_id')))
+    result = api_module.send_microsoft_email(data['recipient'], data['subject'], data['body'],
+                                             attachments=attachments)
+    return jsonify(result)
+
+@service_bp.route("/api/jobs/<job_id>")
+def get_job(job_id):
+    job = job_module.get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"status": "warning", "data": "", "message": "Job not found"})
+    return jsonify({"status": "success", "data": job, "message": ""})
+
+def get_bulk_messages(data):
+    """
+    Body: {"messages": [{"recipient", "subject", "body"}, ...]}
+    or    {"recipients": [...], "subject": "...", "body": "..."}
+    Returns None when no valid message list is given.
+    """
+    messages = data.get('messages')
+    if messages is None:
+        messages = [{'recipient': r, 'subject': data.get('subject', ''), 'body': data.get('body', '')}
+                    for r in data.get('recipients', [])]
+    if not messages or any('recipient' not in m for m in messages):
+        return None
+    return [{'recipient': m['recipient'], 'subject': m.get('subject', ''), 'body': m.get('body', '')}
+            for m in messages]
+
+@service_bp.route("/api/send_google_email/bulk", methods=["POST"])
+def send_google_email_bulk():
+    messages = get_bulk_messages(request.get_json())
+    if messages is None:
+        return jsonify({"status": "warning", "data": "", "message": "messages with recipient are required"})
+    result = api_module.send_google_emails(messages)
     return jsonify(result)
 
-@app.route("/api/create-event", methods=["POST"])
+@service_bp.route("/api/send_microsoft_email/bulk", methods=["POST"])
+def send_microsoft_email_bulk():
+    messages = get_bulk_messages(request.get_json())
+    if messages is None:
+        return jsonify({"status": "warning", "data": "", "message": "messages with recipient are required"})
+    result = api_module.send_microsoft_emails(messages)
+    return jsonify(result)
+
+def get_event_user(provider=None):
+    """
+    The session user events are created for: the one signed in with `provider`,
+    or the only one signed in. Its users row (read through the user cache)
+    says which provider to call. Returns (user, None) or (None, warning message).
+    """
+    user_ids = [session.get(key) for name, key in token_module.SESSION_KEYS.items()
+                if session.get(key) is not None and provider in (None, name)]
+    if len(user_ids) > 1:
+        return None, "Signed in with both Google and Microsoft; provider is required"
+    user = db_module.get_user_profile(user_ids[0]) if user_ids else None
+    if user is None:
+        return None, f"Not logged in to {provider.capitalize() if provider else 'Google or Microsoft'}"
+    return user, None
+
+@service_bp.route("/api/create-event", methods=["POST"])
 def create_event():
-    data = request.get_json()
-    return jsonify({"status": "info", "message": "Create event endpoint needs DB integration to determine provider."})
+    """
+    Body: {"title", "start_time", "end_time", "time_zone"?, "description"?,
+    "location"?, "provider"?} (see event_module.from_json)
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": "warning", "data": "", "message": "A JSON object body is required"})
+    user, message = get_event_user(data.get('provider'))
+    if user is None:
+        return jsonify({"status": "warning", "data": "", "message": message})
+    try:
+        event = event_module.from_json(data)
+    except ValueError as e:
+        return jsonify({"status": "warning", "data": "", "message": str(e)})
+    if user['auth_provider'] == token_module.GOOGLE:
+        result = api_module.create_google_event(event, user_id=user['id'])
+    else:
+        result = api_module.create_microsoft_event(event, user_id=user['id'])
+    return jsonify(result)
+
+@service_bp.route("/api/create-event/bulk", methods=["POST"])
+def create_event_bulk():
+    """
+    Imports an .ics or JSON (array or JSON Lines of create-event bodies) file,
+    sent as the multipart "file" field or as the request body itself
+    (Content-Type text/calendar for iCalendar). The file is parsed while the
+    events are created in provider batches; data holds one result per event.
+    """
+    user, message = get_event_user(request.args.get('provider') or request.form.get('provider'))
+    if user is None:
+        return jsonify({"status": "warning", "data": "", "message": message})
+    upload = request.files.get('file')
+    if upload is not None:
+        events = event_module.parse(upload.stream, upload.filename, upload.mimetype)
+    else:
+        events = event_module.parse(request.stream, mimetype=request.mimetype)
+    if user['auth_provider'] == token_module.GOOGLE:
+        result = api_module.create_google_events(events, user_id=user['id'])
+    else:
+        result = api_module.create_microsoft_events(events, user_id=user['id'])
+    return jsonify(result)
 
 
 if __name__ == "__main__":
-    LOGGER = setup_logger("service", "logs/service")
+    # Development server; production runs through serve.py
+    app = create_app()
+    db_module.create_user_table()
     LOGGER.info("Server is running")
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=get_config().get_bool("SERVER", "DEBUG", False))
@@ -1,84 +1,196 @@
+import asyncio
 import base64
-import configparser
 import json
+from datetime import datetime, timedelta
 import requests
 from flask import session, jsonify, request
 from email.mime.text import MIMEText
+from email.policy import compat32
 
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-
+import attachment_module
+import event_module
+import graph_module
+import ratelimit_module
+import refresh_module
+import token_module
+from config_module import get_config
+from lazy_module import lazy_import
 from log_module import setup_logger
 
 LOGGER = setup_logger("api", "logs/service")
 
-def get_config():
-    """Reads configuration from myConfig.ini."""
-    config = configparser.ConfigParser()
-    config.read("myConfig.ini", encoding="utf-8")
-    return config
+# googleapiclient and aiohttp are loaded by the first call that needs them
+google_module = lazy_import("google_module")
+graph_async_module = lazy_import("graph_async_module")
 
 # --- Google API Functions ---
 
-def get_google_credentials():
-    """Creates Google credentials object from session."""
-    credentials = session.get('google_credentials')
-    if not credentials:
-        return None
-    
-    return Credentials(
-        token=credentials.get('token'),
-        refresh_token=credentials.get('refresh_token'),
-        token_uri=credentials.get('token_uri'),
-        client_id=credentials.get('client_id'),
-        client_secret=credentials.get('client_secret'),
-        scopes=credentials.get('scopes', [])
-    )
-
-def send_google_email(recipient, subject, body):
-    """Sends an email using the Gmail API."""
-    # Get Google credentials from session
-    creds = get_google_credentials()
+def ensure_fresh_tokens(user_id):
+    """
+    Fallback for tokens the refresh scheduler has not renewed yet: refresh
+    (single flight per user) when the access token is about to expire. After
+    a failed refresh the scheduler's retry delay applies here as well.
+    """
+    record = token_module.get_tokens(user_id)
+    threshold = datetime.utcnow() + timedelta(seconds=refresh_module.REQUEST_THRESHOLD)
+    if record and record['token_expiry'] and record['token_expiry'] <= threshold:
+        if not refresh_module.is_backing_off(user_id):
+            refresh_module.refresh_user(user_id)
+
+def get_google_credentials(user_id=None):
+    """Returns Google credentials for the given user, or the session's user."""
+    if user_id is None:
+        user_id = session.get(token_module.SESSION_KEYS[token_module.GOOGLE])
+    # The following Google calls queue behind this user's rate limiter
+    ratelimit_module.bind_user(user_id)
+    ensure_fresh_tokens(user_id)
+    return token_module.get_google_credentials(user_id)
+
+def get_microsoft_credentials(user_id=None):
+    """Returns {"access_token", "refresh_token"} for the given user, or the session's user."""
+    if user_id is None:
+        user_id = session.get(token_module.SESSION_KEYS[token_module.MICROSOFT])
+    ratelimit_module.bind_user(user_id)
+    ensure_fresh_tokens(user_id)
+    return token_module.get_microsoft_credentials(user_id)
+
+def send_google_email(recipient, subject, body, user_id=None, attachments=None):
+    """
+    Sends an email using the Gmail API.
+    `user_id` defaults to the session's user; background jobs pass it explicitly.
+    With `attachments` (see attachment_module.from_files) the message is
+    generated while it is sent through a resumable media upload, one chunk at a time.
+    """
+    creds = get_google_credentials(user_id)
+    if not creds:
+        return {"status": "warning", "data": "", "message": "Not logged in to Google"}
     try:
-        service = build('gmail', 'v1', credentials=creds)
-        message = MIMEText(body)
-        message['to'] = recipient
-        message['subject'] = subject
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        create_message = {'raw': encoded_message}
-        send_message = (service.users().messages().send(userId="me", body=create_message).execute())
+        messages = google_module.get_resource('gmail', 'v1', 'users.messages')
+        if attachments:
+            media = google_module.StreamUpload(
+                attachment_module.mime_message(recipient, subject, body, attachments), 'message/rfc822',
+                attachment_module.chunk_size(attachment_module.GMAIL_CHUNK_UNIT))
+            send_request = messages.send(userId="me", body={}, media_body=media)
+        else:
+            message = MIMEText(body)
+            message['to'] = recipient
+            message['subject'] = subject
+            encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+            create_message = {'raw': encoded_message}
+            send_request = messages.send(userId="me", body=create_message)
+        send_message = google_module.execute(send_request, creds)
         LOGGER.info(f"Sent message to {recipient}, Message Id: {send_message['id']}")
         return {"status": "success", "data": send_message}
-    except HttpError as error:
+    except google_module.HttpError as error:
         LOGGER.error(f"An error occurred: {error}")
         return {"status": "error", "message": str(error)}
 
-def create_google_event(user, title, start_time, end_time):
-    """Creates a calendar event using the Google Calendar API."""
-    creds = get_google_credentials(user)
+def encode_google_messages(messages):
+    """
+    Returns the base64url 'raw' payload for each {"recipient", "subject", "body"}.
+    Messages sharing subject and body are serialised once and only get their
+    own To: header. A message whose recipient or subject contains a line break
+    (which would inject headers) gets a ValueError instead of a payload.
+    """
+    templates = {}
+    encoded = []
+    for m in messages:
+        if any('\r' in value or '\n' in value for value in (m['recipient'], m['subject'])):
+            encoded.append(ValueError("Recipient and subject may not contain line breaks"))
+            continue
+        key = (m['subject'], m['body'])
+        template = templates.get(key)
+        if template is None:
+            message = MIMEText(m['body'])
+            message['subject'] = m['subject']
+            template = templates[key] = message.as_bytes()
+        raw = compat32.fold_binary('to', m['recipient']) + template
+        encoded.append(base64.urlsafe_b64encode(raw).decode())
+    return encoded
+
+def send_google_emails(messages):
+    """
+    Sends many emails through the Gmail batch endpoint.
+    `messages` is a list of {"recipient", "subject", "body"}; data holds one
+    {"status", "data", "message"} result per message, in order. Messages that
+    cannot be encoded are reported without being sent.
+    """
+    creds = get_google_credentials()
+    if not creds:
+        return {"status": "warning", "data": "", "message": "Not logged in to Google"}
+
+    gmail = google_module.get_resource('gmail', 'v1', 'users.messages')
+    encoded = encode_google_messages(messages)
+    requests_ = [gmail.send(userId="me", body={'raw': raw}) for raw in encoded if not isinstance(raw, ValueError)]
+    responses = iter(google_module.execute_batch('gmail', 'v1', requests_, creds) if requests_ else ())
+
+    results = []
+    for message, raw in zip(messages, encoded):
+        if isinstance(raw, ValueError):
+            results.append({"status": "error", "data": message['recipient'], "message": str(raw)})
+            continue
+        response, error = next(responses)
+        if error is None:
+            results.append({"status": "success", "data": response, "message": ""})
+        else:
+            results.append({"status": "error", "data": message['recipient'], "message": str(error)})
+
+    sent = sum(1 for r in results if r['status'] == 'success')
+    LOGGER.info(f"Bulk Gmail: {sent}/{len(messages)} sent")
+    if sent == len(messages):
+        status = "success"
+    elif sent:
+        status = "warning"
+    else:
+        status = "error"
+    return {"status": status, "data": results, "message": f"{sent}/{len(messages)} sent"}
+
+def build_google_event(event):
+    """Calendar API body of an event_module event."""
+    return {
+        'summary': event['title'],
+        'description': event['description'],
+        'location': event['location'],
+        'start': event['start'],
+        'end': event['end'],
+    }
+
+def create_google_event(event, user_id=None):
+    """Creates an event_module event with the Google Calendar API."""
+    creds = get_google_credentials(user_id)
+    if not creds:
+        return {"status": "warning", "data": "", "message": "Not logged in to Google"}
     try:
-        service = build('calendar', 'v3', credentials=creds)
-        event = {
-            'summary': title,
-            'start': {'dateTime': start_time, 'timeZone': 'UTC'},
-            'end': {'dateTime': end_time, 'timeZone': 'UTC'},
-        }
-        event = service.events().insert(calendarId='primary', body=event).execute()
-        LOGGER.info(f"Event created: {event.get('htmlLink')}")
-        return {"status": "success", "data": event}
-    except HttpError as error:
+        events = google_module.get_resource('calendar', 'v3', 'events')
+        created = google_module.execute(events.insert(calendarId='primary', body=build_google_event(event)), creds)
+        LOGGER.info(f"Event created: {created.get('htmlLink')}")
+        return {"status": "success", "data": created, "message": ""}
+    except google_module.HttpError as error:
         LOGGER.error(f"An error occurred: {error}")
-        return {"status": "error", "message": str(error)}
+        return {"status": "error", "data": "", "message": str(error)}
+
+def create_google_events(events, user_id=None):
+    """
+    Imports many events (an iterable of event_module events, e.g. a parsed file)
+    through Calendar batch requests; see import_events.
+    """
+    creds = get_google_credentials(user_id)
+    if not creds:
+        return {"status": "warning", "data": "", "message": "Not logged in to Google"}
+    calendar = google_module.get_resource('calendar', 'v3', 'events')
+
+    def create(chunk):
+        requests_ = [calendar.insert(calendarId='primary', body=build_google_event(e)) for e in chunk]
+        return [(response, None) if error is None else (None, str(error))
+                for response, error in google_module.execute_batch('calendar', 'v3', requests_, creds)]
+
+    return import_events(events, create, "Google")
 
 # --- Microsoft Graph API Functions ---
 
-def send_microsoft_email(recipient, subject, body):
-    """Sends an email using the Microsoft Graph API."""
-    microsoft_credentials = session.get('microsoft_credentials')
-    graph_api_url = 'https://graph.microsoft.com/v1.0/me/sendMail'
-    headers = {'Authorization': 'Bearer ' + microsoft_credentials['access_token']}
-    email_msg = {
+def build_microsoft_message(recipient, subject, body):
+    """Builds the Graph sendMail payload."""
+    return {
         'message': {
             'subject': subject,
             'body': {'contentType': 'Text', 'content': body},
@@ -86,27 +198,319 @@ def send_microsoft_email(recipient, subject, body):
         },
         'saveToSentItems': 'true'
     }
-    response = requests.post(graph_api_url, headers=headers, json=email_msg)
+
+def send_microsoft_email(recipient, subject, body, user_id=None, attachments=None):
+    """
+    Sends an email using the Microsoft Graph API.
+    `user_id` defaults to the session's user; background jobs pass it explicitly.
+    `attachments` (see attachment_module.from_files) are sent through
+    send_microsoft_email_with_attachments.
+    """
+    microsoft_credentials = get_microsoft_credentials(user_id)
+    if not microsoft_credentials:
+        return {"status": "warning", "data": "", "message": "Not logged in to Microsoft"}
+    email_msg = build_microsoft_message(recipient, subject, body)
+    try:
+        if attachments:
+            response = send_microsoft_email_with_attachments(
+                microsoft_credentials['access_token'], email_msg['message'], attachments)
+        else:
+            response = graph_module.get_graph_client().post(
+                'me/sendMail', microsoft_credentials['access_token'], json=email_msg)
+    except (requests.RequestException, ValueError) as error:
+        LOGGER.error(f"Error sending email: {error}")
+        return {"status": "error", "message": str(error)}
     if response.status_code == 202:
         LOGGER.info(f"Successfully sent email to {recipient}")
         return {"status": "success"}
     else:
-        LOGGER.error(f"Error sending email: {response.json()}")
-        return {"status": "error", "message": response.json().get('error', {}).get('message', 'Unknown error')}
-
-def create_microsoft_event(user, title, start_time, end_time):
-    """Creates a calendar event using the Microsoft Graph API."""
-    graph_api_url = 'https://graph.microsoft.com/v1.0/me/events'
-    headers = {'Authorization': 'Bearer ' + user['access_token']}
-    event = {
-        "subject": title,
-        "start": {"dateTime": start_time, "timeZone": "UTC"},
-        "end": {"dateTime": end_time, "timeZone": "UTC"}
+        LOGGER.error(f"Error sending email: {response.text}")
+        return {"status": "error", "message": graph_module.error_message(response)}
+
+def add_microsoft_attachment(client, access_token, message_id, attachment):
+    """
+    Adds an attachment to a draft: inline below UPLOAD_SESSION_MIN_BYTES,
+    otherwise through an upload session in [ATTACHMENTS] CHUNK_SIZE ranges.
+    Returns the Graph response (201 on success).
+    """
+    if attachment['size'] < graph_module.UPLOAD_SESSION_MIN_BYTES:
+        return client.post(f'me/messages/{message_id}/attachments', access_token, json={
+            '@odata.type': '#microsoft.graph.fileAttachment',
+            'name': attachment['name'],
+            'contentType': attachment['content_type'],
+            'contentBytes': base64.b64encode(attachment['stream'].read()).decode(),
+        })
+    response = client.post(f'me/messages/{message_id}/attachments/createUploadSession', access_token, json={
+        'AttachmentItem': {
+            'attachmentType': 'file',
+            'name': attachment['name'],
+            'contentType': attachment['content_type'],
+            'size': attachment['size'],
+        }
+    })
+    if response.status_code != 201:
+        return response
+    return client.upload(response.json()['uploadUrl'], attachment['stream'], attachment['size'],
+                         attachment_module.chunk_size(attachment_module.GRAPH_CHUNK_UNIT))
+
+def send_microsoft_email_with_attachments(access_token, message, attachments):
+    """
+    Creates `message` as a draft, adds the attachments one at a time and sends
+    it; a draft that could not be completed is deleted again.
+    Returns the failing Graph response, or the send response (202).
+    """
+    client = graph_module.get_graph_client()
+    response = client.post('me/messages', access_token, json=message)
+    if response.status_code != 201:
+        return response
+    message_id = response.json()['id']
+    try:
+        for attachment in attachments:
+            response = add_microsoft_attachment(client, access_token, message_id, attachment)
+            if response.status_code != 201:
+                break
+        else:
+            response = client.post(f'me/messages/{message_id}/send', access_token)
+    except (requests.RequestException, ValueError):
+        client.delete(f'me/messages/{message_id}', access_token)
+        raise
+    if response.status_code != 202:
+        client.delete(f'me/messages/{message_id}', access_token)
+    return response
+
+def send_microsoft_emails(messages):
+    """
+    Sends many emails through Graph JSON $batch (20 per call).
+    `messages` is a list of {"recipient", "subject", "body"}; data holds one
+    {"status", "data", "message"} result per message, in order.
+    """
+    microsoft_credentials = get_microsoft_credentials()
+    if not microsoft_credentials:
+        return {"status": "warning", "data": "", "message": "Not logged in to Microsoft"}
+
+    batch_requests = [{
+        'method': 'POST',
+        'url': '/me/sendMail',
+        'headers': {'Content-Type': 'application/json'},
+        'body': build_microsoft_message(m['recipient'], m['subject'], m['body']),
+    } for m in messages]
+    responses = graph_module.get_graph_client().batch(batch_requests, microsoft_credentials['access_token'])
+
+    results = []
+    for message, response in zip(messages, responses):
+        if response['status'] == 202:
+            results.append({"status": "success", "data": message['recipient'], "message": ""})
+        else:
+            results.append({"status": "error", "data": message['recipient'],
+                            "message": graph_module.error_message(response)})
+
+    sent = sum(1 for r in results if r['status'] == 'success')
+    LOGGER.info(f"Bulk email: {sent}/{len(messages)} sent")
+    if sent == len(messages):
+        status = "success"
+    elif sent:
+        status = "warning"
+    else:
+        status = "error"
+    return {"status": status, "data": results, "message": f"{sent}/{len(messages)} sent"}
+
+def build_microsoft_event(event):
+    """Graph event body of an event_module event; all-day events start and end at midnight."""
+    body = {
+        'subject': event['title'],
+        'body': {'contentType': 'Text', 'content': event['description']},
+        'location': {'displayName': event['location']},
     }
-    response = requests.post(graph_api_url, headers=headers, json=event)
+    for key in ('start', 'end'):
+        when = event[key]
+        if 'date' in when:
+            body['isAllDay'] = True
+            when = {'dateTime': f"{when['date']}T00:00:00", 'timeZone': 'UTC'}
+        body[key] = when
+    return body
+
+def create_microsoft_event(event, user_id=None):
+    """Creates an event_module event with the Microsoft Graph API."""
+    microsoft_credentials = get_microsoft_credentials(user_id)
+    if not microsoft_credentials:
+        return {"status": "warning", "data": "", "message": "Not logged in to Microsoft"}
+    try:
+        response = graph_module.get_graph_client().post(
+            'me/events', microsoft_credentials['access_token'], json=build_microsoft_event(event))
+    except requests.RequestException as error:
+        LOGGER.error(f"Error creating event: {error}")
+        return {"status": "error", "data": "", "message": str(error)}
     if response.status_code == 201:
         LOGGER.info(f"Successfully created event: {response.json().get('webLink')}")
-        return {"status": "success", "data": response.json()}
+        return {"status": "success", "data": response.json(), "message": ""}
+    else:
+        LOGGER.error(f"Error creating event: {response.text}")
+        return {"status": "error", "data": "", "message": graph_module.error_message(response)}
+
+def create_microsoft_events(events, user_id=None):
+    """
+    Imports many events (an iterable of event_module events, e.g. a parsed file)
+    through Graph JSON $batch; see import_events.
+    """
+    microsoft_credentials = get_microsoft_credentials(user_id)
+    if not microsoft_credentials:
+        return {"status": "warning", "data": "", "message": "Not logged in to Microsoft"}
+    client = graph_module.get_graph_client()
+
+    def create(chunk):
+        batch_requests = [{
+            'method': 'POST',
+            'url': '/me/events',
+            'headers': {'Content-Type': 'application/json'},
+            'body': build_microsoft_event(e),
+        } for e in chunk]
+        responses = client.batch(batch_requests, microsoft_credentials['access_token'])
+        return [(response['body'], None) if response['status'] == 201
+                else (None, graph_module.error_message(response)) for response in responses]
+
+    return import_events(events, create, "Microsoft")
+
+# --- Calendar import ---
+
+def import_events(events, create, provider_name):
+    """
+    Creates `events` [EVENTS] IMPORT_CHUNK_SIZE at a time with `create(chunk)`,
+    which returns one (created event, error message) per event. `events` may be
+    a generator over an uploaded file, so only one chunk is held in memory.
+    Invalid events (ValueError items) are reported without being sent; a file
+    that cannot be parsed further stops the import with the results so far.
+    data holds one {"status", "data", "message"} result per event, in order.
+    """
+    chunk_size = get_config().get_int("EVENTS", "IMPORT_CHUNK_SIZE", 500)
+    results = []
+    error = ""
+    chunks = event_module.chunks(events, chunk_size)
+    while True:
+        # Only reading the file can stop the import; create() errors are per chunk
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            break
+        except ValueError as e:
+            error = f"; import stopped: {e}"
+            break
+        results.extend(_import_chunk(chunk, create))
+
+    created_count = sum(1 for r in results if r['status'] == 'success')
+    LOGGER.info(f"{provider_name} calendar import: {created_count}/{len(results)} created{error}")
+    if created_count == len(results) and not error:
+        status = "success"
+    elif created_count:
+        status = "warning"
+    else:
+        status = "error"
+    return {"status": status, "data": results, "message": f"{created_count}/{len(results)} created{error}"}
+
+def _import_chunk(chunk, create):
+    """
+    One result per event of `chunk`. When create() fails (a provider or network
+    error) or returns a result count that does not match, every event it was
+    given is reported with that error.
+    """
+    valid = [e for e in chunk if not isinstance(e, ValueError)]
+    created = []
+    if valid:
+        try:
+            created = create(valid)
+            if len(created) != len(valid):
+                raise ValueError(f"{len(created)} results returned for {len(valid)} events")
+        except Exception as e:
+            LOGGER.error(f"Error creating events: {e}")
+            created = [(None, str(e))] * len(valid)
+    created = iter(created)
+    results = []
+    for event in chunk:
+        if isinstance(event, ValueError):
+            results.append({"status": "error", "data": "", "message": str(event)})
+            continue
+        response, message = next(created)
+        if message is None:
+            results.append({"status": "success",
+                            "data": {"id": response.get('id'),
+                                     "link": response.get('htmlLink') or response.get('webLink')},
+                            "message": ""})
+        else:
+            results.append({"status": "error", "data": event['title'], "message": message})
+    return results
+
+# --- Microsoft Graph API, asyncio variants (served by asgi_module) ---
+
+async def get_microsoft_credentials_async(user_id):
+    """Token lookup (and refresh) may query the database, so it runs in a worker thread."""
+    if user_id is None:
+        return None
+    # Bound in the task; the worker thread only sees a copy of its context
+    ratelimit_module.bind_user(user_id)
+    return await asyncio.to_thread(get_microsoft_credentials, user_id)
+
+async def send_microsoft_email_async(recipient, subject, body, user_id):
+    """Async send_microsoft_email; the event loop is free while Graph answers."""
+    microsoft_credentials = await get_microsoft_credentials_async(user_id)
+    if not microsoft_credentials:
+        return {"status": "warning", "data": "", "message": "Not logged in to Microsoft"}
+    email_msg = build_microsoft_message(recipient, subject, body)
+    try:
+        response = await graph_async_module.get_async_graph_client().post(
+            'me/sendMail', microsoft_credentials['access_token'], json=email_msg)
+    except graph_async_module.REQUEST_ERRORS as error:
+        LOGGER.error(f"Error sending email: {error}")
+        return {"status": "error", "message": str(error)}
+    if response.status_code == 202:
+        LOGGER.info(f"Successfully sent email to {recipient}")
+        return {"status": "success"}
     else:
-        LOGGER.error(f"Error creating event: {response.json()}")
-        return {"status": "error", "message": response.json().get('error', {}).get('message', 'Unknown error')}
+        LOGGER.error(f"Error sending email: {response.text}")
+        return {"status": "error", "message": graph_module.error_message(response)}
+
+async def create_microsoft_event_async(event, user_id=None):
+    """Async create_microsoft_event: creates an event_module event for the given user."""
+    microsoft_credentials = await get_microsoft_credentials_async(user_id)
+    if not microsoft_credentials:
+        return {"status": "warning", "data": "", "message": "Not logged in to Microsoft"}
+    try:
+        response = await graph_async_module.get_async_graph_client().post(
+            'me/events', microsoft_credentials['access_token'], json=build_microsoft_event(event))
+    except graph_async_module.REQUEST_ERRORS as error:
+        LOGGER.error(f"Error creating event: {error}")
+        return {"status": "error", "data": "", "message": str(error)}
+    if response.status_code == 201:
+        LOGGER.info(f"Successfully created event: {response.json().get('webLink')}")
+        return {"status": "success", "data": response.json(), "message": ""}
+    else:
+        LOGGER.error(f"Error creating event: {response.text}")
+        return {"status": "error", "data": "", "message": graph_module.error_message(response)}
+
+async def get_microsoft_profile_async(user_id):
+    """The user's Graph /me profile."""
+    microsoft_credentials = await get_microsoft_credentials_async(user_id)
+    if not microsoft_credentials:
+        return {"status": "warning", "data": "", "message": "Not logged in to Microsoft"}
+    try:
+        response = await graph_async_module.get_async_graph_client().get(
+            'me', microsoft_credentials['access_token'])
+    except graph_async_module.REQUEST_ERRORS as error:
+        LOGGER.error(f"Error fetching profile: {error}")
+        return {"status": "error", "message": str(error)}
+    if response.status_code == 200:
+        return {"status": "success", "data": response.json()}
+    return {"status": "error", "message": graph_module.error_message(response)}
+
+async def get_microsoft_photo_async(user_id):
+    """The user's Graph profile photo as (bytes, content type), or None when there is none."""
+    microsoft_credentials = await get_microsoft_credentials_async(user_id)
+    if not microsoft_credentials:
+        return None
+    try:
+        response = await graph_async_module.get_async_graph_client().get(
+            'me/photo/$value', microsoft_credentials['access_token'])
+    except graph_async_module.REQUEST_ERRORS as error:
+        LOGGER.error(f"Error fetching photo: {error}")
+        return None
+    if response.status_code != 200:
+        return None
+    return response.content, response.headers.get('Content-Type', 'image/jpeg')
@@ -0,0 +1,233 @@
+"""
+ASGI entry point: serves the Microsoft Graph endpoints natively on asyncio and
+every other route through the Flask app, run in a thread pool.
+
+    python serve.py --asgi
+    uvicorn asgi_module:create_asgi_app --factory --workers 4
+
+Async routes (same session cookie, CORS headers and response envelope as the
+Flask routes):
+    POST /api/async/send_microsoft_email     {"recipient", "subject", "body"}
+    POST /api/async/create_microsoft_event   body of /api/create-event (see event_module.from_json)
+    GET  /api/async/microsoft/me
+    GET  /api/async/microsoft/me/photo
+"""
+import asyncio
+import io
+import json
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_cors.core import get_cors_headers, get_cors_options
+from werkzeug.wrappers import Request
+
+import api_module
+import event_module
+import graph_async_module
+import metrics_module
+import ratelimit_module
+import token_module
+from config_module import get_config
+
+
+# Request bodies for the Flask routes are kept in memory up to this size, then spooled to disk
+SPOOL_MAX_MEMORY = 512 * 1024
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI http scope; `body` is a file-like object."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0] if client else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            environ[name] = value
+            continue
+        key = f"HTTP_{name}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def run_wsgi(wsgi_app, environ):
+    """Runs a WSGI app to completion; returns (status, headers, body)."""
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response["status"], response["headers"], body
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def spool_body(receive, max_memory):
+    """
+    Request body as a SpooledTemporaryFile: bodies larger than `max_memory`
+    (attachment uploads) are written to disk instead of being held in memory.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    while True:
+        message = await receive()
+        body.write(message.get("body", b""))
+        if not message.get("more_body"):
+            body.seek(0)
+            return body
+
+
+async def send_response(send, status, headers, body):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def json_response(payload):
+    # Envelope errors are reported in the body with HTTP 200, as in the Flask routes
+    return 200, [("Content-Type", "application/json")], json.dumps(payload).encode()
+
+
+# --- Async routes ---
+
+async def send_email(data, user_id):
+    return json_response(await api_module.send_microsoft_email_async(
+        data['recipient'], data['subject'], data['body'], user_id))
+
+async def create_event(data, user_id):
+    return json_response(await api_module.create_microsoft_event_async(event_module.from_json(data), user_id))
+
+async def get_me(data, user_id):
+    return json_response(await api_module.get_microsoft_profile_async(user_id))
+
+async def get_photo(data, user_id):
+    photo = await api_module.get_microsoft_photo_async(user_id)
+    if photo is None:
+        return json_response({"status": "warning", "data": "", "message": "No photo available"})
+    content, content_type = photo
+    return 200, [("Content-Type", content_type), ("Cache-Control", "private, max-age=300")], content
+
+ROUTES = {
+    ("POST", "/api/async/send_microsoft_email"): send_email,
+    ("POST", "/api/async/create_microsoft_event"): create_event,
+    ("GET", "/api/async/microsoft/me"): get_me,
+    ("GET", "/api/async/microsoft/me/photo"): get_photo,
+}
+ROUTE_PATHS = {path for _, path in ROUTES}
+
+
+class AsgiApp:
+    """ASGI application wrapping the Flask app."""
+
+    def __init__(self, flask_app, threads=8):
+        import Service
+        self.flask_app = flask_app
+        # Bounds how many Flask (blocking) requests run at once, like gthread workers
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="wsgi")
+        self.cors_options = get_cors_options(flask_app, Service.CORS_OPTIONS)
+
+    def cors_headers(self, environ):
+        """The CORS headers Flask-CORS would add to this request's response."""
+        headers = get_cors_headers(self.cors_options, Request(environ).headers, environ["REQUEST_METHOD"])
+        return [(name, str(value)) for name, value in headers.items(multi=True)]
+
+    def session_user_id(self, environ):
+        """Reads the Microsoft user id from Flask's signed session cookie."""
+        session = self.flask_app.session_interface.open_session(self.flask_app, Request(environ))
+        return session.get(token_module.SESSION_KEYS[token_module.MICROSOFT]) if session else None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        route = ROUTES.get((scope["method"], scope["path"]))
+        preflight = scope["method"] == "OPTIONS" and scope["path"] in ROUTE_PATHS
+        if route is None and not preflight:
+            environ = build_environ(scope, await spool_body(receive, SPOOL_MAX_MEMORY))
+            loop = asyncio.get_running_loop()
+            try:
+                status, headers, payload = await loop.run_in_executor(
+                    self.executor, run_wsgi, self.flask_app.wsgi_app, environ)
+            finally:
+                environ["wsgi.input"].close()
+            await send_response(send, status, headers, payload)
+            return
+
+        body = await read_body(receive)
+        environ = build_environ(scope, io.BytesIO(body))
+        cors_headers = self.cors_headers(environ)
+        if preflight:
+            await send_response(send, 200, cors_headers, b"")
+            return
+
+        token = metrics_module.start_request(scope["path"], scope["method"])
+        status = 500
+        try:
+            data = json.loads(body) if body else {}
+            if not isinstance(data, dict):
+                raise ValueError("a JSON object body is required")
+            status, headers, payload = await route(data, self.session_user_id(environ))
+        except (ValueError, KeyError) as e:
+            status, headers, payload = json_response(
+                {"status": "warning", "data": "", "message": f"Invalid request: {e}"})
+        except ratelimit_module.RateLimitExceeded as e:
+            status, headers, payload = json_response({"status": "warning", "data": "", "message": str(e)})
+            headers.append(("Retry-After", str(max(1, round(e.retry_after)))))
+        finally:
+            metrics_module.finish_request(token, scope["path"], status, environ["REMOTE_ADDR"])
+        await send_response(send, status, headers + cors_headers, payload)
+
+    async def lifespan(self, receive, send):
+        import Service
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await graph_async_module.close_async_graph_client()
+                self.executor.shutdown(wait=True)
+                await asyncio.to_thread(Service.shutdown)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def create_asgi_app():
+    """ASGI application factory (one per worker process)."""
+    import Service
+    return AsgiApp(Service.create_app(), threads=get_config().get_int("SERVER", "THREADS", 8))
@@ -0,0 +1,84 @@
+import base64
+import os
+import uuid
+from email.message import MIMEPart
+from email.policy import SMTP
+
+from config_module import get_config
+
+# Gmail resumable uploads take chunks in multiples of 256 KiB, Graph upload sessions of 320 KiB
+GMAIL_CHUNK_UNIT = 256 * 1024
+GRAPH_CHUNK_UNIT = 320 * 1024
+# Raw bytes base64-encoded at a time: 57 bytes make one 76-character line
+BASE64_BLOCK = 57 * 1024
+
+
+def chunk_size(unit):
+    """[ATTACHMENTS] CHUNK_SIZE rounded down to a multiple of `unit` (at least one unit)."""
+    size = get_config().get_int("ATTACHMENTS", "CHUNK_SIZE", 1280 * 1024)
+    return max(unit, size // unit * unit)
+
+
+def from_files(files):
+    """
+    Attachments of a multipart/form-data request (its "attachments" file fields)
+    as {"name", "content_type", "stream", "size"}. The form parser has already
+    spooled large uploads to temporary files, so nothing is read into memory here.
+    """
+    attachments = []
+    for storage in files.getlist("attachments"):
+        if not storage.filename:
+            continue
+        stream = storage.stream
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        attachments.append({
+            "name": storage.filename,
+            "content_type": storage.mimetype or "application/octet-stream",
+            "stream": stream,
+            "size": size,
+        })
+    return attachments
+
+
+def read_blocks(stream, block_size):
+    """Yields `stream` in blocks of at most `block_size` bytes."""
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def _headers(part):
+    return b"".join(part.policy.fold_binary(name, value) for name, value in part.items()) + b"\r\n"
+
+
+def mime_message(recipient, subject, body, attachments):
+    """
+    Yields an RFC 822 multipart/mixed message with a text body and the given
+    attachments, a piece at a time: attachments are base64-encoded one
+    BASE64_BLOCK at a time, so the message is never built in memory.
+    """
+    boundary = f"=_{uuid.uuid4().hex}"
+    message = MIMEPart(policy=SMTP)
+    message["To"] = recipient
+    message["Subject"] = subject
+    message["MIME-Version"] = "1.0"
+    message["Content-Type"] = f'multipart/mixed; boundary="{boundary}"'
+    yield _headers(message)
+
+    text = MIMEPart(policy=SMTP)
+    text.set_content(body)
+    yield f"--{boundary}\r\n".encode() + bytes(text)
+
+    for attachment in attachments:
+        part = MIMEPart(policy=SMTP)
+        part["Content-Type"] = attachment["content_type"]
+        part.add_header("Content-Disposition", "attachment", filename=attachment["name"])
+        part["Content-Transfer-Encoding"] = "base64"
+        yield f"\r\n--{boundary}\r\n".encode() + _headers(part)
+        for block in read_blocks(attachment["stream"], BASE64_BLOCK):
+            yield base64.encodebytes(block).replace(b"\n", b"\r\n")
+    yield f"\r\n--{boundary}--\r\n".encode()
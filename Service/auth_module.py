@@ -1,41 +1,61 @@
-import configparser
-import msal
 import os
 import requests
-from flask import Blueprint, request, jsonify, redirect, session, make_response
-from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+import threading
+from collections.abc import MutableMapping
+from flask import Blueprint, current_app, request, jsonify, redirect, session, make_response, url_for
+from itsdangerous import BadSignature, URLSafeTimedSerializer
 
 
 import db_module
+import graph_module
+import id_token_module
+import photo_module
+import ratelimit_module
+import token_module
+from config_module import get_config
+from lazy_module import is_loaded, lazy_import
 from log_module import setup_logger
 
 
 # Setup logger
 LOGGER = setup_logger("auth", "logs/service")
 
+# Provider SDKs are loaded by the first login with that provider
+msal = lazy_import("msal")
+oauthlib_flow = lazy_import("google_auth_oauthlib.flow")
+google_module = lazy_import("google_module")
+
 auth_bp = Blueprint('auth_bp', __name__)
 
-def get_config():
-    """Reads configuration from myConfig.ini."""
-    config = configparser.ConfigParser()
-    # Assuming myConfig.ini is in the same directory or a known path
-    config.read("myConfig.ini", encoding="utf-8")
-    return config
+# Process-wide OAuth clients, rebuilt only when the config snapshot changes
+_CLIENT_LOCK = threading.Lock()
+_MSAL_BUILD_LOCK = threading.Lock()
+_MSAL_APP = None              # (config version, ConfidentialClientApplication)
+_CLIENT_STATS = {
+    "msal_apps_created": 0,
+    "msal_metadata_fetches": 0,
+}
+
+def get_client_stats():
+    """Returns how often client secrets / authority metadata were loaded in this process."""
+    with _CLIENT_LOCK:
+        stats = dict(_CLIENT_STATS)
+    # Not loading the Google SDK just to report that nothing was loaded
+    stats["google_client_config_loads"] = google_module.client_config_loads if is_loaded(google_module) else 0
+    return stats
 
 # --- Google OAuth ---
 def get_google_flow():
     """Initializes and returns a Google OAuth Flow instance."""
     config = get_config()
-    client_secrets_file = config['GOOGLE']['client_secret_file']
-    scopes = config['GOOGLE']['scopes'].split()
-    redirect_uri = config['GOOGLE']['redirect_uri']
+    scopes = config.get_list('GOOGLE', 'scopes')
+    redirect_uri = config.get('GOOGLE', 'redirect_uri')
 
     # The google_state is used to prevent CSRF attacks.
     # It's stored in the session to be verified in the callback.
-    flow = Flow.from_client_secrets_file(
-        client_secrets_file,
+    # A Flow carries per-request state, so only the parsed client config is shared.
+    flow = oauthlib_flow.Flow.from_client_config(
+        google_module.get_client_config(),
         scopes=scopes,
         redirect_uri=redirect_uri
     )
@@ -61,7 +81,10 @@ def google_callback():
     """
     google_state = session.pop('google_state', None)
     flow = get_google_flow()
-    
+
+    # The user is not known before the token exchange, so logins share the provider-wide limiter
+    ratelimit_module.bind_user(None)
+    ratelimit_module.acquire(ratelimit_module.GOOGLE)
     try:
         flow.fetch_token(authorization_response=request.url, state=google_state)
     except Exception as e:
@@ -69,24 +92,19 @@ def google_callback():
         return jsonify({"status": "error", "message": "Authentication failed."}), 400
 
     credentials = flow.credentials
-    user_info_service = build('oauth2', 'v2', credentials=credentials)
-    user_info = user_info_service.userinfo().get().execute()
+    user_info = google_user_info(credentials)
     email = user_info.get('email')
 
     if not email:
-        return jsonify({"status": "error", "message": "Email not found in Google profile."}), 400
+        return jsonify({"status": "error", "message": "Verified email not found in Google profile."}), 400
 
-    session['google_credentials'] = {
-        'token': credentials.token,
-        'refresh_token': credentials.refresh_token,
-        'token_uri': credentials.token_uri,
-        'client_id': credentials.client_id,
-        'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes
-    }
+    # Tokens are kept server-side; the session cookie only carries the user id
+    session['google_user_id'] = token_module.save_tokens(
+        email, token_module.GOOGLE, credentials.token, credentials.refresh_token,
+        token_module.expires_in(credentials.expiry))
 
     config = get_config()
-    frontend_url = config['WEB']['frontend_url']
+    frontend_url = config.get('WEB', 'frontend_url')
     
     # The response will be a script that sends tokens to the parent window
     response_html = f"""
@@ -107,24 +125,148 @@ def google_callback():
     response = make_response(response_html)
     return response
 
+def google_user_info(credentials):
+    """
+    email / name / picture of the signed-in user, from the locally verified
+    id_token; the userinfo endpoint is only called when a claim is missing.
+    email is None unless Google says the address is verified, since it keys
+    the user's row.
+    """
+    client_config = google_module.get_client_config()
+    client_id = (client_config.get('web') or client_config.get('installed') or {}).get('client_id')
+    claims = id_token_module.verify_id_token(
+        id_token_module.GOOGLE, getattr(credentials, 'id_token', None), client_id)
+    if claims and claims.get('email'):
+        user_info = {"email": claims['email'], "name": claims.get('name'), "picture": claims.get('picture')}
+        verified = claims.get('email_verified')
+    else:
+        userinfo = google_module.get_resource('oauth2', 'v2', 'userinfo')
+        user_info = google_module.execute(userinfo.get(), credentials)
+        verified = user_info.get('verified_email')
+    # Older tokens carry the claim as a string
+    if verified not in (True, 'true'):
+        LOGGER.warning(f"Google account {user_info.get('email')} has no verified email")
+        user_info['email'] = None
+    return user_info
+
 @auth_bp.route("/google/logout", methods=["POST"])
 def google_logout():
     """
     Logs out the user from Google by clearing the session.
     """
     session.pop('google_state', None)
+    token_module.forget(session.get('google_user_id'))
     session.clear()
 
 # --- Microsoft (MSAL) OAuth ---
+class _LockedDict(MutableMapping):
+    """
+    dict guarded by a lock. MSAL's http_cache is read and written by every
+    request thread through the shared app, and MSAL wraps it in several
+    mappings of its own, each with a separate lock.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._data))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def pop(self, key, *default):
+        with self._lock:
+            return self._data.pop(key, *default)
+
+_MSAL_HTTP_CACHE = _LockedDict()
+
+class _MetadataCountingHttpClient:
+    """HTTP client handed to MSAL that counts authority/instance discovery requests."""
+
+    def __init__(self, session=None):
+        self._session = session or requests.Session()
+
+    def get(self, url, **kwargs):
+        if "openid-configuration" in url or "discovery/instance" in url:
+            with _CLIENT_LOCK:
+                _CLIENT_STATS["msal_metadata_fetches"] += 1
+        return self._session.get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self._session.post(url, **kwargs)
+
+    def close(self):
+        self._session.close()
+
+def _discarding_token_cache():
+    """
+    MSAL token cache that keeps nothing. Tokens are stored by token_module, so
+    MSAL's default in-memory cache in the process-wide app would only be an
+    ever-growing second copy of every user's access, refresh and id tokens.
+    """
+    class DiscardingTokenCache(msal.TokenCache):
+        def add(self, event, **kwargs):
+            pass
+
+    return DiscardingTokenCache()
+
 def get_msal_app():
-    """Initializes and returns an MSAL ConfidentialClientApplication."""
+    """
+    Returns the process-wide MSAL ConfidentialClientApplication.
+    Keeping one instance preserves the discovered authority metadata across
+    requests; it is thread-safe. Tokens it acquires are not cached in it.
+    """
+    global _MSAL_APP
     config = get_config()
-    app = msal.ConfidentialClientApplication(
-        config['AZURE']['client_id'],
-        authority=config['MSAL']['authority'],
-        client_credential=config['AZURE']['client_secret'],
-    )
-    return app
+    cached = _MSAL_APP
+    if cached and cached[0] == config.version:
+        return cached[1]
+
+    with _MSAL_BUILD_LOCK:
+        cached = _MSAL_APP
+        if cached and cached[0] == config.version:
+            return cached[1]
+        # Constructing the app performs authority discovery (counted by the http client)
+        app = msal.ConfidentialClientApplication(
+            config.get('AZURE', 'client_id'),
+            authority=config.get('MSAL', 'authority'),
+            client_credential=config.get('AZURE', 'client_secret'),
+            # Only off for authorities Microsoft does not know, e.g. a local stand-in
+            validate_authority=config.get_bool('MSAL', 'VALIDATE_AUTHORITY', True),
+            http_client=_MetadataCountingHttpClient(),
+            http_cache=_MSAL_HTTP_CACHE,
+            token_cache=_discarding_token_cache(),
+        )
+        _MSAL_APP = (config.version, app)
+        with _CLIENT_LOCK:
+            _CLIENT_STATS["msal_apps_created"] += 1
+        return app
+
+def reset_msal_app():
+    """Drops the MSAL app (and its HTTP session) inherited from the parent process."""
+    global _MSAL_APP
+    with _MSAL_BUILD_LOCK:
+        _MSAL_APP = None
 
 @auth_bp.route("/microsoft/login")
 def microsoft_login():
@@ -132,8 +274,8 @@ def microsoft_login():
     Generates a Microsoft authorization URL.
     """
     config = get_config()
-    scopes = config['MSAL']['scopes'].split()
-    redirect_uri = config['MSAL']['redirect_uri']
+    scopes = config.get_list('MSAL', 'scopes')
+    redirect_uri = config.get('MSAL', 'redirect_uri')
     
     app = get_msal_app()
     auth_url = app.get_authorization_request_url(
@@ -144,16 +286,16 @@ def microsoft_login():
 
 @auth_bp.route("/microsoft/callback")
 def microsoft_callback():
-    import json
-    import base64
     """
     Handles Microsoft callback, creates tokens, and sets refresh token in cookie.
     """
     config = get_config()
-    scopes = config['MSAL']['scopes'].split()
-    redirect_uri = config['MSAL']['redirect_uri']
+    scopes = config.get_list('MSAL', 'scopes')
+    redirect_uri = config.get('MSAL', 'redirect_uri')
     
     app = get_msal_app()
+    ratelimit_module.bind_user(None)
+    ratelimit_module.acquire(ratelimit_module.MICROSOFT)
     result = app.acquire_token_by_authorization_code(
         request.args['code'],
         scopes=scopes,
@@ -164,39 +306,28 @@ def microsoft_callback():
         LOGGER.error(f"MSAL Error: {result.get('error_description')}")
         return jsonify({"status": "error", "message": "Authentication failed."}), 400
 
-    # Get user profile information from Microsoft Graph
+    # The profile thumbnail is fetched from Microsoft Graph while the id_token is checked
     ms_access_token = result['access_token']
-    graph_api_url = 'https://graph.microsoft.com/v1.0/me'
-    user_info = requests.get(
-        graph_api_url,
-        headers={'Authorization': 'Bearer ' + ms_access_token}
-    ).json()
+    photo_future = graph_module.submit(photo_module.fetch_photo, ms_access_token)
+    user_info = microsoft_user_info(result)
 
     email = user_info.get('mail') or user_info.get('userPrincipalName')
     if not email:
         return jsonify({"status": "error", "message": "Email not found in Microsoft profile."}), 400
 
-
-    # Get user's profile image
-    photo_url = 'https://graph.microsoft.com/v1.0/me/photo/$value'
-    photo_response = requests.get(
-        photo_url,
-        headers={'Authorization': 'Bearer ' + ms_access_token}
-    )
-    photo_data_url = None
-    if photo_response.status_code == 200:
-        photo_content_b64 = base64.b64encode(photo_response.content).decode('utf-8')
-        photo_data_url = f"data:image/jpeg;base64,{photo_content_b64}"
-
-    frontend_url = config['WEB']['frontend_url']
+    frontend_url = config.get('WEB', 'frontend_url')
 
     access_token = result['access_token']
     refresh_token = result.get('refresh_token', None)
 
-    session['microsoft_credentials'] = {
-        'access_token': access_token,
-        'refresh_token': refresh_token
-    }
+    user_id = token_module.save_tokens(
+        email, token_module.MICROSOFT, access_token, refresh_token, result.get('expires_in', 3600))
+    session['microsoft_user_id'] = user_id
+
+    # The photo is served by microsoft_photo instead of being inlined as a data URL
+    photo = photo_future.result()
+    photo_module.store(user_id, photo)
+    photo_url = photo_url_for(user_id, photo)
 
     response_html = f"""
     <script>
@@ -207,7 +338,7 @@ def microsoft_callback():
         userInfo: {{
           email: '{email}',
           name: '{user_info.get("displayName")}',
-          picture: '{photo_data_url or ''}'
+          picture: '{photo_url}'
         }}
       }}, '{frontend_url}');
       window.close();
@@ -217,11 +348,77 @@ def microsoft_callback():
     return response
 
 
+def microsoft_user_info(result):
+    """
+    The signed-in user's profile in Graph /me form (mail, userPrincipalName,
+    displayName), from the locally verified id_token; Graph is asked when the
+    token has no verified email. The email claim is set by the user's tenant, so
+    it is only used with the xms_edov optional claim (domain owner verified);
+    otherwise any tenant could sign in as another user's row. preferred_username
+    is never used as the address: it is only a display hint the user may change.
+    """
+    claims = id_token_module.verify_id_token(
+        id_token_module.MICROSOFT, result.get('id_token'), get_config().get('AZURE', 'client_id'))
+    if claims and claims.get('email') and claims.get('xms_edov') in (True, 'true', '1', 1):
+        return {"mail": claims['email'], "userPrincipalName": claims.get('preferred_username'),
+                "displayName": claims.get('name')}
+    return graph_module.get_graph_client().get('me', result['access_token']).json()
+
+def _photo_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt="microsoft-photo")
+
+def photo_url_for(user_id, photo):
+    """
+    Signed thumbnail URL. It works without the session cookie (which browsers do
+    not send on cross-site image requests); the ETag in it busts caches when the
+    photo changes.
+    """
+    if photo == photo_module.NO_PHOTO:
+        return ''
+    token = _photo_serializer().dumps(user_id)
+    return url_for('auth_bp.microsoft_photo', token=token, v=photo[0], _external=True)
+
+@auth_bp.route("/microsoft/photo/<token>")
+def microsoft_photo(token):
+    """
+    Returns the user's profile thumbnail (cached per user, see [PHOTOS]) with
+    ETag / Cache-Control, answering 304 when the browser's copy is current.
+    """
+    config = get_config()
+    try:
+        user_id = _photo_serializer().loads(token, max_age=config.get_int("PHOTOS", "URL_MAX_AGE", 86400))
+    except BadSignature:
+        return jsonify({"status": "warning", "data": "", "message": "Invalid or expired photo link"})
+
+    photo = photo_module.get_photo(user_id)
+    if photo == photo_module.NO_PHOTO:
+        return jsonify({"status": "warning", "data": "", "message": "No photo available"})
+    etag, content_type, content = photo
+    max_age = config.get_int("PHOTOS", "CACHE_TTL", 3600)
+    headers = {"ETag": f'"{etag}"', "Cache-Control": f"private, max-age={max_age}"}
+    if request.if_none_match.contains(etag):
+        return make_response("", 304, headers)
+    response = make_response(content)
+    response.headers.update(headers)
+    response.headers["Content-Type"] = content_type
+    return response
+
+@auth_bp.route("/client_stats")
+def client_stats():
+    """
+    Returns OAuth client setup counters, e.g. to verify that authority
+    discovery happens once per process.
+    """
+    return jsonify({"status": "success", "data": get_client_stats(), "message": ""})
+
 @auth_bp.route("/logout", methods=["POST"])
 def logout():
     """
     Logs out the user by clearing the session and the JWT cookie.
     """
+    for key in token_module.SESSION_KEYS.values():
+        token_module.forget(session.get(key))
+    photo_module.forget(session.get('microsoft_user_id'))
     session.clear()
     response = jsonify({"status": "success", "message": "Logged out successfully."})
     return response
@@ -229,19 +426,21 @@ def logout():
 @auth_bp.route("/me")
 def me():
     """
-    Returns the profile of the currently logged-in user.
-    The user's identity is retrieved from the JWT.
+    Returns the profile of the currently logged-in user, per provider, from
+    the users table (read through the user cache; token columns are not read).
     """
-    
-    # In a real application, you would fetch user details from the database
-    # using the identity (e.g., user's email or ID).
-    # user = db_module.get_user_by_email(current_user_identity)
-    # For now, we'll just return the identity from the token.
-    
+    providers = {}
+    for provider, key in token_module.SESSION_KEYS.items():
+        user = db_module.get_user_profile(session.get(key))
+        if user:
+            providers[provider] = user
+    if not providers:
+        return jsonify({"status": "warning", "data": "", "message": "Not logged in"})
+
     return jsonify({
         "status": "success",
         "data": {
-            "email": ""
-            # Add other user details here after fetching from DB
+            "email": next(iter(providers.values()))["email"],
+            "providers": providers,
         }
     })
@@ -0,0 +1,902 @@
+"""
+Micro-benchmarks for the Service package.
+
+Usage:
+    python benchmark.py db-pool --iterations 500 --threads 8
+    python benchmark.py db-upsert --iterations 2000 --threads 16
+    python benchmark.py config --iterations 2000
+    python benchmark.py logging --iterations 5000 --threads 4
+    python benchmark.py google-send --iterations 500
+    python benchmark.py gmail-batch --iterations 500
+    python benchmark.py graph-session --iterations 1000 --threads 8
+    python benchmark.py graph-batch --iterations 200 --throttle-every 7
+    python benchmark.py ms-callback --iterations 200 --latency 50
+    python benchmark.py graph-async --iterations 2000 --threads 8 --concurrency 200 --latency 100
+    python benchmark.py id-token --iterations 200 --latency 50
+    python benchmark.py attachments
+    python benchmark.py calendar-import --iterations 5000 --latency 50
+    python benchmark.py ratelimit --iterations 100 --threads 8 --stub-rate 20
+    python benchmark.py import-time --iterations 10 --budget 450
+
+Run from the Service directory so myConfig.ini is picked up. These only
+measure; the checks that must pass are in tests/ (python -m pytest -q tests),
+whose stub servers and mock transports (tests/support.py) they share.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+
+from tests.support import (SERVICE_DIR, MockGmailHttp, MockResumableGmailHttp, StubGraphHandler,
+                           StubRateLimitedHandler, eagerly_loaded_sdks, start_stub_server)
+
+
+def report(name, samples, elapsed=None):
+    """Prints latency percentiles (ms) for a list of samples in seconds."""
+    samples = sorted(samples)
+    count = len(samples)
+    if not count:
+        print(f"{name:<28} no samples")
+        return
+
+    def pct(p):
+        return samples[min(count - 1, int(count * p))] * 1000
+
+    line = (f"{name:<28} n={count:<6} mean={statistics.mean(samples) * 1000:8.3f}ms "
+            f"p50={pct(0.50):8.3f}ms p95={pct(0.95):8.3f}ms p99={pct(0.99):8.3f}ms")
+    if elapsed:
+        line += f" rate={count / elapsed:9.1f}/s"
+    print(line)
+
+
+def run_threads(func, iterations, threads):
+    """Runs func() `iterations` times spread over `threads` threads, returns (samples, elapsed)."""
+    samples = []
+    lock = threading.Lock()
+    per_thread = max(1, iterations // threads)
+
+    def worker():
+        local = []
+        for _ in range(per_thread):
+            start = time.perf_counter()
+            func()
+            local.append(time.perf_counter() - start)
+        with lock:
+            samples.extend(local)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return samples, time.perf_counter() - start
+
+
+# --- Database ---
+
+def bench_db_pool(args):
+    """Per-call connect (the old get_db_connection) vs. pooled checkout, running SELECT 1."""
+    import mysql.connector
+    import db_module
+
+    pool = db_module.get_pool()
+    connect_args = pool.connect_args
+
+    def per_call():
+        conn = mysql.connector.connect(**connect_args)
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        conn.close()
+
+    def pooled():
+        with db_module.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+
+    report("per-call connect", *run_threads(per_call, args.iterations, args.threads))
+    report("pooled", *run_threads(pooled, args.iterations, args.threads))
+    print("pool stats:", db_module.get_pool_stats())
+
+
+def bench_db_upsert(args):
+    """
+    get_or_create_user: the old SELECT then UPDATE/INSERT vs. the prepared
+    upsert, with `threads` threads logging in the same 4 users at once.
+    Reports duplicate-key failures and server statements (Questions) per call,
+    then one-by-one vs. bulk upsert_users for `iterations` users.
+    """
+    import itertools
+    import uuid
+    from datetime import datetime, timedelta
+    import mysql.connector
+    import db_module
+
+    db_module.create_user_table()
+
+    @db_module.db_operation
+    def select_then_write(cursor, email, provider, token):
+        expiry = datetime.utcnow() + timedelta(hours=1)
+        db_module.exec_sql(cursor, "SELECT * FROM users WHERE email = %s AND auth_provider = %s", (email, provider))
+        user = cursor.fetchone()
+        if user:
+            db_module.exec_sql(cursor, "UPDATE users SET access_token = %s, token_expiry = %s WHERE id = %s",
+                               (token, expiry, user["id"]))
+        else:
+            db_module.exec_sql(cursor, "INSERT INTO users (email, auth_provider, access_token, refresh_token, "
+                                       "token_expiry) VALUES (%s, %s, %s, %s, %s)",
+                               (email, provider, token, "r", expiry))
+
+    @db_module.db_operation
+    def questions(cursor):
+        db_module.exec_sql(cursor, "SHOW GLOBAL STATUS LIKE 'Questions'")
+        return int(cursor.fetchone()["Value"])
+
+    @db_module.db_operation
+    def cleanup(cursor, provider):
+        db_module.exec_sql(cursor, "DELETE FROM users WHERE auth_provider = %s", (provider,))
+
+    def measure(name, write):
+        provider = f"bench-{uuid.uuid4().hex[:8]}"
+        counter = itertools.count()
+        failures = []
+
+        def login():
+            i = next(counter)
+            try:
+                write(f"user{i % 4}@example.com", provider, f"token-{i}")
+            except mysql.connector.IntegrityError:
+                failures.append(i)
+
+        before = questions()
+        samples, elapsed = run_threads(login, args.iterations, args.threads)
+        statements = (questions() - before - 1) / len(samples)
+        report(name, samples, elapsed)
+        print(f"  duplicate-key failures: {len(failures)}  statements/call: {statements:.2f}")
+        cleanup(provider)
+
+    measure("select then write", select_then_write)
+    measure("upsert", lambda email, provider, token: db_module.get_or_create_user(
+        email, provider, token, None, 3600))
+
+    provider = f"bench-{uuid.uuid4().hex[:8]}"
+    users = [{"email": f"user{i}@example.com", "auth_provider": provider, "access_token": "a",
+              "refresh_token": "r", "expires_in": 3600} for i in range(args.iterations)]
+    start = time.perf_counter()
+    for u in users:
+        db_module.get_or_create_user(u["email"], provider, "a", "r", 3600)
+    print(f"{'one by one':<28} {len(users)} users {(time.perf_counter() - start) * 1000:9.1f}ms")
+    start = time.perf_counter()
+    affected = db_module.upsert_users(users)
+    print(f"{'upsert_users (bulk)':<28} {len(users)} users {(time.perf_counter() - start) * 1000:9.1f}ms "
+          f"affected={affected}")
+    cleanup(provider)
+
+
+# --- Flask app ---
+
+def write_client_secrets(token_uri="https://oauth2.googleapis.com/token"):
+    """Writes a throwaway Google client secrets file and points the config at it."""
+    import os
+    import tempfile
+
+    secrets = {
+        "web": {
+            "client_id": "benchmark-client",
+            "client_secret": "benchmark-secret",
+            "auth_uri": "https://accounts.google.com/o/oauth2/auth",
+            "token_uri": token_uri,
+            "redirect_uris": ["http://localhost:5000/api/auth/google/callback"],
+        }
+    }
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(secrets, f)
+    os.environ["MYOAUTH__GOOGLE__CLIENT_SECRET_FILE"] = path
+    os.environ.setdefault("MYOAUTH__GOOGLE__REDIRECT_URI", secrets["web"]["redirect_uris"][0])
+    os.environ.setdefault("MYOAUTH__GOOGLE__SCOPES", "openid email profile")
+    return path
+
+
+_APP = None
+
+def get_test_client():
+    """Builds the Flask app once through the application factory and returns a test client."""
+    global _APP
+    import Service
+
+    if _APP is None:
+        _APP = Service.create_app()
+    return _APP.test_client()
+
+
+def bench_config(args):
+    """Latency of /api/auth/google/login with per-request INI parsing vs. the cached config."""
+    import auth_module
+    import config_module
+
+    write_client_secrets()
+    config_module.reload_config()
+    client = get_test_client()
+
+    def login():
+        client.get("/api/auth/google/login")
+
+    report("load_config (parse)", *run_threads(config_module.load_config, args.iterations, 1))
+    report("get_config (cached)", *run_threads(config_module.get_config, args.iterations, 1))
+
+    cached = auth_module.get_config
+    auth_module.get_config = config_module.load_config
+    try:
+        report("google/login parse per call", *run_threads(login, args.iterations, args.threads))
+    finally:
+        auth_module.get_config = cached
+    report("google/login cached config", *run_threads(login, args.iterations, args.threads))
+
+
+def bench_logging_run(args):
+    """Request throughput of GET / under the current [LOG] configuration."""
+    client = get_test_client()
+    report(args.label or "GET /", *run_threads(lambda: client.get("/"), args.iterations, args.threads))
+
+
+def bench_logging(args):
+    """GET / throughput with DEBUG logging off, synchronous and queued (one process per mode)."""
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    modes = (
+        ("logging off (INFO)", {"LEVEL": "INFO", "ASYNC": "false"}),
+        ("DEBUG, sync handler", {"LEVEL": "DEBUG", "ASYNC": "false"}),
+        ("DEBUG, async queue", {"LEVEL": "DEBUG", "ASYNC": "true"}),
+    )
+    for label, settings in modes:
+        env = dict(os.environ, **{f"MYOAUTH__LOG__{key}": value for key, value in settings.items()})
+        with tempfile.TemporaryDirectory() as log_root:
+            subprocess.run([sys.executable, os.path.abspath(__file__), "logging-run", "--label", label,
+                            "--iterations", str(args.iterations), "--threads", str(args.threads)],
+                           env=env, cwd=log_root, check=True)
+
+
+# --- Google API ---
+
+def bench_google_send(args):
+    """Gmail send path: build() per call vs. the cached google_module resources (mocked HTTP)."""
+    from googleapiclient.discovery import build
+    from googleapiclient.http import HttpMock
+    import google_module
+
+    response = b'{"id": "benchmark-message", "threadId": "benchmark-thread"}'
+
+    class MockHttp(HttpMock):
+        def __init__(self):
+            super().__init__(headers={"status": "200"})
+            self.data = response
+
+    body = {"raw": "VG86IGJlbmNobWFya0BleGFtcGxlLmNvbQoKaGVsbG8="}
+
+    def per_call_build():
+        service = build("gmail", "v1", http=MockHttp())
+        service.users().messages().send(userId="me", body=body).execute()
+
+    def cached_resource():
+        messages = google_module.get_resource("gmail", "v1", "users.messages")
+        messages.send(userId="me", body=body).execute(http=MockHttp())
+
+    report("build() per call", *run_threads(per_call_build, args.iterations, args.threads))
+    report("cached resource", *run_threads(cached_resource, args.iterations, args.threads))
+
+
+def bench_attachments(args):
+    """
+    Peak Python memory (tracemalloc) of one /api/send_*_email request with an
+    attachment of growing size: Gmail through a local resumable-upload
+    transport, Graph through a stub server with upload sessions. The peak
+    should stay flat while the attachment grows.
+    """
+    import os
+    import tempfile
+    import tracemalloc
+    from unittest import mock
+
+    server, base_url = start_stub_server(StubGraphHandler)
+    # Before the first import of the service modules, which load the config
+    os.environ["MYOAUTH__GRAPH__BASE_URL"] = f"{base_url}/v1.0"
+    from google.oauth2.credentials import Credentials
+    import api_module
+    import google_module
+
+    http = MockResumableGmailHttp()
+    client = get_test_client()
+    patches = [
+        mock.patch.object(google_module, "authorized_http", lambda credentials: http),
+        mock.patch.object(api_module, "get_google_credentials", lambda user_id=None: Credentials(token="x")),
+        mock.patch.object(api_module, "get_microsoft_credentials", lambda user_id=None: {"access_token": "x"}),
+    ]
+    for patch in patches:
+        patch.start()
+
+    tracemalloc.start()
+    for megabytes in (1, 4, 16, 64):
+        for provider in ("google", "microsoft"):
+            # The test client closes the file once the request is sent
+            with tempfile.TemporaryFile() as attachment:
+                attachment.truncate(megabytes * 1024 * 1024)
+                http.received = StubGraphHandler.counter = 0
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                start = time.perf_counter()
+                response = client.post(f"/api/send_{provider}_email", content_type="multipart/form-data", data={
+                    "recipient": "bench@example.com", "subject": "benchmark", "body": "hello",
+                    "attachments": (attachment, "benchmark.bin", "application/octet-stream"),
+                })
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                uploaded = http.received if provider == "google" else StubGraphHandler.counter
+                print(f"{provider:<10} {megabytes:>3} MB attachment  peak={peak / 2 ** 20:6.2f} MB  "
+                      f"uploaded={uploaded / 2 ** 20:7.2f} MB  {elapsed * 1000:8.1f}ms  "
+                      f"{response.get_json()['status']}")
+    tracemalloc.stop()
+    for patch in patches:
+        patch.stop()
+    server.shutdown()
+
+
+def bench_gmail_batch(args):
+    """`iterations` Gmail sends one at a time vs. send_google_emails' batch path (mocked transport)."""
+    import os
+
+    # Measures the transport alone; before the first import of the service modules, which load the config
+    os.environ["MYOAUTH__RATELIMIT__ENABLED"] = "false"
+    from unittest import mock
+    from google.oauth2.credentials import Credentials
+    import api_module
+    import google_module
+
+    creds = Credentials(token="benchmark")
+    messages = [{"recipient": f"user{i}@example.com", "subject": "benchmark", "body": "hello " * 200}
+                for i in range(args.iterations)]
+    http = MockGmailHttp(latency=args.latency / 1000)
+    gmail = google_module.get_resource("gmail", "v1", "users.messages")
+
+    def one_at_a_time():
+        for m in messages:
+            message = api_module.MIMEText(m["body"])
+            message["to"] = m["recipient"]
+            message["subject"] = m["subject"]
+            raw = api_module.base64.urlsafe_b64encode(message.as_bytes()).decode()
+            gmail.send(userId="me", body={"raw": raw}).execute(http=http)
+
+    with mock.patch.object(google_module, "authorized_http", lambda credentials: http), \
+            mock.patch.object(api_module, "get_google_credentials", lambda: creds):
+        for name, func in (("one at a time", one_at_a_time),
+                           ("batch", lambda: api_module.send_google_emails(messages))):
+            http.calls = 0
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            print(f"{name:<28} {len(messages) / elapsed:9.1f} msg/s  http calls={http.calls}")
+
+
+# --- Microsoft Graph ---
+
+def bench_graph_session(args):
+    """Bare requests.post per call vs. the pooled GraphClient against a local stub Graph."""
+    import os
+
+    # Measures the transport alone; before the first import of the service modules, which load the config
+    os.environ["MYOAUTH__RATELIMIT__ENABLED"] = "false"
+    import requests
+    import graph_module
+
+    StubGraphHandler.throttle_every = args.throttle_every
+    server, base_url = start_stub_server(StubGraphHandler)
+    url = f"{base_url}/v1.0/me/sendMail"
+    payload = {"message": {"subject": "benchmark"}, "saveToSentItems": "true"}
+    client = graph_module.GraphClient(base_url=f"{base_url}/v1.0", pool_maxsize=args.threads,
+                                      backoff_factor=0)
+    failures = []
+
+    def bare():
+        response = requests.post(url, headers={"Authorization": "Bearer x"}, json=payload)
+        if response.status_code != 202:
+            failures.append(response.status_code)
+
+    def pooled():
+        response = client.post("me/sendMail", "x", json=payload)
+        if response.status_code != 202:
+            failures.append(response.status_code)
+
+    report("requests.post per call", *run_threads(bare, args.iterations, args.threads))
+    print(f"  failed: {len(failures)}")
+    failures.clear()
+    report("pooled GraphClient", *run_threads(pooled, args.iterations, args.threads))
+    print(f"  failed: {len(failures)}")
+    server.shutdown()
+
+
+def bench_graph_batch(args):
+    """`iterations` emails sent one POST at a time vs. packed into $batch calls."""
+    import os
+
+    # Measures the transport alone; before the first import of the service modules, which load the config
+    os.environ["MYOAUTH__RATELIMIT__ENABLED"] = "false"
+    import graph_module
+    from api_module import build_microsoft_message
+
+    StubGraphHandler.throttle_every = args.throttle_every
+    server, base_url = start_stub_server(StubGraphHandler)
+    client = graph_module.GraphClient(base_url=f"{base_url}/v1.0", backoff_factor=0)
+    messages = [build_microsoft_message(f"user{i}@example.com", "benchmark", "hello")
+                for i in range(args.iterations)]
+
+    start = time.perf_counter()
+    sent = sum(client.post("me/sendMail", "x", json=m).status_code == 202 for m in messages)
+    elapsed = time.perf_counter() - start
+    print(f"{'one request per email':<28} sent={sent}/{len(messages)} {elapsed * 1000:9.1f}ms "
+          f"rate={len(messages) / elapsed:9.1f}/s")
+
+    batch = [{"method": "POST", "url": "/me/sendMail", "headers": {"Content-Type": "application/json"},
+              "body": m} for m in messages]
+    start = time.perf_counter()
+    responses = client.batch(batch, "x")
+    elapsed = time.perf_counter() - start
+    sent = sum(r["status"] == 202 for r in responses)
+    print(f"{'$batch':<28} sent={sent}/{len(messages)} {elapsed * 1000:9.1f}ms "
+          f"rate={len(messages) / elapsed:9.1f}/s")
+    server.shutdown()
+
+
+def bench_ms_callback(args):
+    """
+    /api/auth/microsoft/callback latency and response size against a stub Graph
+    answering after `latency` ms (MSAL and the token store are replaced locally).
+    """
+    import os
+
+    StubGraphHandler.latency = args.latency / 1000
+    server, base_url = start_stub_server(StubGraphHandler)
+    # Before the first import of the service modules, which load the config
+    os.environ["MYOAUTH__GRAPH__BASE_URL"] = f"{base_url}/v1.0"
+    import auth_module
+    import token_module
+
+    class FakeMsalApp:
+        def acquire_token_by_authorization_code(self, code, scopes, redirect_uri):
+            return {"access_token": "x", "refresh_token": "r", "expires_in": 3600}
+
+    auth_module.get_msal_app = lambda: FakeMsalApp()
+    token_module.save_tokens = lambda *args_: 1
+    client = get_test_client()
+    sizes = []
+
+    def callback():
+        response = client.get("/api/auth/microsoft/callback?code=benchmark")
+        sizes.append(len(response.data))
+
+    report(args.label or "microsoft_callback", *run_threads(callback, args.iterations, args.threads))
+    print(f"  response size: {sizes[-1]} bytes")
+    server.shutdown()
+
+
+class StubProviderHandler(StubGraphHandler):
+    """
+    StubGraphHandler plus the identity provider endpoints used at login: a token
+    endpoint returning an RS256 id_token, the JWKS with its public key and
+    Google's userinfo. `claims` is filled in per token request.
+    """
+
+    private_key = None
+    jwks = None
+    claims = {}
+
+    @classmethod
+    def generate_key(cls):
+        import jwt
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        cls.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = jwt.algorithms.RSAAlgorithm.to_jwk(cls.private_key.public_key(), as_dict=True)
+        cls.jwks = {"keys": [dict(jwk, kid="benchmark-key", use="sig", alg="RS256")]}
+
+    @classmethod
+    def id_token(cls, **claims):
+        import jwt
+
+        now = int(time.time())
+        return jwt.encode(dict(cls.claims, iat=now, exp=now + 3600, **claims), cls.private_key,
+                          algorithm="RS256", headers={"kid": "benchmark-key"})
+
+    def do_GET(self):
+        if self.path == "/certs":
+            self._send(200, self.jwks, {"Cache-Control": "public, max-age=3600"})
+        elif self.path == "/oauth2/v2/userinfo":
+            time.sleep(self.latency)
+            self._send(200, {"email": self.claims["email"], "verified_email": True,
+                             "name": self.claims["name"], "picture": self.claims["picture"]})
+        else:
+            super().do_GET()
+
+    def do_POST(self):
+        if self.path == "/token":
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            time.sleep(self.latency)
+            self._send(200, {"access_token": "x", "token_type": "Bearer", "expires_in": 3600,
+                             "id_token": self.id_token()})
+        else:
+            super().do_POST()
+
+
+def bench_id_token(args):
+    """
+    Google and Microsoft login callback latency against a stub provider answering
+    after `latency` ms: profile from the userinfo endpoint / Graph /me
+    ([ID_TOKEN] VERIFY = false) vs. from the id_token verified with the cached
+    JWKS. The token store is replaced locally; Google's userinfo call goes to the
+    stub through a replaced google_module.execute.
+    """
+    import os
+
+    import requests
+
+    StubProviderHandler.latency = args.latency / 1000
+    StubProviderHandler.generate_key()
+    server, base_url = start_stub_server(StubProviderHandler)
+    # Before the first import of the service modules, which load the config
+    write_client_secrets(token_uri=f"{base_url}/token")
+    os.environ.update({
+        "OAUTHLIB_INSECURE_TRANSPORT": "1",
+        "OAUTHLIB_RELAX_TOKEN_SCOPE": "1",
+        "MYOAUTH__GRAPH__BASE_URL": f"{base_url}/v1.0",
+        "MYOAUTH__AZURE__CLIENT_ID": "benchmark-client",
+        "MYOAUTH__ID_TOKEN__GOOGLE_JWKS_URI": f"{base_url}/certs",
+        "MYOAUTH__ID_TOKEN__MICROSOFT_JWKS_URI": f"{base_url}/certs",
+        "MYOAUTH__ID_TOKEN__MICROSOFT_ISSUER": f"{base_url}/{{tid}}/v2.0",
+    })
+    import auth_module
+    import google_module
+    import id_token_module
+    import token_module
+    from config_module import reload_config
+
+    session = requests.Session()
+
+    def execute(request, credentials, **kwargs):
+        return session.get(f"{base_url}/oauth2/v2/userinfo",
+                           headers={"Authorization": f"Bearer {credentials.token}"}).json()
+
+    class FakeMsalApp:
+        def acquire_token_by_authorization_code(self, code, scopes, redirect_uri):
+            # MSAL's token request, with the stub's latency
+            time.sleep(StubProviderHandler.latency)
+            return {"access_token": "x", "refresh_token": "r", "expires_in": 3600,
+                    "id_token": StubProviderHandler.id_token(
+                        iss=f"{base_url}/benchmark-tenant/v2.0", aud="benchmark-client",
+                        tid="benchmark-tenant", email="bench@example.com", xms_edov=True,
+                        preferred_username="bench@example.com")}
+
+    google_module.execute = execute
+    auth_module.get_msal_app = lambda: FakeMsalApp()
+    token_module.save_tokens = lambda *args_: 1
+    client = get_test_client()
+
+    def google_callback():
+        StubProviderHandler.claims = {
+            "iss": "https://accounts.google.com", "aud": "benchmark-client", "sub": "1",
+            "email": "bench@example.com", "email_verified": True, "name": "Benchmark User",
+            "picture": "http://localhost/p.jpg"}
+        with client.session_transaction() as flask_session:
+            flask_session["google_state"] = "benchmark"
+        response = client.get("/api/auth/google/callback?code=benchmark&state=benchmark")
+        assert b"bench@example.com" in response.data, response.data[:200]
+
+    def microsoft_callback():
+        StubProviderHandler.claims = {"name": "Benchmark User", "sub": "1"}
+        response = client.get("/api/auth/microsoft/callback?code=benchmark")
+        assert b"bench@example.com" in response.data, response.data[:200]
+
+    for verify in ("false", "true"):
+        os.environ["MYOAUTH__ID_TOKEN__VERIFY"] = verify
+        reload_config()
+        source = "id_token" if verify == "true" else "userinfo / Graph /me"
+        report(f"google callback, profile from {source}",
+               *run_threads(google_callback, args.iterations, args.threads))
+        report(f"microsoft callback, profile from {source}",
+               *run_threads(microsoft_callback, args.iterations, args.threads))
+    fetches = {provider: id_token_module.get_jwks_cache(provider).fetches
+               for provider in (id_token_module.GOOGLE, id_token_module.MICROSOFT)}
+    print(f"  JWKS fetches: {fetches}")
+    server.shutdown()
+
+
+def bench_ratelimit(args):
+    """
+    `threads` senders of one user calling sendMail for `iterations` calls each
+    against a stub Graph that accepts `--stub-rate` calls/s: without the
+    limiter, with the AIMD limiter, and with the limiter reading quota headers.
+    Reports accepted calls/s, 429s and the errors the callers saw.
+    """
+    import os
+
+    server, base_url = start_stub_server(StubRateLimitedHandler)
+    # Before the first import of the service modules, which load the config
+    os.environ["MYOAUTH__GRAPH__BASE_URL"] = f"{base_url}/v1.0"
+    os.environ["MYOAUTH__RATELIMIT__MICROSOFT_USER_RATE"] = str(args.stub_rate * 2)
+    import graph_module
+    import ratelimit_module
+    from config_module import reload_config
+
+    for name, enabled, quota_headers in (("no limiter", "false", False), ("AIMD limiter", "true", False),
+                                         ("limiter + quota headers", "true", True)):
+        os.environ["MYOAUTH__RATELIMIT__ENABLED"] = enabled
+        reload_config()
+        ratelimit_module._LIMITERS.clear()
+        StubRateLimitedHandler.reset(args.stub_rate, quota_headers)
+        client = graph_module.get_graph_client()
+        errors = []
+
+        def send():
+            ratelimit_module.bind_user(1)
+            try:
+                response = client.post("me/sendMail", "x", json={})
+                if response.status_code != 202:
+                    errors.append(response.status_code)
+            except ratelimit_module.RateLimitExceeded as error:
+                errors.append(error)
+
+        samples, elapsed = run_threads(send, args.iterations, args.threads)
+        report(name, samples, elapsed)
+        stats = ratelimit_module.get_limiter(ratelimit_module.MICROSOFT, 1).stats()
+        print(f"  accepted {StubRateLimitedHandler.accepted / elapsed:6.1f}/s of {args.stub_rate}/s  "
+              f"429s={StubRateLimitedHandler.rejected}  caller errors={len(errors)}  "
+              f"limiter rate={stats['rate']}/s queued={stats['queued']} rejected={stats['rejected']}")
+    server.shutdown()
+
+
+def bench_graph_async(args):
+    """
+    Sync GraphClient on `threads` threads (one per in-flight call, as in a
+    gthread worker) vs. AsyncGraphClient holding `concurrency` calls on a
+    single event loop, against a stub Graph answering after `latency` ms.
+    """
+    import os
+
+    # Measures the transport alone; before the first import of the service modules, which load the config
+    os.environ["MYOAUTH__RATELIMIT__ENABLED"] = "false"
+    import asyncio
+    import graph_async_module
+    import graph_module
+
+    StubGraphHandler.throttle_every = args.throttle_every
+    StubGraphHandler.latency = args.latency / 1000
+    server, base_url = start_stub_server(StubGraphHandler)
+    payload = {"message": {"subject": "benchmark"}, "saveToSentItems": "true"}
+    failures = []
+
+    client = graph_module.GraphClient(base_url=f"{base_url}/v1.0", pool_maxsize=args.threads,
+                                      backoff_factor=0)
+
+    def sync_send():
+        if client.post("me/sendMail", "x", json=payload).status_code != 202:
+            failures.append(1)
+
+    report(f"sync, {args.threads} threads", *run_threads(sync_send, args.iterations, args.threads))
+    print(f"  failed: {len(failures)}")
+    failures.clear()
+
+    async def run_async():
+        async_client = graph_async_module.AsyncGraphClient(
+            base_url=f"{base_url}/v1.0", pool_maxsize=args.concurrency, backoff_factor=0)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        samples = []
+
+        async def send():
+            async with semaphore:
+                start = time.perf_counter()
+                response = await async_client.post("me/sendMail", "x", json=payload)
+                samples.append(time.perf_counter() - start)
+                if response.status_code != 202:
+                    failures.append(1)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send() for _ in range(args.iterations)))
+        elapsed = time.perf_counter() - start
+        await async_client.close()
+        return samples, elapsed
+
+    report(f"async, {args.concurrency} in flight", *asyncio.run(run_async()))
+    print(f"  failed: {len(failures)}")
+    server.shutdown()
+
+
+# --- Calendar ---
+
+class CountingGraphHandler(StubGraphHandler):
+    """StubGraphHandler counting the HTTP requests it receives."""
+
+    requests = 0
+
+    def do_POST(self):
+        with self.counter_lock:
+            CountingGraphHandler.requests += 1
+        super().do_POST()
+
+
+def bench_calendar_import(args):
+    """
+    An .ics file of `iterations` events imported one create-event call at a
+    time vs. through POST /api/create-event/bulk (streamed parse, Calendar
+    batch / Graph $batch), per provider: events/s, HTTP calls and the peak
+    Python memory (tracemalloc) of the bulk import.
+    """
+    import io
+    import os
+    import tracemalloc
+    from unittest import mock
+
+    server, base_url = start_stub_server(CountingGraphHandler)
+    # Measures the transport alone; before the first import of the service modules, which load the config
+    os.environ["MYOAUTH__RATELIMIT__ENABLED"] = "false"
+    os.environ["MYOAUTH__GRAPH__BASE_URL"] = f"{base_url}/v1.0"
+    from google.oauth2.credentials import Credentials
+    import api_module
+    import db_module
+    import event_module
+    import google_module
+    import token_module
+
+    CountingGraphHandler.latency = args.latency / 1000
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0"]
+    for i in range(args.iterations):
+        lines += ["BEGIN:VEVENT", f"UID:bench-{i}", f"SUMMARY:Benchmark event {i}",
+                  f"DTSTART;TZID=Europe/Paris:20250101T{i % 24:02d}0000",
+                  f"DTEND;TZID=Europe/Paris:20250101T{i % 24:02d}3000",
+                  "DESCRIPTION:Imported by the benchmark\\nsecond line", "END:VEVENT"]
+    ics = ("\r\n".join(lines + ["END:VCALENDAR"]) + "\r\n").encode()
+    print(f"{args.iterations} events, {len(ics) / 1024:.0f} KiB .ics")
+
+    http = MockGmailHttp(latency=args.latency / 1000)
+    client = get_test_client()
+    provider = {"auth_provider": token_module.GOOGLE}
+    patches = [
+        mock.patch.object(google_module, "authorized_http", lambda credentials: http),
+        mock.patch.object(api_module, "get_google_credentials", lambda user_id=None: Credentials(token="x")),
+        mock.patch.object(api_module, "get_microsoft_credentials", lambda user_id=None: {"access_token": "x"}),
+        mock.patch.object(db_module, "get_user_profile", lambda user_id: dict(provider, id=user_id)),
+    ]
+    for patch in patches:
+        patch.start()
+
+    for name, create in (("google", api_module.create_google_event),
+                         ("microsoft", api_module.create_microsoft_event)):
+        provider["auth_provider"] = name
+        with client.session_transaction() as session:
+            session.clear()
+            session[token_module.SESSION_KEYS[name]] = 1
+
+        def one_at_a_time():
+            for event in event_module.parse_ics(io.BytesIO(ics)):
+                create(event, user_id=1)
+
+        def bulk():
+            response = client.post("/api/create-event/bulk", content_type="multipart/form-data",
+                                   data={"file": (io.BytesIO(ics), "calendar.ics", "text/calendar")})
+            return response.get_json()["message"]
+
+        for label, func in (("one at a time", one_at_a_time), ("bulk", bulk)):
+            http.calls = CountingGraphHandler.requests = 0
+            start = time.perf_counter()
+            message = func()
+            elapsed = time.perf_counter() - start
+            calls = http.calls if name == "google" else CountingGraphHandler.requests
+            print(f"{name:<10} {label:<16} {args.iterations / elapsed:9.1f} events/s  http calls={calls}"
+                  + (f"  {message}" if message else ""))
+
+        tracemalloc.start()
+        bulk()
+        print(f"{name:<10} bulk import peak={tracemalloc.get_traced_memory()[1] / 2 ** 20:.2f} MB")
+        tracemalloc.stop()
+
+    for patch in patches:
+        patch.stop()
+    server.shutdown()
+
+
+# --- Startup ---
+
+# Median `import Service` time bench_import_time compares with, in ms
+IMPORT_TIME_BUDGET = 450
+
+
+def measure_import_time(iterations):
+    """
+    Times `import Service` in `iterations` fresh interpreters with -X importtime.
+    Returns (seconds per run, {module Service imports directly: seconds per run}).
+    """
+    import os
+    import subprocess
+    import sys
+
+    env = dict(os.environ, MYOAUTH__REFRESH__ENABLED="false")
+    samples = []
+    children = {}
+    for _ in range(iterations):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import Service"],
+                                capture_output=True, text=True, env=env, cwd=SERVICE_DIR, check=True)
+        for line in result.stderr.splitlines():
+            fields = line.split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue  # the header, or output that is not from -X importtime
+            cumulative, name = int(fields[1]) / 1e6, fields[2]
+            if name == " Service":
+                samples.append(cumulative)
+            elif name.startswith("   ") and not name.startswith("    "):
+                children.setdefault(name.strip(), []).append(cumulative)
+    return samples, children
+
+
+def bench_import_time(args):
+    """
+    `import Service` in `iterations` fresh interpreters, timed by -X importtime,
+    with the heaviest modules it imports directly, against the budget. Also
+    lists the provider SDKs create_app loads, which should be none
+    (tests/test_import_time.py checks that).
+    """
+    samples, children = measure_import_time(args.iterations)
+    report("import Service", samples)
+    heaviest = sorted(children.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:8]
+    for name, times in heaviest:
+        print(f"  {name:<30} {statistics.median(times) * 1000:8.1f}ms")
+    loaded = eagerly_loaded_sdks()
+    print(f"  provider SDKs loaded by create_app: {', '.join(loaded) or 'none'}")
+    budget = args.budget or IMPORT_TIME_BUDGET
+    print(f"  median {statistics.median(samples) * 1000:.1f}ms, budget {budget:g}ms")
+
+
+BENCHMARKS = {
+    "db-pool": bench_db_pool,
+    "db-upsert": bench_db_upsert,
+    "config": bench_config,
+    "logging": bench_logging,
+    "logging-run": bench_logging_run,
+    "google-send": bench_google_send,
+    "gmail-batch": bench_gmail_batch,
+    "graph-session": bench_graph_session,
+    "graph-batch": bench_graph_batch,
+    "graph-async": bench_graph_async,
+    "ms-callback": bench_ms_callback,
+    "id-token": bench_id_token,
+    "attachments": bench_attachments,
+    "ratelimit": bench_ratelimit,
+    "calendar-import": bench_calendar_import,
+    "import-time": bench_import_time,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="calls in flight on the event loop for async benchmarks")
+    parser.add_argument("--throttle-every", type=int, default=0,
+                        help="stub servers answer every Nth request with 429")
+    parser.add_argument("--stub-rate", type=float, default=20.0,
+                        help="calls/s the rate limited stub accepts before answering 429")
+    parser.add_argument("--label", help="label printed by single-run benchmarks")
+    parser.add_argument("--budget", type=float,
+                        help=f"import-time: median ms to compare with (default {IMPORT_TIME_BUDGET})")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated provider round-trip latency in ms for mocked transports")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,62 @@
+import threading
+
+from cache_module import create_cache
+from config_module import get_config
 from db_module import db_operation, exec_sql
 from log_module import setup_logger
 
 global LOGGER
 LOGGER = setup_logger("business", "logs/business")
 
+# get_user never needs the (large) token columns
+USER_COLUMNS = "id, username, email, sub"
 
-@db_operation
-def get_user(cursor, args):
+_CACHE = None
+_LOCK = threading.Lock()
+
+
+def get_cache():
+    """username -> get_user rows, invalidated by add_user."""
+    global _CACHE
+    if _CACHE is None:
+        with _LOCK:
+            if _CACHE is None:
+                config = get_config()
+                _CACHE = create_cache(
+                    "business_users",
+                    maxsize=config.get_int("CACHE", "USER_CACHE_SIZE", 10000),
+                    ttl=config.get_float("CACHE", "USER_CACHE_TTL", 300),
+                )
+    return _CACHE
+
+
+def get_user(args):
     if "username" not in args:
         return {"status": "warning", "data": "", "message": "username is required"}
-    
-    sql = "SELECT * FROM users WHERE username = %s"
-    exec_sql(cursor, sql, (args["username"],))
-    queryResult = cursor.fetchall()
+
+    queryResult = get_cache().get(args["username"])
+    if queryResult is None:
+        queryResult = _select_user(args["username"])
+        get_cache().set(args["username"], queryResult)
     return {"status": "success", "data": queryResult, "message": ""}
 
 @db_operation
-def add_user(cursor, user_info):
+def _select_user(cursor, username):
+    sql = f"SELECT {USER_COLUMNS} FROM users WHERE username = %s"
+    exec_sql(cursor, sql, (username,))
+    return cursor.fetchall()
+
+def add_user(user_info):
     if "username" not in user_info or "email" not in user_info or "sub" not in user_info:
         return {"status": "warning", "data": "", "message": "username, email, sub are required"}
-    
+
+    result = _insert_user(user_info)
+    # After the commit, so a concurrent get_user cannot cache the old rows again
+    get_cache().delete(user_info["username"])
+    return result
+
+@db_operation
+def _insert_user(cursor, user_info):
     sql = "INSERT INTO users (username, email, sub) VALUES (%s, %s, %s)"
     exec_sql(cursor, sql, (user_info["username"], user_info["email"], user_info["sub"]))
-    return {"status": "success", "data": cursor.lastrowid, "message": "加入成功"}
\ No newline at end of file
+    return {"status": "success", "data": cursor.lastrowid, "message": "加入成功"}
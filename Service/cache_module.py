@@ -0,0 +1,153 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from config_module import get_config
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with an optional time-to-live per entry."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at or None, value)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self._stats["misses"] += 1
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, size=len(self._data), maxsize=self.maxsize)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisCache:
+    """
+    Cache shared by all workers on a Redis (or Redis-compatible) server, with
+    the LRUCache interface. Values are pickled; keys are namespaced by `prefix`.
+    Size is bounded by the server's maxmemory policy. A failing server counts
+    as a miss rather than failing the request.
+    """
+
+    def __init__(self, url, prefix, ttl=None):
+        import redis  # optional dependency, only needed for [CACHE] BACKEND = redis
+
+        self.prefix = prefix
+        self.ttl = ttl
+        self._errors = redis.RedisError
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, key, default=None):
+        try:
+            raw = self._client.get(f"{self.prefix}{key}")
+        except self._errors:
+            self._count("errors")
+            raw = None
+        if raw is None:
+            self._count("misses")
+            return default
+        self._count("hits")
+        return pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        try:
+            self._client.set(f"{self.prefix}{key}", pickle.dumps(value), ex=int(ttl) if ttl else None)
+        except self._errors:
+            self._count("errors")
+
+    def delete(self, key):
+        try:
+            self._client.delete(f"{self.prefix}{key}")
+        except self._errors:
+            self._count("errors")
+
+    def clear(self):
+        try:
+            keys = list(self._client.scan_iter(match=f"{self.prefix}*", count=1000))
+            if keys:
+                self._client.delete(*keys)
+        except self._errors:
+            self._count("errors")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+_CACHES = {}  # name -> cache, for get_cache_stats
+_LOCK = threading.Lock()
+
+
+def create_cache(name, maxsize=1024, ttl=None, shared=True):
+    """
+    Creates a named cache: an LRUCache, or a RedisCache when [CACHE] BACKEND = redis
+    and `shared` is set (token caches are shared only with several workers).
+    """
+    config = get_config()
+    if shared and config.get("CACHE", "BACKEND", "memory") == "redis":
+        cache = RedisCache(config.get("CACHE", "REDIS_URL", "redis://localhost:6379/0"),
+                           prefix=f"myoauth:{name}:", ttl=ttl)
+    else:
+        cache = LRUCache(maxsize=maxsize, ttl=ttl)
+    with _LOCK:
+        _CACHES[name] = cache
+    return cache
+
+
+def get_cache_stats():
+    """Hit/miss counters of every cache made by create_cache, by name."""
+    with _LOCK:
+        caches = dict(_CACHES)
+    return {name: cache.stats() for name, cache in caches.items()}
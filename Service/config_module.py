@@ -0,0 +1,159 @@
+import configparser
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+CONFIG_FILE = "myConfig.ini"
+# MYOAUTH__<SECTION>__<KEY>=value overrides [SECTION] KEY in myConfig.ini
+ENV_PREFIX = "MYOAUTH__"
+
+
+def parse_bool(value):
+    """
+    true/false, yes/no, on/off or 1/0 (any case) as configparser reads them;
+    JSON booleans and 0/1 are taken as they are. Raises ValueError otherwise.
+    """
+    if isinstance(value, bool):
+        return value
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[str(value).strip().lower()]
+    except KeyError:
+        raise ValueError(f"Not a boolean: {value!r}")
+
+
+class ConfigSection(Mapping):
+    """Read-only view of one INI section. Keys are case-insensitive like configparser."""
+
+    def __init__(self, values):
+        self._values = {key.lower(): value for key, value in values.items()}
+
+    def __getitem__(self, key):
+        return self._values[key.lower()]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"ConfigSection({sorted(self._values)})"
+
+
+class Config:
+    """
+    Immutable snapshot of myConfig.ini with environment overrides applied.
+    Supports config['SECTION']['key'] as well as typed accessors.
+    """
+
+    def __init__(self, sections, path=None, mtime=None, version=0):
+        self._sections = {name: ConfigSection(values) for name, values in sections.items()}
+        self.path = path
+        self.mtime = mtime
+        self.version = version
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __contains__(self, section):
+        return section in self._sections
+
+    def sections(self):
+        return list(self._sections)
+
+    def get(self, section, key, fallback=None):
+        try:
+            return self._sections[section][key]
+        except KeyError:
+            return fallback
+
+    def get_int(self, section, key, fallback=None):
+        value = self.get(section, key)
+        return int(value) if value not in (None, "") else fallback
+
+    def get_float(self, section, key, fallback=None):
+        value = self.get(section, key)
+        return float(value) if value not in (None, "") else fallback
+
+    def get_bool(self, section, key, fallback=False):
+        value = self.get(section, key)
+        if value in (None, ""):
+            return fallback
+        try:
+            return parse_bool(value)
+        except ValueError:
+            raise ValueError(f"Not a boolean: [{section}] {key} = {value}")
+
+    def get_list(self, section, key, fallback=None):
+        """Whitespace separated values, e.g. OAuth scopes."""
+        value = self.get(section, key)
+        if value in (None, ""):
+            return list(fallback or [])
+        return value.split()
+
+
+def load_config(path=CONFIG_FILE, environ=None, version=0):
+    """Parses the INI file and applies MYOAUTH__SECTION__KEY environment overrides."""
+    parser = configparser.ConfigParser()
+    parser.read(path, encoding="utf-8")
+    sections = {name: dict(parser[name]) for name in parser.sections()}
+
+    environ = os.environ if environ is None else environ
+    for name, value in environ.items():
+        if not name.startswith(ENV_PREFIX):
+            continue
+        section, _, key = name[len(ENV_PREFIX):].partition("__")
+        if section and key:
+            sections.setdefault(section, {})[key.lower()] = value
+
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = None
+    return Config(sections, path=path, mtime=mtime, version=version)
+
+
+_CONFIG = None
+_LOCK = threading.Lock()
+_next_check = 0.0
+
+def get_config():
+    """
+    Returns the shared Config, parsed once per process.
+    With [CONFIG] HOT_RELOAD = true the file mtime is checked at most every
+    RELOAD_INTERVAL seconds and the snapshot is replaced when it changes.
+    """
+    global _CONFIG, _next_check
+    config = _CONFIG
+    if config is None:
+        with _LOCK:
+            if _CONFIG is None:
+                _CONFIG = load_config()
+            return _CONFIG
+
+    if config.get_bool("CONFIG", "HOT_RELOAD"):
+        now = time.monotonic()
+        if now >= _next_check:
+            with _LOCK:
+                if now >= _next_check:
+                    _next_check = now + config.get_float("CONFIG", "RELOAD_INTERVAL", 5.0)
+                    try:
+                        mtime = os.path.getmtime(config.path)
+                    except OSError:
+                        mtime = config.mtime
+                    if mtime != config.mtime:
+                        _CONFIG = load_config(config.path, version=config.version + 1)
+                config = _CONFIG
+    return config
+
+def reload_config(path=None):
+    """Forces a re-read of the configuration file."""
+    global _CONFIG
+    with _LOCK:
+        current = _CONFIG
+        _CONFIG = load_config(
+            path or (current.path if current else CONFIG_FILE),
+            version=(current.version + 1) if current else 0,
+        )
+        return _CONFIG
@@ -1,45 +1,284 @@
 import time, os
+import logging
+import threading
+from collections import deque
 from contextlib import contextmanager
 from functools import wraps
 import mysql.connector
 from mysql.connector import Error
 
+import metrics_module
+from cache_module import create_cache
+from config_module import get_config
 from log_module import setup_logger
 
 global LOGGER
 LOGGER = setup_logger("database", "logs/database")
 
-def get_config():
-    import configparser
-    configs = configparser.ConfigParser()
-    configs.read("myConfig.ini", encoding="utf-8")
-    return configs
+
+class PoolTimeoutError(Error):
+    """Raised when no connection becomes available within the pool timeout."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe MySQL connection pool.
+
+    Keeps up to `size` idle connections, allows `max_overflow` extra connections
+    under load (closed again when returned), discards connections idle longer than
+    `idle_timeout` or older than `recycle` seconds, and optionally pings a
+    connection before handing it out.
+    """
+
+    def __init__(self, connect_args, size=5, max_overflow=10, timeout=30,
+                 idle_timeout=300, recycle=3600, pre_ping=True):
+        self.connect_args = connect_args
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.recycle = recycle
+        self.pre_ping = pre_ping
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, created_at, last_used)
+        self._created_at = {}  # id(conn) -> created_at
+        self._total = 0
+        self._checked_out = 0
+        self._stats = {
+            "connects": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "timeouts": 0,
+            "recycled": 0,
+            "invalidated": 0,
+        }
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self.connect_args)
+        with self._cond:
+            self._stats["connects"] += 1
+            self._created_at[id(conn)] = time.monotonic()
+        return conn
+
+    def _close(self, conn):
+        self._created_at.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception as e:
+            LOGGER.error(f"Error closing mysql database connection: {e}")
+
+    def _is_stale(self, created_at, last_used, now):
+        if self.recycle and now - created_at > self.recycle:
+            return True
+        if self.idle_timeout and now - last_used > self.idle_timeout:
+            return True
+        return False
+
+    def acquire(self):
+        """Check a connection out of the pool, waiting up to `timeout` seconds."""
+        deadline = time.monotonic() + self.timeout
+        wait_start = None
+        stale = []
+        conn = None
+        try:
+            with self._cond:
+                try:
+                    while True:
+                        now = time.monotonic()
+                        while self._idle:
+                            candidate, created_at, last_used = self._idle.pop()
+                            if self._is_stale(created_at, last_used, now):
+                                stale.append(candidate)
+                                self._total -= 1
+                                self._stats["recycled"] += 1
+                                continue
+                            conn = candidate
+                            break
+                        if conn is not None:
+                            break
+                        if self._total < self.size + self.max_overflow:
+                            # Reserve the slot now, connect outside the lock
+                            self._total += 1
+                            break
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            self._stats["timeouts"] += 1
+                            raise PoolTimeoutError(
+                                msg=f"Connection pool exhausted ({self._total} connections in use)"
+                            )
+                        if wait_start is None:
+                            wait_start = now
+                            self._stats["waits"] += 1
+                        self._cond.wait(remaining)
+                finally:
+                    # Waits that end in a timeout count too
+                    if wait_start is not None:
+                        self._stats["wait_time"] += time.monotonic() - wait_start
+                self._checked_out += 1
+        finally:
+            for candidate in stale:
+                self._close(candidate)
+
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif self.pre_ping:
+                try:
+                    conn.ping(reconnect=False)
+                except Error:
+                    self._close(conn)
+                    with self._cond:
+                        self._stats["invalidated"] += 1
+                    conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._checked_out -= 1
+                self._cond.notify()
+            raise
+        # Only connections actually handed out count as checkouts
+        with self._cond:
+            self._stats["checkouts"] += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        """Return a connection to the pool, or close it if discarded or surplus."""
+        if not discard:
+            try:
+                if conn.unread_result:
+                    conn.consume_results()
+                if conn.in_transaction:
+                    conn.rollback()
+            except Exception as e:
+                LOGGER.error(f"Error resetting pooled connection: {e}")
+                discard = True
+
+        with self._cond:
+            self._checked_out -= 1
+            keep = not discard and len(self._idle) < self.size
+            if keep:
+                created_at = self._created_at.get(id(conn), time.monotonic())
+                self._idle.append((conn, created_at, time.monotonic()))
+            else:
+                self._total -= 1
+                if discard:
+                    self._stats["invalidated"] += 1
+            self._cond.notify()
+        if not keep:
+            self._close(conn)
+
+    def dispose(self):
+        """Close every idle connection. Checked-out connections are closed on return."""
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._total -= len(idle)
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "size": self.size,
+                "max_overflow": self.max_overflow,
+                "total": self._total,
+                "idle": len(self._idle),
+                "checked_out": self._checked_out,
+            })
+        return stats
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    """Returns the process-wide connection pool, creating it on first use."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                config = get_config()
+                DB_CONFIG = {
+                    "user": config.get("DATABASE", "DB_USER"),
+                    "password": config.get("DATABASE", "DB_PASSWORD"),
+                    "host": config.get("DATABASE", "DB_HOST"),
+                    "port": config.get_int("DATABASE", "DB_PORT", 3306),
+                    "database": config.get("DATABASE", "DB_NAME"),
+                    "charset": "utf8mb4",
+                    "collation": "utf8mb4_general_ci",
+                }
+                _POOL = ConnectionPool(
+                    DB_CONFIG,
+                    size=config.get_int("DATABASE", "POOL_SIZE", 5),
+                    max_overflow=config.get_int("DATABASE", "POOL_MAX_OVERFLOW", 10),
+                    timeout=config.get_float("DATABASE", "POOL_TIMEOUT", 30),
+                    idle_timeout=config.get_float("DATABASE", "POOL_IDLE_TIMEOUT", 300),
+                    recycle=config.get_float("DATABASE", "POOL_RECYCLE", 3600),
+                    pre_ping=config.get_bool("DATABASE", "POOL_PRE_PING", True),
+                )
+    return _POOL
+
+def reset_pool():
+    """
+    Forgets the pool without closing its connections. Used in a forked worker,
+    whose inherited sockets still belong to the parent process.
+    """
+    global _POOL
+    _POOL = None
+
+def dispose_pool():
+    """Closes the idle connections on shutdown; checked-out ones close on release."""
+    global _POOL
+    with _POOL_LOCK:
+        pool, _POOL = _POOL, None
+    if pool is not None:
+        pool.dispose()
+
+def get_pool_stats():
+    """Returns checkout/wait statistics of the connection pool."""
+    if _POOL is None:
+        return {}
+    return _POOL.stats()
 
 @contextmanager
 def get_db_connection():
-    config = get_config()
-    DB_CONFIG = {
-        "user": config["DATABASE"]["DB_USER"],
-        "password": config["DATABASE"]["DB_PASSWORD"],
-        "host": config["DATABASE"]["DB_HOST"],
-        "database": config["DATABASE"]["DB_NAME"],
-        "charset": "utf8mb4",
-        "collation": "utf8mb4_general_ci",
-    }
-    conn = None
+    pool = get_pool()
+    conn = pool.acquire()
+    discard = False
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
         yield conn
     except Error as e:
         LOGGER.error(f"Database connection error: {e}")
+        # A broken connection must not go back to the pool
+        try:
+            discard = not conn.is_connected()
+        except Exception:
+            discard = True
         raise
     finally:
-        if conn:
-            try:
-                if conn.is_connected():
-                    conn.close()
-            except Exception as e:
-                LOGGER.error(f"Error closing mysql database connection: {e}")
+        pool.release(conn, discard=discard)
+
+
+@contextmanager
+def named_lock(name, timeout=0):
+    """
+    MySQL GET_LOCK on a pooled connection, held for the duration of the block.
+    Yields whether the lock was acquired, so only one process does the work.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+        acquired = cursor.fetchone()[0] == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+                cursor.fetchall()
+            cursor.close()
 
 
 def db_operation(func):
@@ -58,16 +297,57 @@ def db_operation(func):
     return wrapper
 
 
-def exec_sql(cursor, sql, params=None):
-    """Execute & Log SQL query and its parameters."""
+def _prepared_cursor(cursor, sql):
+    """
+    Returns (sql, cursor) for a server-side prepared statement on the cursor's
+    connection, prepared once per pooled connection. The cached sql object is
+    returned because MySQLCursorPrepared re-prepares unless it is passed the
+    very same string again.
+    """
+    # A cursor keeps a (weak) reference to its connection in _connection
+    conn = cursor._connection
+    statements = getattr(conn, '_myoauth_statements', None)
+    if statements is None:
+        statements = conn._myoauth_statements = {}
+    entry = statements.get(sql)
+    if entry is None:
+        entry = statements[sql] = (sql, conn.cursor(prepared=True, dictionary=True))
+    return entry
+
+
+def exec_sql(cursor, sql, params=None, prepared=False):
+    """
+    Execute & Log SQL query and its parameters. Returns the cursor holding the
+    result: with prepared=True that is the connection's cached prepared cursor.
+    """
+    if prepared:
+        sql, cursor = _prepared_cursor(cursor, sql)
+    if not LOGGER.isEnabledFor(logging.DEBUG):
+        with metrics_module.track("db"):
+            cursor.execute(sql, params or ())
+        return cursor
+
     start_time = time.time()
     if params:
-        LOGGER.debug(f"Executing SQL: {sql} with params: {params}")
+        LOGGER.debug("Executing SQL: %s with params: %s", sql, params)
     else:
-        LOGGER.debug(f"Executing SQL: {sql}")
-    result = cursor.execute(sql, params or ())
-    LOGGER.debug(f"Execution time: {time.time() - start_time}")
-    return result
+        LOGGER.debug("Executing SQL: %s", sql)
+    with metrics_module.track("db"):
+        cursor.execute(sql, params or ())
+    LOGGER.debug("Execution time: %s", time.time() - start_time)
+    return cursor
+
+
+def exec_many(cursor, sql, seq_params):
+    """
+    executemany with the same logging and timing as exec_sql. For INSERT
+    statements the connector sends one multi-row statement per call.
+    """
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("Executing SQL: %s for %s rows", sql, len(seq_params))
+    with metrics_module.track("db"):
+        cursor.executemany(sql, seq_params)
+    return cursor
 
 
 @db_operation
@@ -83,59 +363,180 @@ def create_user_table(cursor):
         token_expiry DATETIME,
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
-        UNIQUE KEY (email, auth_provider)
+        UNIQUE KEY (email, auth_provider),
+        INDEX idx_token_expiry (token_expiry)
     )
     """
     exec_sql(cursor, sql)
+
+    # Tables created before the refresh scheduler existed lack the expiry index
+    exec_sql(cursor, "SHOW INDEX FROM users WHERE Key_name = 'idx_token_expiry'")
+    if not cursor.fetchall():
+        exec_sql(cursor, "CREATE INDEX idx_token_expiry ON users (token_expiry)")
     LOGGER.info("Users table created or already exists.")
 
 
-@db_operation
-def get_or_create_user(cursor, email, auth_provider, access_token, refresh_token, expires_in):
+# Token columns are large TEXT values; only read them when the tokens are needed
+USER_TOKEN_COLUMNS = "id, email, auth_provider, access_token, refresh_token, token_expiry"
+# Profile columns do not change when tokens are refreshed, so cached profiles stay valid
+USER_PROFILE_COLUMNS = "id, email, auth_provider, created_at"
+
+_USER_CACHE = None
+
+def get_user_cache():
+    """user id -> profile row (no tokens); shared between workers with [CACHE] BACKEND = redis."""
+    global _USER_CACHE
+    if _USER_CACHE is None:
+        with _POOL_LOCK:
+            if _USER_CACHE is None:
+                config = get_config()
+                _USER_CACHE = create_cache(
+                    "users",
+                    maxsize=config.get_int("CACHE", "USER_CACHE_SIZE", 10000),
+                    ttl=config.get_float("CACHE", "USER_CACHE_TTL", 300),
+                )
+    return _USER_CACHE
+
+def invalidate_user(user_id):
+    get_user_cache().delete(user_id)
+
+
+# id = LAST_INSERT_ID(id) makes lastrowid the existing row's id when the key already exists.
+# Providers only return a refresh token on first consent, so a NULL keeps the stored one.
+# The inserted row is read through the row alias `new` (MySQL 8.0.19+).
+UPSERT_USER_SQL = """
+INSERT INTO users (email, auth_provider, access_token, refresh_token, token_expiry)
+VALUES (%s, %s, %s, %s, %s) AS new
+ON DUPLICATE KEY UPDATE
+    id = LAST_INSERT_ID(id),
+    access_token = new.access_token,
+    refresh_token = COALESCE(new.refresh_token, users.refresh_token),
+    token_expiry = new.token_expiry
+"""
+# The same upsert for MariaDB and MySQL before 8.0.19, which have no row alias.
+# MySQL 8.0.20+ deprecates VALUES(col) here and warns on every statement.
+UPSERT_USER_SQL_VALUES = """
+INSERT INTO users (email, auth_provider, access_token, refresh_token, token_expiry)
+VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    id = LAST_INSERT_ID(id),
+    access_token = VALUES(access_token),
+    refresh_token = COALESCE(VALUES(refresh_token), refresh_token),
+    token_expiry = VALUES(token_expiry)
+"""
+
+
+def upsert_user_sql(cursor):
+    """The users upsert in the form the cursor's server accepts."""
+    conn = cursor._connection
+    if "mariadb" in conn.get_server_info().lower() or conn.get_server_version() < (8, 0, 19):
+        return UPSERT_USER_SQL_VALUES
+    return UPSERT_USER_SQL
+
+# Rows per multi-row INSERT in upsert_users, bounding the statement size
+UPSERT_BATCH_SIZE = 500
+
+
+def get_or_create_user(email, auth_provider, access_token, refresh_token, expires_in):
     """
     Get a user by email and auth_provider, or create a new one.
-    Updates tokens on every call.
+    Updates tokens on every call, in a single upsert round trip that cannot
+    race with a concurrent login of the same user. The row is not read back:
+    its refresh_token is None when none was given and the stored one was kept.
     """
+    user = _upsert_user(email, auth_provider, access_token, refresh_token, expires_in)
+    # After the commit, so a concurrent read cannot cache the old row again
+    invalidate_user(user["id"])
+    return user
+
+@db_operation
+def _upsert_user(cursor, email, auth_provider, access_token, refresh_token, expires_in):
     from datetime import datetime, timedelta
 
     token_expiry = datetime.utcnow() + timedelta(seconds=int(expires_in))
+    cursor = exec_sql(cursor, upsert_user_sql(cursor),
+                      (email, auth_provider, access_token, refresh_token, token_expiry), prepared=True)
+    return {
+        "id": cursor.lastrowid,
+        "email": email,
+        "auth_provider": auth_provider,
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_expiry": token_expiry
+    }
 
-    # Check if user exists
-    sql_select = "SELECT * FROM users WHERE email = %s AND auth_provider = %s"
-    exec_sql(cursor, sql_select, (email, auth_provider))
-    user = cursor.fetchone()
-
-    if user:
-        # Update existing user's tokens
-        sql_update = """
-        UPDATE users SET access_token = %s, refresh_token = %s, token_expiry = %s
-        WHERE id = %s
-        """
-        exec_sql(cursor, sql_update, (access_token, refresh_token, token_expiry, user['id']))
-        user['access_token'] = access_token
-        user['refresh_token'] = refresh_token
-        user['token_expiry'] = token_expiry
-        return user
-    else:
-        # Create new user
-        sql_insert = """
-        INSERT INTO users (email, auth_provider, access_token, refresh_token, token_expiry)
-        VALUES (%s, %s, %s, %s, %s)
-        """
-        exec_sql(cursor, sql_insert, (email, auth_provider, access_token, refresh_token, token_expiry))
-        user_id = cursor.lastrowid
-        return {
-            "id": user_id,
-            "email": email,
-            "auth_provider": auth_provider,
-            "access_token": access_token,
-            "refresh_token": refresh_token,
-            "token_expiry": token_expiry
-        }
+def upsert_users(users):
+    """
+    Bulk get_or_create_user for importing or refreshing many users. `users` is
+    a list of {"email", "auth_provider", "access_token", "refresh_token",
+    "expires_in"}; they are written UPSERT_BATCH_SIZE rows per statement.
+    Returns the affected-row count (1 per insert, 2 per changed row).
+    """
+    affected = _upsert_users(users)
+    # Row ids are not known here, so the whole profile cache is dropped
+    get_user_cache().clear()
+    return affected
+
+@db_operation
+def _upsert_users(cursor, users):
+    from datetime import datetime, timedelta
+
+    now = datetime.utcnow()
+    rows = [(u["email"], u["auth_provider"], u.get("access_token"), u.get("refresh_token"),
+             now + timedelta(seconds=int(u.get("expires_in", 3600)))) for u in users]
+    affected = 0
+    for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+        exec_many(cursor, upsert_user_sql(cursor), rows[start:start + UPSERT_BATCH_SIZE])
+        affected += cursor.rowcount
+    return affected
 
 @db_operation
 def get_user_by_id(cursor, user_id):
-    """Get a user by their ID."""
-    sql = "SELECT * FROM users WHERE id = %s"
+    """Get a user and their tokens by ID (token_module caches the result)."""
+    sql = f"SELECT {USER_TOKEN_COLUMNS} FROM users WHERE id = %s"
+    exec_sql(cursor, sql, (user_id,))
+    return cursor.fetchone()
+
+def get_user_profile(user_id):
+    """A user's row without the token columns, read through the user cache."""
+    if user_id is None:
+        return None
+    cache = get_user_cache()
+    user = cache.get(user_id)
+    if user is None:
+        user = _load_user_profile(user_id)
+        if user is not None:
+            cache.set(user_id, user)
+    return user
+
+@db_operation
+def _load_user_profile(cursor, user_id):
+    sql = f"SELECT {USER_PROFILE_COLUMNS} FROM users WHERE id = %s"
     exec_sql(cursor, sql, (user_id,))
     return cursor.fetchone()
+
+@db_operation
+def update_user_tokens(cursor, user_id, access_token, refresh_token, token_expiry):
+    """Store refreshed tokens for a user."""
+    sql = """
+    UPDATE users SET access_token = %s, refresh_token = COALESCE(%s, refresh_token), token_expiry = %s
+    WHERE id = %s
+    """
+    exec_sql(cursor, sql, (access_token, refresh_token, token_expiry, user_id))
+
+@db_operation
+def clear_refresh_token(cursor, user_id):
+    """Forget a refresh token the provider has revoked."""
+    exec_sql(cursor, "UPDATE users SET refresh_token = NULL WHERE id = %s", (user_id,))
+
+@db_operation
+def get_expiring_users(cursor, before, limit):
+    """Users with a refresh token whose access token expires before `before`, soonest first."""
+    sql = """
+    SELECT id, auth_provider, token_expiry FROM users
+    WHERE token_expiry < %s AND refresh_token IS NOT NULL
+    ORDER BY token_expiry
+    LIMIT %s
+    """
+    exec_sql(cursor, sql, (before, limit))
+    return cursor.fetchall()
@@ -0,0 +1,420 @@
+"""
+End-to-end load test that runs offline. It starts local stand-ins for the
+providers and a throwaway database, points serve.py at them and drives
+complete login -> callback -> send email flows with virtual users, reporting
+throughput and latency percentiles per endpoint:
+
+  - Google: token endpoint (RS256 id_tokens), JWKS and the Gmail API
+    (through [GOOGLE] ROOT_URL)
+  - Microsoft: the authority (OpenID discovery, token endpoint, keys) and
+    Graph (through [GRAPH] BASE_URL)
+  - MySQL: mysqld (or MariaDB's mariadbd) from PATH or --mysqld, initialized
+    in a temporary data directory; --db-host uses an existing server instead
+
+Every answer from a stand-in is delayed by --latency ms. The authorization code
+a virtual user sends to the callback is its email address, so each virtual
+user has its own row in the users table.
+
+Usage:
+    python e2e_loadtest.py --users 32 --duration 20 --latency 50
+    python e2e_loadtest.py --providers microsoft --workers 2 --threads 8 --sends-per-login 5
+    python e2e_loadtest.py --db-host 127.0.0.1 --db-user root --db-name myoauth_loadtest
+
+The identity endpoints are served over HTTPS (MSAL only accepts https
+authorities) with a self-signed certificate the service trusts through
+REQUESTS_CA_BUNDLE. Run from the Service directory.
+"""
+import argparse
+import base64
+import datetime
+import getpass
+import ipaddress
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+
+from benchmark import StubProviderHandler, report, write_client_secrets
+from loadtest import free_port, wait_until_ready
+from tests.support import StubGraphHandler, start_stub_server
+
+CLIENT_ID = "benchmark-client"  # the client id write_client_secrets uses, also taken for Azure
+TENANT = "loadtest-tenant"
+GRAPH_SCOPES = "User.Read Mail.Send"
+DB_NAME = "myoauth_loadtest"
+FLOWS = {
+    "google": ("/api/auth/google/login", "/api/auth/google/callback", "/api/send_google_email"),
+    "microsoft": ("/api/auth/microsoft/login", "/api/auth/microsoft/callback", "/api/send_microsoft_email"),
+}
+
+
+# --- Provider stand-ins ---
+
+class StubIdentityHandler(StubProviderHandler):
+    """
+    Google's token endpoint and JWKS plus the Microsoft authority of one tenant:
+    OpenID discovery, token endpoint and keys. The authorization code is taken
+    as the user's email address.
+    """
+
+    calls = Counter()
+
+    def _count(self, name):
+        with self.counter_lock:
+            self.calls[name] += 1
+
+    def do_GET(self):
+        base = f"https://{self.headers['Host']}"
+        if self.path == f"/{TENANT}/v2.0/.well-known/openid-configuration":
+            self._count("microsoft discovery")
+            self._send(200, {
+                "issuer": f"{base}/{TENANT}/v2.0",
+                "authorization_endpoint": f"{base}/{TENANT}/oauth2/v2.0/authorize",
+                "token_endpoint": f"{base}/{TENANT}/oauth2/v2.0/token",
+                "jwks_uri": f"{base}/{TENANT}/discovery/v2.0/keys",
+            })
+        elif self.path in ("/certs", f"/{TENANT}/discovery/v2.0/keys"):
+            self._count("jwks")
+            self._send(200, self.jwks, {"Cache-Control": "public, max-age=3600"})
+        else:
+            self._send(404, {"error": "not_found"})
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode())
+        time.sleep(self.latency)
+        email = form.get("code", [""])[0]
+        tokens = {"access_token": f"access-{email}", "refresh_token": f"refresh-{email}",
+                  "token_type": "Bearer", "expires_in": 3600}
+        if self.path == "/token":
+            self._count("google token")
+            tokens["id_token"] = self.id_token(
+                iss="https://accounts.google.com", aud=CLIENT_ID, sub=email, email=email,
+                email_verified=True, name="Load Test User", picture="")
+        elif self.path == f"/{TENANT}/oauth2/v2.0/token":
+            self._count("microsoft token")
+            client_info = json.dumps({"uid": email, "utid": TENANT}).encode()
+            tokens.update({
+                "scope": GRAPH_SCOPES,
+                "client_info": base64.urlsafe_b64encode(client_info).decode().rstrip("="),
+                "id_token": self.id_token(
+                    iss=f"https://{self.headers['Host']}/{TENANT}/v2.0", aud=CLIENT_ID, tid=TENANT,
+                    sub=email, oid=email, email=email, xms_edov=True, preferred_username=email,
+                    name="Load Test User"),
+            })
+        else:
+            self._send(404, {"error": "not_found"})
+            return
+        self._send(200, tokens)
+
+
+class StubApiHandler(StubGraphHandler):
+    """StubGraphHandler (Graph under /v1.0) plus Gmail's messages.send, counting the emails sent."""
+
+    calls = Counter()
+
+    def do_POST(self):
+        if self.path.startswith("/gmail/v1/users/me/messages/send"):
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            time.sleep(self.latency)
+            if self._throttled():
+                return
+            with self.counter_lock:
+                self.calls["gmail send"] += 1
+            self._send(200, {"id": "message", "threadId": "thread", "labelIds": ["SENT"]})
+            return
+        if self.path.endswith("/me/sendMail"):
+            with self.counter_lock:
+                self.calls["graph sendMail"] += 1
+        super().do_POST()
+
+
+def write_self_signed_cert(directory):
+    """Writes a certificate and key for 127.0.0.1 / localhost, returns (certfile, keyfile)."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "myOAuth load test")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    certfile = os.path.join(directory, "stub-cert.pem")
+    keyfile = os.path.join(directory, "stub-key.pem")
+    with open(certfile, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+# --- Database ---
+
+def start_mysql(mysqld, directory):
+    """
+    Initializes a data directory under `directory` and starts mysqld (or
+    mariadbd) on a free port with a password-less root. Returns (process, port).
+    """
+    datadir = os.path.join(directory, "mysql")
+    user = f"--user={getpass.getuser()}"  # mysqld refuses to run as root unless asked to
+    if "mariadb" in os.path.basename(mysqld):
+        install_db = shutil.which("mariadb-install-db") or shutil.which("mysql_install_db")
+        init = [install_db, "--no-defaults", user, f"--datadir={datadir}", "--auth-root-authentication-method=normal"]
+    else:
+        init = [mysqld, "--no-defaults", user, "--initialize-insecure", f"--datadir={datadir}"]
+    subprocess.run(init, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    port = free_port()
+    process = subprocess.Popen(
+        [mysqld, "--no-defaults", user, f"--datadir={datadir}", f"--port={port}",
+         "--bind-address=127.0.0.1", f"--socket={os.path.join(directory, 'mysqld.sock')}",
+         "--skip-log-bin", "--max-connections=1000"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return process, port
+
+
+def create_database(host, port, user, password, name, timeout=60):
+    """Waits for the server to accept connections, then creates the database."""
+    import mysql.connector
+
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = mysql.connector.connect(host=host, port=port, user=user, password=password)
+            break
+        except mysql.connector.Error:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{name}`")
+    finally:
+        conn.close()
+
+
+# --- Virtual users ---
+
+def run_flow(session, base_url, provider, email, sends, timings):
+    """One login -> callback -> `sends` emails flow; appends (endpoint, seconds, ok) to timings."""
+    login, callback, send = FLOWS[provider]
+
+    def call(path, method="GET", **kwargs):
+        start = time.perf_counter()
+        try:
+            response = session.request(method, base_url + path, timeout=60, **kwargs)
+        except OSError:
+            timings.append((path, time.perf_counter() - start, False))
+            return None
+        timings.append((path, time.perf_counter() - start, response.status_code == 200))
+        return response
+
+    response = call(login)
+    if response is None or response.status_code != 200:
+        return False
+    query = parse_qs(urlsplit(response.json()["authorization_url"]).query)
+    params = {"code": email}
+    if provider == "google":
+        params["state"] = query["state"][0]  # checked against the one in the session
+    response = call(callback, params=params)
+    if response is None or email not in response.text:
+        return False
+
+    for _ in range(sends):
+        response = call(send, "POST", json={"recipient": "to@example.com", "subject": "load test",
+                                            "body": "Sent by e2e_loadtest.py"})
+        if response is None or response.status_code != 200 or response.json().get("status") != "success":
+            return False
+    return True
+
+
+def client_process(index, base_url, users, providers, sends, duration, results):
+    """Runs `users` virtual users for `duration` seconds, each cycling through `providers`."""
+    import requests
+
+    timings = []
+    flows = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def virtual_user(number):
+        local_timings, local_flows = [], []
+        email = f"user{index}-{number}@loadtest.example"
+        with requests.Session() as session:  # keeps the Flask session cookie and the connection
+            turn = number
+            while time.perf_counter() < deadline:
+                provider = providers[turn % len(providers)]
+                turn += 1
+                start = time.perf_counter()
+                ok = run_flow(session, base_url, provider, email, sends, local_timings)
+                local_flows.append((provider, time.perf_counter() - start, ok))
+        with lock:
+            timings.extend(local_timings)
+            flows.extend(local_flows)
+
+    threads = [threading.Thread(target=virtual_user, args=(n,)) for n in range(users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put((timings, flows))
+
+
+def drive(base_url, args):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    per_process = max(1, args.users // args.client_processes)
+    clients = [context.Process(target=client_process,
+                               args=(i, base_url, per_process, args.providers, args.sends_per_login,
+                                     args.duration, results))
+               for i in range(args.client_processes)]
+    start = time.perf_counter()
+    for c in clients:
+        c.start()
+    timings, flows = [], []
+    for _ in clients:
+        t, f = results.get()
+        timings.extend(t)
+        flows.extend(f)
+    for c in clients:
+        c.join()
+    elapsed = time.perf_counter() - start
+
+    for provider in args.providers:
+        for path in FLOWS[provider]:
+            samples = [seconds for name, seconds, ok in timings if name == path and ok]
+            report(path.rsplit("/api/", 1)[1], samples, elapsed)
+            errors = sum(1 for name, _, ok in timings if name == path and not ok)
+            if errors:
+                print(f"{'':<28} errors={errors}")
+        samples = [seconds for name, seconds, ok in flows if name == provider and ok]
+        report(f"{provider} flow", samples, elapsed)
+        failed = sum(1 for name, _, ok in flows if name == provider and not ok)
+        if failed:
+            print(f"{'':<28} failed flows={failed}")
+
+
+# --- Main ---
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--providers", nargs="+", choices=sorted(FLOWS), default=sorted(FLOWS))
+    parser.add_argument("--users", type=int, default=16, help="concurrent virtual users")
+    parser.add_argument("--client-processes", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--sends-per-login", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="provider stand-in latency in ms")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=8, help="threads per worker process")
+    parser.add_argument("--asgi", action="store_true", help="serve with uvicorn (asgi_module)")
+    parser.add_argument("--mysqld", default=shutil.which("mysqld") or shutil.which("mariadbd"),
+                        help="server binary for the throwaway database (default: from PATH)")
+    parser.add_argument("--db-host", help="use an existing MySQL server instead of starting one")
+    parser.add_argument("--db-port", type=int, default=3306)
+    parser.add_argument("--db-user", default="root")
+    parser.add_argument("--db-password", default="")
+    parser.add_argument("--db-name", default=DB_NAME)
+    args = parser.parse_args()
+    if not args.db_host and not args.mysqld:
+        parser.error("no mysqld or mariadbd on PATH; pass --mysqld or --db-host")
+
+    directory = tempfile.mkdtemp(prefix="myoauth-loadtest-")
+    processes = []
+    try:
+        certfile, keyfile = write_self_signed_cert(directory)
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(certfile, keyfile)
+        StubIdentityHandler.latency = StubApiHandler.latency = args.latency / 1000
+        StubIdentityHandler.generate_key()
+        _, identity_url = start_stub_server(StubIdentityHandler, ssl_context)
+        _, api_url = start_stub_server(StubApiHandler)
+
+        if args.db_host:
+            db_host, db_port = args.db_host, args.db_port
+        else:
+            mysqld, db_port = start_mysql(args.mysqld, directory)
+            processes.append(mysqld)
+            db_host = "127.0.0.1"
+        create_database(db_host, db_port, args.db_user, args.db_password, args.db_name)
+
+        port = free_port()
+        write_client_secrets(token_uri=f"{identity_url}/token")
+        env = dict(os.environ)
+        env.update({
+            # Per-request DEBUG logging would dominate the measurement
+            "MYOAUTH__LOG__LEVEL": env.get("MYOAUTH__LOG__LEVEL", "INFO"),
+            "MYOAUTH__REFRESH__ENABLED": "false",
+            "MYOAUTH__DATABASE__DB_HOST": db_host,
+            "MYOAUTH__DATABASE__DB_PORT": str(db_port),
+            "MYOAUTH__DATABASE__DB_USER": args.db_user,
+            "MYOAUTH__DATABASE__DB_PASSWORD": args.db_password,
+            "MYOAUTH__DATABASE__DB_NAME": args.db_name,
+            "MYOAUTH__GOOGLE__REDIRECT_URI": f"http://127.0.0.1:{port}/api/auth/google/callback",
+            "MYOAUTH__GOOGLE__ROOT_URL": api_url,
+            "MYOAUTH__AZURE__TENANT_ID": TENANT,
+            "MYOAUTH__AZURE__CLIENT_ID": CLIENT_ID,
+            "MYOAUTH__AZURE__CLIENT_SECRET": "benchmark-secret",
+            "MYOAUTH__MSAL__AUTHORITY": f"{identity_url}/{TENANT}",
+            "MYOAUTH__MSAL__VALIDATE_AUTHORITY": "false",
+            "MYOAUTH__MSAL__REDIRECT_URI": f"http://127.0.0.1:{port}/api/auth/microsoft/callback",
+            "MYOAUTH__MSAL__SCOPES": GRAPH_SCOPES,
+            "MYOAUTH__GRAPH__BASE_URL": f"{api_url}/v1.0",
+            "MYOAUTH__ID_TOKEN__GOOGLE_JWKS_URI": f"{identity_url}/certs",
+            "MYOAUTH__WEB__FRONTEND_URL": "http://127.0.0.1",
+            "REQUESTS_CA_BUNDLE": certfile,
+            # The callbacks are served over plain HTTP here
+            "OAUTHLIB_INSECURE_TRANSPORT": "1",
+            "OAUTHLIB_RELAX_TOKEN_SCOPE": "1",
+        })
+        command = [sys.executable, "serve.py", "--bind", f"127.0.0.1:{port}",
+                   "--workers", str(args.workers), "--threads", str(args.threads)]
+        if args.asgi:
+            command.append("--asgi")
+        server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(server)
+        if not wait_until_ready(port):
+            print("server did not start")
+            return
+
+        print(f"{' + '.join(args.providers)} flows, {args.users} virtual users, {args.duration:g}s, "
+              f"provider latency {args.latency:g}ms, workers={args.workers} threads={args.threads}")
+        drive(f"http://127.0.0.1:{port}", args)
+        calls = StubIdentityHandler.calls + StubApiHandler.calls
+        print("  provider calls: " + ", ".join(f"{name}={count}" for name, count in sorted(calls.items())))
+    finally:
+        # SIGTERM exercises the graceful shutdown path
+        for process in reversed(processes):
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
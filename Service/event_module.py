@@ -0,0 +1,218 @@
+import codecs
+import json
+import re
+from datetime import date, datetime, timedelta
+
+# Bytes read from an uploaded JSON file at a time
+JSON_BLOCK = 64 * 1024
+
+# Between the items of a JSON array, or of JSON Lines
+_JSON_SEPARATORS = re.compile(r"[\s,\[]*")
+_ICS_ESCAPES = re.compile(r"\\([\\;,nN])")
+# Name and parameters up to the first colon outside a quoted parameter value, then the value
+_ICS_PROPERTY = re.compile(r'((?:[^:"]|"[^"]*")*):?(.*)')
+
+
+def from_json(data):
+    """
+    A provider-neutral event from {"title", "start_time", "end_time", "time_zone"?,
+    "description"?, "location"?}. start_time / end_time are ISO 8601 local
+    times in time_zone (default UTC), or dates (YYYY-MM-DD) for all-day
+    events; both must be of the same kind, end not before start. Raises
+    ValueError when a field is missing or invalid.
+    """
+    if not isinstance(data, dict) or not all(data.get(k) for k in ("title", "start_time", "end_time")):
+        raise ValueError("title, start_time and end_time are required")
+    for key in ("title", "time_zone", "description", "location"):
+        if not isinstance(data.get(key) or "", str):
+            raise ValueError(f"{key} must be a string")
+    time_zone = data.get("time_zone") or "UTC"
+    start = _json_time("start_time", data["start_time"], time_zone)
+    end = _json_time("end_time", data["end_time"], time_zone)
+    _check_range(start, end)
+    return {
+        "title": data["title"],
+        "start": start,
+        "end": end,
+        "description": data.get("description") or "",
+        "location": data.get("location") or "",
+    }
+
+
+def _json_time(key, value, time_zone):
+    if not isinstance(value, str):
+        raise ValueError(f"{key} must be a string")
+    try:
+        if len(value) == 10:
+            return {"date": date.fromisoformat(value).isoformat()}
+        local = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{key} {value!r} is not an ISO 8601 date or time") from None
+    return {"dateTime": local.isoformat(), "timeZone": time_zone}
+
+
+def _check_range(start, end):
+    """
+    Raises ValueError unless start and end are both dates or both times and end
+    does not come before start (an all-day event ends on a later, exclusive date),
+    so events providers would reject are reported before a batch is sent.
+    """
+    if ("date" in start) != ("date" in end):
+        raise ValueError("start and end must both be dates or both be times")
+    if "date" in start:
+        if end["date"] <= start["date"]:
+            raise ValueError("end date must be after the start date")
+        return
+    first, last = datetime.fromisoformat(start["dateTime"]), datetime.fromisoformat(end["dateTime"])
+    # Local times in different zones (iCalendar TZIDs) cannot be compared without the zone rules
+    if (first.tzinfo is None) != (last.tzinfo is None):
+        return
+    if first.tzinfo is None and start["timeZone"] != end["timeZone"]:
+        return
+    if last < first:
+        raise ValueError("end is before start")
+
+
+def parse_json(stream, block_size=JSON_BLOCK):
+    """
+    Yields the events of a JSON array ([{...}, ...]) or of JSON Lines, decoding
+    one object at a time from `block_size` reads, so the file is never held in
+    memory. An invalid event is yielded as a ValueError; invalid JSON raises it.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer, pos, eof = "", 0, False
+    while True:
+        pos = _JSON_SEPARATORS.match(buffer, pos).end()
+        if buffer.startswith("]", pos):
+            return
+        try:
+            item, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            # An object cut off at the end of the buffer: read on
+            if eof:
+                if pos == len(buffer):
+                    return
+                raise ValueError(f"Invalid JSON: {e.msg}")
+        else:
+            try:
+                yield from_json(item)
+            except ValueError as e:
+                yield e
+            continue
+        block = stream.read(block_size)
+        eof = not block
+        buffer = buffer[pos:] + text.decode(block, final=eof)
+        pos = 0
+
+
+def _ics_lines(stream):
+    """Unfolded content lines of an iCalendar stream (continuation lines start with a space or tab)."""
+    line = None
+    for raw in stream:
+        raw = raw.decode("utf-8-sig" if line is None else "utf-8", errors="replace").rstrip("\r\n")
+        if raw[:1] in (" ", "\t") and line is not None:
+            line += raw[1:]
+            continue
+        if line:
+            yield line
+        line = raw
+    if line:
+        yield line
+
+
+def _ics_property(line):
+    """'DTSTART;TZID=Europe/Paris:20240101T090000' -> ('DTSTART', {'TZID': 'Europe/Paris'}, '20240101T090000')"""
+    head, value = _ICS_PROPERTY.match(line).groups()
+    name, *params = head.split(";")
+    return name.upper(), {key.upper(): v for key, _, v in (p.partition("=") for p in params)}, value
+
+
+def _ics_time(params, value):
+    """DATE (YYYYMMDD) or DATE-TIME (YYYYMMDDTHHMMSS[Z]) value; raises ValueError when it is neither."""
+    try:
+        if params.get("VALUE") == "DATE" or len(value) == 8:
+            return {"date": datetime.strptime(value, "%Y%m%d").date().isoformat()}
+        local = datetime.strptime(value.removesuffix("Z"), "%Y%m%dT%H%M%S")
+    except ValueError:
+        raise ValueError(f"invalid date or time {value!r}") from None
+    # UTC ("Z"), or local time in TZID; floating times are taken as UTC
+    time_zone = "UTC" if value.endswith("Z") else params.get("TZID", "UTC").strip('"')
+    return {"dateTime": local.isoformat(), "timeZone": time_zone}
+
+
+def _ics_text(value):
+    return _ICS_ESCAPES.sub(lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+
+
+def parse_ics(stream):
+    """
+    Yields the VEVENTs of an iCalendar (.ics) stream as provider-neutral events,
+    reading it a line at a time. Components nested in an event (alarms) are
+    skipped; an event without DTSTART, or with invalid dates (see from_json),
+    is yielded as a ValueError. Without DTEND a timed event ends when it starts and an
+    all-day event lasts one day.
+    """
+    event, depth = None, 0
+    for line in _ics_lines(stream):
+        name, params, value = _ics_property(line)
+        if name == "BEGIN":
+            if event is not None:
+                depth += 1
+            elif value.upper() == "VEVENT":
+                event, depth = {}, 0
+        elif name == "END" and event is not None:
+            if depth:
+                depth -= 1
+                continue
+            yield _ics_event(event)
+            event = None
+        elif event is not None and not depth and name not in event:
+            event[name] = (params, value)
+
+
+def _ics_event(properties):
+    title = _ics_text(properties.get("SUMMARY", ({}, ""))[1]) or "(no title)"
+    if "DTSTART" not in properties:
+        return ValueError(f"Event {title!r} has no DTSTART")
+    try:
+        start = _ics_time(*properties["DTSTART"])
+        if "DTEND" in properties:
+            end = _ics_time(*properties["DTEND"])
+        elif "date" in start:
+            end = {"date": (date.fromisoformat(start["date"]) + timedelta(days=1)).isoformat()}
+        else:
+            end = dict(start)
+        _check_range(start, end)
+    except ValueError as e:
+        return ValueError(f"Event {title!r}: {e}")
+    return {
+        "title": title,
+        "start": start,
+        "end": end,
+        "description": _ics_text(properties.get("DESCRIPTION", ({}, ""))[1]),
+        "location": _ics_text(properties.get("LOCATION", ({}, ""))[1]),
+    }
+
+
+def is_ics(filename, mimetype):
+    return mimetype == "text/calendar" or (filename or "").lower().endswith((".ics", ".ical"))
+
+
+def parse(stream, filename="", mimetype=""):
+    """Events of an uploaded file: iCalendar by extension or Content-Type, JSON otherwise."""
+    if is_ics(filename, mimetype):
+        return parse_ics(stream)
+    return parse_json(stream)
+
+
+def chunks(events, size):
+    """Lists of up to `size` items of an iterable, so only one chunk is in memory at a time."""
+    chunk = []
+    for event in events:
+        chunk.append(event)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,240 @@
+import contextvars
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import google_auth_httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaUpload, build_http
+
+import metrics_module
+import ratelimit_module
+from config_module import get_config
+from log_module import setup_logger
+
+LOGGER = setup_logger("google", "logs/service")
+
+# Resource trees are built once per process from the discovery documents bundled
+# with google-api-python-client (no network fetch). They are bound to an
+# unauthenticated placeholder http; every request is executed with a per-user
+# AuthorizedHttp instead, so building a service per call is no longer needed.
+_LOCK = threading.Lock()
+_DOCUMENTS = {}   # (api, version) -> parsed discovery document
+_RESOURCES = {}   # (api, version, path) -> Resource
+_local = threading.local()
+_EXECUTOR = None
+_CLIENT_CONFIG = None  # (config version, parsed client secrets)
+client_config_loads = 0
+
+# Gmail allows up to 100 calls per batch but throttles large batches; 50 is Google's advice
+BATCH_SIZE = 50
+# 403 reasons Google uses for throttling (besides 429)
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+def get_client_config():
+    """Reads and caches the OAuth client secrets file named in [GOOGLE] client_secret_file."""
+    global _CLIENT_CONFIG, client_config_loads
+    config = get_config()
+    cached = _CLIENT_CONFIG
+    if cached and cached[0] == config.version:
+        return cached[1]
+
+    with _LOCK:
+        cached = _CLIENT_CONFIG
+        if cached and cached[0] == config.version:
+            return cached[1]
+        with open(config.get('GOOGLE', 'client_secret_file'), encoding='utf-8') as f:
+            client_config = json.load(f)
+        _CLIENT_CONFIG = (config.version, client_config)
+        client_config_loads += 1
+        return client_config
+
+
+def get_discovery_document(api, version):
+    """
+    Returns the parsed static discovery document for an API. [GOOGLE] ROOT_URL
+    replaces its rootUrl, which API, media upload and batch requests are sent
+    to (e.g. a local stand-in for load tests).
+    """
+    key = (api, version)
+    document = _DOCUMENTS.get(key)
+    if document is None:
+        content = get_static_doc(api, version)
+        if content is None:
+            raise ValueError(f"No bundled discovery document for {api} {version}")
+        document = json.loads(content)
+        root_url = get_config().get('GOOGLE', 'ROOT_URL')
+        if root_url:
+            document['rootUrl'] = root_url.rstrip('/') + '/'
+            document['baseUrl'] = document['rootUrl'] + document.get('servicePath', '')
+        _DOCUMENTS[key] = document
+    return document
+
+
+def get_resource(api, version, path=""):
+    """
+    Returns a cached resource collection, e.g.
+    get_resource('gmail', 'v1', 'users.messages') for service.users().messages().
+    """
+    key = (api, version, path)
+    resource = _RESOURCES.get(key)
+    if resource is not None:
+        return resource
+
+    with _LOCK:
+        resource = _RESOURCES.get(key)
+        if resource is None:
+            resource = build_from_document(get_discovery_document(api, version), http=build_http())
+            for name in filter(None, path.split(".")):
+                resource = getattr(resource, name)()
+            _RESOURCES[key] = resource
+            LOGGER.info(f"Built Google API resource {api} {version} {path}")
+    return resource
+
+
+def get_http():
+    """Returns this thread's httplib2 connection (httplib2.Http is not thread-safe)."""
+    http = getattr(_local, "http", None)
+    if http is None:
+        http = _local.http = build_http()
+    return http
+
+
+def authorized_http(credentials):
+    """Binds user credentials to this thread's connection."""
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=get_http())
+
+
+def throttle_status(error):
+    """HTTP status of a failed call, with Gmail's 403 rate limit errors reported as 429."""
+    status = error.resp.status
+    details = error.error_details if isinstance(error.error_details, list) else []
+    if status == 403 and any(isinstance(d, dict) and d.get("reason") in RATE_LIMIT_REASONS for d in details):
+        return 429
+    return status
+
+
+def execute(request, credentials, **kwargs):
+    """
+    Executes an HttpRequest (or BatchHttpRequest) on behalf of the given user,
+    through the rate limiter of the user bound by ratelimit_module.bind_user.
+    """
+    ratelimit_module.acquire(ratelimit_module.GOOGLE)
+    with metrics_module.track("google"):
+        try:
+            response = request.execute(http=authorized_http(credentials), **kwargs)
+        except HttpError as error:
+            ratelimit_module.report(ratelimit_module.GOOGLE, throttle_status(error), error.resp)
+            raise
+    ratelimit_module.report(ratelimit_module.GOOGLE, 200)
+    return response
+
+
+class StreamUpload(MediaUpload):
+    """
+    Resumable media upload read from an iterable of byte strings whose total
+    size is not known up front (e.g. a MIME message generated on the fly).
+    Only the chunk being sent, the previous one (resent if the server did not
+    keep all of it) and the read-ahead that tells whether the next chunk is
+    the last are held in memory. `chunksize` must be a multiple of 256 KiB.
+    """
+
+    def __init__(self, chunks, mimetype, chunksize):
+        super().__init__()
+        self._chunks = iter(chunks)
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._buffer = bytearray()
+        self._offset = 0   # stream position of _buffer[0]
+        self._next = 0     # where the next chunk starts
+        self._size = None  # known once the iterable is exhausted
+
+    def _fill(self, end):
+        while self._size is None and self._offset + len(self._buffer) < end:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                self._size = self._offset + len(self._buffer)
+
+    def chunksize(self):
+        return self._chunksize
+
+    def mimetype(self):
+        return self._mimetype
+
+    def size(self):
+        # Asked before every chunk; reading one byte past the next chunk means the
+        # last chunk carries the total size even when it is exactly `chunksize` long
+        self._fill(self._next + self._chunksize + 1)
+        return self._size
+
+    def resumable(self):
+        return True
+
+    def getbytes(self, begin, length):
+        if begin < self._offset:
+            raise ValueError(f"Cannot rewind the upload stream to byte {begin}")
+        del self._buffer[:begin - self._offset]
+        self._offset = begin
+        self._fill(begin + length)
+        data = bytes(self._buffer[:length])
+        self._next = begin + len(data)
+        return data
+
+    def has_stream(self):
+        return False
+
+
+def get_executor():
+    """Shared worker pool that bounds how many batch requests run concurrently."""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _LOCK:
+            if _EXECUTOR is None:
+                workers = get_config().get_int("GOOGLE", "BATCH_CONCURRENCY", 4)
+                _EXECUTOR = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="google-batch")
+    return _EXECUTOR
+
+
+def reset_clients():
+    """Drops per-process HTTP state in a forked worker; parsed documents and resources are kept."""
+    global _local, _EXECUTOR
+    _local = threading.local()
+    _EXECUTOR = None  # its threads did not survive fork()
+
+
+def execute_batch(api, version, requests_, credentials, batch_size=BATCH_SIZE):
+    """
+    Executes many HttpRequests through the API's batch endpoint, `batch_size`
+    per HTTP call, with at most [GOOGLE] BATCH_CONCURRENCY batches in flight.
+    Returns one (response, exception) tuple per request, in order.
+    """
+    root = get_resource(api, version)
+    results = [None] * len(requests_)
+
+    def run(start):
+        def callback(request_id, response, exception):
+            results[start + int(request_id)] = (response, exception)
+            if isinstance(exception, HttpError):
+                ratelimit_module.report(ratelimit_module.GOOGLE, throttle_status(exception), exception.resp)
+
+        batch = root.new_batch_http_request(callback=callback)
+        for offset, request in enumerate(requests_[start:start + batch_size]):
+            batch.add(request, request_id=str(offset))
+        try:
+            execute(batch, credentials)
+        except Exception as error:
+            LOGGER.error(f"Google batch request failed: {error}")
+            for offset in range(min(batch_size, len(requests_) - start)):
+                if results[start + offset] is None:
+                    results[start + offset] = (None, error)
+
+    # Each batch runs in a copy of the caller's context so its time is charged to the request
+    futures = [get_executor().submit(contextvars.copy_context().run, run, start)
+               for start in range(0, len(requests_), batch_size)]
+    for future in futures:
+        future.result()
+    return results
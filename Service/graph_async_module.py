@@ -0,0 +1,113 @@
+import asyncio
+import json
+
+import aiohttp
+
+import graph_module
+import metrics_module
+import ratelimit_module
+from config_module import get_config
+from log_module import setup_logger
+
+LOGGER = setup_logger("graph", "logs/service")
+
+# What a failed call can raise (connection errors and timeouts)
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class AsyncResponse:
+    """Buffered Graph response with the parts of requests.Response the callers use."""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncGraphClient:
+    """
+    asyncio counterpart of graph_module.GraphClient. One aiohttp session (and
+    its connection pool) is shared by every request on the event loop, so a
+    worker can hold hundreds of Graph calls in flight without a thread each.
+    429/503 are retried with exponential backoff, honouring Retry-After.
+    """
+
+    def __init__(self, base_url=graph_module.GRAPH_URL, pool_maxsize=100,
+                 connect_timeout=3.05, read_timeout=30, max_retries=3,
+                 backoff_factor=0.5, max_retry_after=30):
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = max_retry_after
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_maxsize),
+            timeout=aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout),
+        )
+
+    def url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    async def request(self, method, path, access_token=None, **kwargs):
+        """Sends a request to Graph and returns the buffered AsyncResponse."""
+        headers = kwargs.pop("headers", None) or {}
+        if access_token:
+            headers["Authorization"] = "Bearer " + access_token
+        attempt = 0
+        with metrics_module.track("graph"):
+            while True:
+                await ratelimit_module.acquire_async(ratelimit_module.MICROSOFT)
+                async with self.session.request(method, self.url(path), headers=headers, **kwargs) as response:
+                    content = await response.read()
+                    result = AsyncResponse(response.status, response.headers, content)
+                ratelimit_module.report(ratelimit_module.MICROSOFT, result.status_code, result.headers)
+                if result.status_code not in (429, 503) or attempt >= self.max_retries:
+                    return result
+                attempt += 1
+                delay = graph_module._retry_after(result.headers) or self.backoff_factor * (2 ** (attempt - 1))
+                await asyncio.sleep(min(delay, self.max_retry_after))
+
+    async def get(self, path, access_token=None, **kwargs):
+        return await self.request("GET", path, access_token, **kwargs)
+
+    async def post(self, path, access_token=None, **kwargs):
+        return await self.request("POST", path, access_token, **kwargs)
+
+    async def close(self):
+        await self.session.close()
+
+
+_CLIENTS = {}  # event loop -> AsyncGraphClient (aiohttp sessions are bound to their loop)
+
+
+def get_async_graph_client():
+    """Returns the AsyncGraphClient of the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _CLIENTS.get(loop)
+    if client is None:
+        config = get_config()
+        client = _CLIENTS[loop] = AsyncGraphClient(
+            base_url=config.get("GRAPH", "BASE_URL") or graph_module.GRAPH_URL,
+            pool_maxsize=config.get_int("GRAPH", "ASYNC_POOL_MAXSIZE", 100),
+            connect_timeout=config.get_float("GRAPH", "CONNECT_TIMEOUT", 3.05),
+            read_timeout=config.get_float("GRAPH", "READ_TIMEOUT", 30),
+            max_retries=config.get_int("GRAPH", "MAX_RETRIES", 3),
+            backoff_factor=config.get_float("GRAPH", "BACKOFF_FACTOR", 0.5),
+            max_retry_after=config.get_float("GRAPH", "MAX_RETRY_AFTER", 30),
+        )
+    return client
+
+
+async def close_async_graph_client():
+    """Closes the running loop's client, e.g. on ASGI lifespan shutdown."""
+    client = _CLIENTS.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
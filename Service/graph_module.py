@@ -0,0 +1,265 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics_module
+import ratelimit_module
+from config_module import get_config
+from log_module import setup_logger
+
+LOGGER = setup_logger("graph", "logs/service")
+
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+# Graph accepts at most 20 sub-requests per JSON $batch call
+BATCH_LIMIT = 20
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+# Outlook attachments of at least 3 MB must go through an upload session; smaller ones are posted inline
+UPLOAD_SESSION_MIN_BYTES = 3 * 1024 * 1024
+
+
+class GraphRetry(Retry):
+    """urllib3 Retry that caps how long a Retry-After header may make us sleep."""
+
+    max_retry_after = 30
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.max_retry_after = self.max_retry_after
+        return retry
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.max_retry_after)
+
+
+class GraphClient:
+    """
+    Microsoft Graph client sharing one pooled requests.Session, so calls reuse
+    keep-alive connections to graph.microsoft.com instead of a fresh TCP+TLS
+    handshake each time. 429/503 responses are retried with exponential backoff,
+    honouring Retry-After.
+    """
+
+    def __init__(self, base_url=GRAPH_URL, pool_connections=4, pool_maxsize=20,
+                 connect_timeout=3.05, read_timeout=30, max_retries=3,
+                 backoff_factor=0.5, max_retry_after=30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_retry_after = max_retry_after
+
+        retry = GraphRetry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,                    # never replay a request the server may have processed
+            status=max_retries,
+            status_forcelist=(429, 503),
+            allowed_methods=None,      # 429/503 mean "not processed", so POST is safe to retry
+            backoff_factor=backoff_factor,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        retry.max_retry_after = max_retry_after
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              max_retries=retry, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def request(self, method, path, access_token=None, **kwargs):
+        """Sends a request to Graph; `path` is relative to the base url (e.g. 'me/sendMail')."""
+        headers = kwargs.pop("headers", None) or {}
+        if access_token:
+            headers["Authorization"] = "Bearer " + access_token
+        kwargs.setdefault("timeout", self.timeout)
+        ratelimit_module.acquire(ratelimit_module.MICROSOFT)
+        with metrics_module.track("graph"):
+            response = self.session.request(method, self.url(path), headers=headers, **kwargs)
+        # 429/503 answers retried by urllib3 still slow the key down
+        retries = getattr(response.raw, "retries", None)
+        for attempt in (retries.history if retries else ()):
+            if attempt.status in ratelimit_module.THROTTLED_STATUS:
+                ratelimit_module.report(ratelimit_module.MICROSOFT, attempt.status)
+        ratelimit_module.report(ratelimit_module.MICROSOFT, response.status_code, response.headers)
+        return response
+
+    def get(self, path, access_token=None, **kwargs):
+        return self.request("GET", path, access_token, **kwargs)
+
+    def post(self, path, access_token=None, **kwargs):
+        return self.request("POST", path, access_token, **kwargs)
+
+    def delete(self, path, access_token=None, **kwargs):
+        return self.request("DELETE", path, access_token, **kwargs)
+
+    def upload(self, upload_url, stream, size, chunk_size):
+        """
+        Uploads `size` bytes read from `stream` to an upload session, one
+        `chunk_size` byte range per PUT, so at most one chunk is in memory.
+        The upload url is pre-authenticated and must not get the bearer token.
+        Returns the response to the last range sent (201 once complete).
+        """
+        offset = 0
+        while True:
+            chunk = stream.read(min(chunk_size, size - offset))
+            if not chunk:
+                raise ValueError(f"Attachment stream ended at byte {offset} of {size}")
+            end = offset + len(chunk) - 1
+            response = self.request("PUT", upload_url, data=chunk, headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Range": f"bytes {offset}-{end}/{size}",
+            })
+            offset = end + 1
+            if response.status_code not in (200, 201) or offset >= size:
+                return response
+
+    def batch(self, requests_, access_token):
+        """
+        Sends sub-requests ({"method", "url", "body", "headers"}) through JSON $batch,
+        BATCH_LIMIT per call. Items answered with 429/5xx are resent in a later
+        round after their Retry-After (or exponential backoff).
+        Returns one {"id", "status", "headers", "body"} dict per input, in order.
+        """
+        results = [None] * len(requests_)
+        pending = list(range(len(requests_)))
+        attempt = 0
+        while pending:
+            attempt += 1
+            retry, delay = [], 0.0
+            for start in range(0, len(pending), BATCH_LIMIT):
+                chunk = pending[start:start + BATCH_LIMIT]
+                payload = {"requests": [dict(requests_[i], id=str(i)) for i in chunk]}
+                try:
+                    response = self.post("$batch", access_token, json=payload)
+                except (requests.RequestException, ratelimit_module.RateLimitExceeded) as error:
+                    LOGGER.error(f"Graph $batch failed: {error}")
+                    for i in chunk:
+                        results[i] = _batch_error(i, 0, str(error))
+                    continue
+
+                if response.status_code != 200:
+                    message = error_message(response)
+                    LOGGER.error(f"Graph $batch failed: HTTP {response.status_code} {message}")
+                    for i in chunk:
+                        results[i] = _batch_error(i, response.status_code, message)
+                    if response.status_code in RETRYABLE_STATUS:
+                        retry.extend(chunk)
+                    continue
+
+                for item in response.json().get("responses", []):
+                    i = int(item["id"])
+                    results[i] = item
+                    if item.get("status") in RETRYABLE_STATUS:
+                        ratelimit_module.report(ratelimit_module.MICROSOFT, item["status"], item.get("headers"))
+                        retry.append(i)
+                        delay = max(delay, _retry_after(item.get("headers") or {}))
+
+            if not retry or attempt > self.max_retries:
+                break
+            delay = delay or self.backoff_factor * (2 ** (attempt - 1))
+            delay = min(delay, self.max_retry_after)
+            LOGGER.warning(f"Graph $batch: retrying {len(retry)} throttled items in {delay:.2f}s")
+            time.sleep(delay)
+            pending = sorted(retry)
+
+        for i, item in enumerate(results):
+            if item is None:
+                results[i] = _batch_error(i, 0, "No response in $batch")
+        return results
+
+    def close(self):
+        self.session.close()
+
+
+def _retry_after(headers):
+    for name, value in headers.items():
+        if name.lower() == "retry-after":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 0.0
+
+
+def _batch_error(i, status, message):
+    return {"id": str(i), "status": status, "headers": {}, "body": {"error": {"message": message}}}
+
+
+def error_message(response):
+    """Extracts the Graph error message from a failed response or $batch item."""
+    if isinstance(response, dict):
+        body = response.get("body")
+        if isinstance(body, dict):
+            return body.get("error", {}).get("message", "Unknown error")
+        return f"HTTP {response.get('status')}"
+    try:
+        return response.json().get("error", {}).get("message", "Unknown error")
+    except ValueError:
+        return f"HTTP {response.status_code}"
+
+
+_CLIENT = None  # (config version, GraphClient)
+_EXECUTOR = None
+_LOCK = threading.Lock()
+
+def get_graph_client():
+    """Returns the process-wide GraphClient, rebuilt when the config snapshot changes."""
+    global _CLIENT
+    config = get_config()
+    cached = _CLIENT
+    if cached and cached[0] == config.version:
+        return cached[1]
+
+    with _LOCK:
+        cached = _CLIENT
+        if cached and cached[0] == config.version:
+            return cached[1]
+        client = GraphClient(
+            base_url=config.get("GRAPH", "BASE_URL") or GRAPH_URL,
+            pool_connections=config.get_int("GRAPH", "POOL_CONNECTIONS", 4),
+            pool_maxsize=config.get_int("GRAPH", "POOL_MAXSIZE", 20),
+            connect_timeout=config.get_float("GRAPH", "CONNECT_TIMEOUT", 3.05),
+            read_timeout=config.get_float("GRAPH", "READ_TIMEOUT", 30),
+            max_retries=config.get_int("GRAPH", "MAX_RETRIES", 3),
+            backoff_factor=config.get_float("GRAPH", "BACKOFF_FACTOR", 0.5),
+            max_retry_after=config.get_float("GRAPH", "MAX_RETRY_AFTER", 30),
+        )
+        # A replaced client is left to the GC; other threads may still be using it
+        _CLIENT = (config.version, client)
+        return client
+
+def get_executor():
+    """Shared worker pool for Graph calls issued concurrently within one request."""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        with _LOCK:
+            if _EXECUTOR is None:
+                workers = get_config().get_int("GRAPH", "CONCURRENCY", 8)
+                _EXECUTOR = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="graph")
+    return _EXECUTOR
+
+def submit(func, *args, **kwargs):
+    """Runs func on the shared pool in a copy of the caller's context, so its time is charged to the request."""
+    return get_executor().submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+def reset_graph_client():
+    """Drops the shared session (and worker pool), e.g. in a freshly forked worker."""
+    global _CLIENT, _EXECUTOR
+    with _LOCK:
+        cached, _CLIENT = _CLIENT, None
+        _EXECUTOR = None  # its threads did not survive fork()
+    if cached:
+        cached[1].close()
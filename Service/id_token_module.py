@@ -0,0 +1,156 @@
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+import metrics_module
+from config_module import get_config
+from lazy_module import lazy_import
+from log_module import setup_logger
+
+LOGGER = setup_logger("auth", "logs/service")
+
+# PyJWT pulls in cryptography; only needed once someone logs in
+jwt = lazy_import("jwt")
+
+GOOGLE = "google"
+MICROSOFT = "microsoft"
+
+GOOGLE_JWKS_URI = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ["https://accounts.google.com", "accounts.google.com"]
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class JwksCache:
+    """
+    Signing keys of one provider, fetched from its JWKS endpoint and kept for
+    the response's Cache-Control max-age (at most `ttl` seconds). A token
+    signed with an unknown key id triggers one refetch, so rotated keys are
+    picked up without waiting for the TTL; refetches are at most one per
+    `min_refresh_interval` seconds. When a refetch fails the old keys stay in use.
+    """
+
+    def __init__(self, uri, ttl=3600, min_refresh_interval=60, timeout=5, component="google"):
+        self.uri = uri
+        self.component = component  # metrics_module component the fetches are charged to
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetches = 0
+        self._keys = {}          # kid -> PyJWK
+        self._expires_at = 0.0
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+
+    def _fetch(self):
+        with metrics_module.track(self.component):
+            response = self._session.get(self.uri, timeout=self.timeout)
+        response.raise_for_status()
+        key_set = jwt.PyJWKSet.from_dict(response.json())
+        max_age = _MAX_AGE.search(response.headers.get("Cache-Control", ""))
+        ttl = min(int(max_age.group(1)), self.ttl) if max_age else self.ttl
+        self._keys = {key.key_id: key for key in key_set.keys}
+        self._fetched_at = time.monotonic()
+        self._expires_at = self._fetched_at + ttl
+        self.fetches += 1
+        LOGGER.info(f"Fetched {len(self._keys)} signing keys from {self.uri}")
+
+    def _refresh(self, unknown_kid=None):
+        with self._lock:
+            now = time.monotonic()
+            if unknown_kid is None:
+                if now < self._expires_at:
+                    return  # another thread refreshed while we waited
+            elif unknown_kid in self._keys or (
+                    self._fetched_at is not None and now - self._fetched_at < self.min_refresh_interval):
+                return
+            try:
+                self._fetch()
+            except (requests.RequestException, ValueError, jwt.PyJWKSetError) as e:
+                LOGGER.error(f"Failed to fetch signing keys from {self.uri}: {e}")
+                # Keep serving the old keys, and do not retry on every login
+                self._fetched_at = now
+                self._expires_at = now + self.min_refresh_interval
+
+    def get_key(self, kid):
+        """Returns the PyJWK for `kid`, refetching the key set when it is stale or unknown."""
+        if time.monotonic() >= self._expires_at:
+            self._refresh()
+        key = self._keys.get(kid)
+        if key is None:
+            self._refresh(unknown_kid=kid)
+            key = self._keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key {kid!r}")
+        return key
+
+
+_CACHES = {}  # provider -> (JWKS uri, JwksCache)
+_LOCK = threading.Lock()
+
+
+def _jwks_uri(provider):
+    config = get_config()
+    if provider == GOOGLE:
+        return config.get("ID_TOKEN", "GOOGLE_JWKS_URI") or GOOGLE_JWKS_URI
+    return (config.get("ID_TOKEN", "MICROSOFT_JWKS_URI")
+            or f"{config.get('MSAL', 'authority', '').rstrip('/')}/discovery/v2.0/keys")
+
+
+def get_jwks_cache(provider):
+    """The provider's JwksCache, rebuilt when its JWKS uri changes in the config."""
+    uri = _jwks_uri(provider)
+    cached = _CACHES.get(provider)
+    if cached and cached[0] == uri:
+        return cached[1]
+    with _LOCK:
+        cached = _CACHES.get(provider)
+        if cached is None or cached[0] != uri:
+            config = get_config()
+            cache = JwksCache(uri,
+                              ttl=config.get_float("ID_TOKEN", "JWKS_TTL", 3600),
+                              min_refresh_interval=config.get_float("ID_TOKEN", "MIN_REFRESH_INTERVAL", 60),
+                              timeout=config.get_float("ID_TOKEN", "TIMEOUT", 5),
+                              component="google" if provider == GOOGLE else "graph")
+            cached = _CACHES[provider] = (uri, cache)
+    return cached[1]
+
+
+def _microsoft_issuer(claims):
+    """v2.0 tokens are issued by <authority host>/<tenant id>/v2.0, also via /common."""
+    config = get_config()
+    template = config.get("ID_TOKEN", "MICROSOFT_ISSUER")
+    if not template:
+        authority = urlsplit(config.get("MSAL", "authority", ""))
+        template = f"{authority.scheme}://{authority.netloc}/{{tid}}/v2.0"
+    return template.replace("{tid}", str(claims.get("tid", "")))
+
+
+def verify_id_token(provider, id_token, audience):
+    """
+    Verifies an id_token's signature, audience, issuer and expiry against the
+    provider's cached JWKS. Returns the claims, or None when there is no token,
+    local verification is disabled ([ID_TOKEN] VERIFY) or it fails, in which
+    case callers fall back to asking the provider for the profile.
+    """
+    if not id_token or not get_config().get_bool("ID_TOKEN", "VERIFY", True):
+        return None
+    leeway = get_config().get_float("ID_TOKEN", "LEEWAY", 60)
+    try:
+        header = jwt.get_unverified_header(id_token)
+        key = get_jwks_cache(provider).get_key(header.get("kid"))
+        claims = jwt.decode(
+            id_token, key.key, algorithms=["RS256"], audience=audience, leeway=leeway,
+            issuer=GOOGLE_ISSUERS if provider == GOOGLE else None,
+            options={"require": ["exp", "iat", "iss", "aud"]},
+        )
+        if provider == MICROSOFT and claims["iss"] != _microsoft_issuer(claims):
+            raise jwt.InvalidIssuerError(f"Invalid issuer {claims['iss']!r}")
+    except jwt.PyJWTError as e:
+        LOGGER.warning(f"{provider} id_token not verified locally: {e}")
+        return None
+    return claims
@@ -0,0 +1,396 @@
+import json
+import multiprocessing
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+import api_module
+import db_module
+from config_module import get_config, parse_bool
+from log_module import setup_logger
+
+LOGGER = setup_logger("job", "logs/service")
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+ENQUEUE_LOCK_NAME = "myoauth_email_jobs_enqueue"
+# Seconds an enqueue waits for another worker's capacity check and insert
+ENQUEUE_LOCK_TIMEOUT = 2
+
+
+# --- Job handlers ---
+
+def _send_google_email(payload):
+    return api_module.send_google_email(
+        payload['recipient'], payload['subject'], payload['body'], user_id=payload['user_id'])
+
+def _send_microsoft_email(payload):
+    return api_module.send_microsoft_email(
+        payload['recipient'], payload['subject'], payload['body'], user_id=payload['user_id'])
+
+HANDLERS = {
+    "google_email": _send_google_email,
+    "microsoft_email": _send_microsoft_email,
+}
+
+
+def new_job(kind, payload):
+    now = datetime.utcnow()
+    return {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "payload": payload,
+        "status": QUEUED,
+        "result": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+def public_view(job):
+    """Job fields returned to the client."""
+    return {
+        "id": job["id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "result": job["result"],
+        "created_at": str(job["created_at"]),
+        "updated_at": str(job["updated_at"]),
+    }
+
+
+# --- Backends ---
+
+class InProcessBackend:
+    """Bounded in-memory queue. Jobs are lost on restart."""
+
+    def __init__(self, capacity=1000, retention=10000):
+        self._queue = queue.Queue(maxsize=capacity)
+        self._jobs = OrderedDict()
+        self._retention = retention
+        self._lock = threading.Lock()
+
+    def put(self, job, timeout=0):
+        with self._lock:
+            self._jobs[job["id"]] = job
+        try:
+            self._queue.put(job["id"], block=timeout > 0, timeout=timeout or None)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job["id"], None)
+            return False
+        return True
+
+    def claim(self, timeout=1.0):
+        try:
+            job_id = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        with self._lock:
+            job = self._jobs[job_id]
+            job["status"] = RUNNING
+            job["updated_at"] = datetime.utcnow()
+            return job
+
+    def complete(self, job_id, status, result):
+        with self._lock:
+            job = self._jobs[job_id]
+            job["status"] = status
+            job["result"] = result
+            job["updated_at"] = datetime.utcnow()
+            job["payload"] = None  # only needed until the job has run
+            self._jobs.move_to_end(job_id)
+            while len(self._jobs) > self._retention:
+                oldest = next(iter(self._jobs.values()))
+                if oldest["status"] in (QUEUED, RUNNING):
+                    break
+                self._jobs.popitem(last=False)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def depth(self):
+        return self._queue.qsize()
+
+
+class DbBackend:
+    """
+    MySQL table backed queue (via db_module), so queued jobs survive restarts
+    and can be drained by workers in several processes.
+    """
+
+    def __init__(self, capacity=1000, poll_interval=0.5, lease=300):
+        self.capacity = capacity
+        self.poll_interval = poll_interval
+        self.lease = lease
+        create_job_table()
+        requeue_stale_jobs(lease)
+
+    def put(self, job, timeout=0):
+        deadline = time.monotonic() + timeout
+        while True:
+            # Workers in other processes count and insert under the same lock,
+            # so they cannot both take the last free slot
+            with db_module.named_lock(ENQUEUE_LOCK_NAME, ENQUEUE_LOCK_TIMEOUT) as acquired:
+                if acquired and insert_job(job, self.capacity):
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(min(self.poll_interval, max(0.0, deadline - time.monotonic())))
+
+    def claim(self, timeout=1.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = claim_job()
+            if job or time.monotonic() >= deadline:
+                return job
+            time.sleep(self.poll_interval)
+
+    def complete(self, job_id, status, result):
+        complete_job(job_id, status, result)
+
+    def get(self, job_id):
+        return get_job(job_id)
+
+    def depth(self):
+        return count_queued_jobs()
+
+
+@db_module.db_operation
+def create_job_table(cursor):
+    """Create the email_jobs table if it doesn't exist."""
+    sql = """
+    CREATE TABLE IF NOT EXISTS email_jobs (
+        id CHAR(32) PRIMARY KEY,
+        kind VARCHAR(50) NOT NULL,
+        payload MEDIUMTEXT,
+        status VARCHAR(20) NOT NULL,
+        result MEDIUMTEXT,
+        created_at DATETIME NOT NULL,
+        updated_at DATETIME NOT NULL,
+        INDEX idx_status_created (status, created_at)
+    )
+    """
+    db_module.exec_sql(cursor, sql)
+
+@db_module.db_operation
+def requeue_stale_jobs(cursor, lease):
+    """Jobs left 'running' by a crashed worker for longer than `lease` seconds are queued again."""
+    sql = "UPDATE email_jobs SET status = %s WHERE status = %s AND updated_at < UTC_TIMESTAMP() - INTERVAL %s SECOND"
+    db_module.exec_sql(cursor, sql, (QUEUED, RUNNING, int(lease)))
+
+@db_module.db_operation
+def count_queued_jobs(cursor):
+    db_module.exec_sql(cursor, "SELECT COUNT(*) AS depth FROM email_jobs WHERE status = %s", (QUEUED,))
+    return cursor.fetchone()["depth"]
+
+@db_module.db_operation
+def insert_job(cursor, job, capacity):
+    """
+    Inserts the job unless `capacity` jobs are already queued. Called under
+    ENQUEUE_LOCK_NAME; the insert is committed before the lock is released.
+    """
+    db_module.exec_sql(cursor, "SELECT COUNT(*) AS depth FROM email_jobs WHERE status = %s", (QUEUED,))
+    if cursor.fetchone()["depth"] >= capacity:
+        return False
+    sql = """
+    INSERT INTO email_jobs (id, kind, payload, status, created_at, updated_at)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    """
+    db_module.exec_sql(cursor, sql, (job["id"], job["kind"], json.dumps(job["payload"]), job["status"],
+                                     job["created_at"], job["updated_at"]))
+    return True
+
+@db_module.db_operation
+def claim_job(cursor):
+    """Marks the oldest queued job as running and returns it (SKIP LOCKED lets workers claim in parallel)."""
+    sql = """
+    SELECT * FROM email_jobs WHERE status = %s
+    ORDER BY created_at LIMIT 1 FOR UPDATE SKIP LOCKED
+    """
+    db_module.exec_sql(cursor, sql, (QUEUED,))
+    job = cursor.fetchone()
+    if not job:
+        return None
+    job["payload"] = json.loads(job["payload"]) if job["payload"] else None
+    job["status"] = RUNNING
+    job["updated_at"] = datetime.utcnow()
+    db_module.exec_sql(cursor, "UPDATE email_jobs SET status = %s, updated_at = %s WHERE id = %s",
+                       (RUNNING, job["updated_at"], job["id"]))
+    return job
+
+@db_module.db_operation
+def complete_job(cursor, job_id, status, result):
+    # The payload is not needed once the job has finished
+    sql = "UPDATE email_jobs SET status = %s, result = %s, payload = NULL, updated_at = %s WHERE id = %s"
+    db_module.exec_sql(cursor, sql, (status, json.dumps(result), datetime.utcnow(), job_id))
+
+@db_module.db_operation
+def get_job(cursor, job_id):
+    db_module.exec_sql(cursor, "SELECT * FROM email_jobs WHERE id = %s", (job_id,))
+    job = cursor.fetchone()
+    if job:
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+# --- Workers ---
+
+def run_job(backend, job):
+    handler = HANDLERS.get(job["kind"])
+    try:
+        if handler is None:
+            raise ValueError(f"Unknown job kind: {job['kind']}")
+        result = handler(job["payload"])
+        status = FAILED if result.get("status") == "error" else DONE
+    except Exception as e:
+        LOGGER.error(f"Job {job['id']} failed: {e}")
+        result = {"status": "error", "data": "", "message": str(e)}
+        status = FAILED
+    backend.complete(job["id"], status, result)
+
+def worker_loop(backend, stop_event):
+    while not stop_event.is_set():
+        try:
+            job = backend.claim(timeout=1.0)
+        except Exception as e:
+            LOGGER.error(f"Failed to claim job: {e}")
+            stop_event.wait(1.0)
+            continue
+        if job:
+            run_job(backend, job)
+
+def _process_worker(stop_event):
+    """Entry point of worker processes; they drain the shared database queue."""
+    config = get_config()
+    backend = DbBackend(
+        capacity=config.get_int("JOBS", "CAPACITY", 1000),
+        poll_interval=config.get_float("JOBS", "POLL_INTERVAL", 0.5),
+    )
+    worker_loop(backend, stop_event)
+
+
+class JobQueue:
+    """Job backend plus the pool of threads or processes that drains it."""
+
+    def __init__(self, backend, workers=4, mode="thread", enqueue_timeout=0.5):
+        if mode == "process" and not isinstance(backend, DbBackend):
+            raise ValueError("Process workers need the database backend ([JOBS] BACKEND = mysql)")
+        self.backend = backend
+        self.workers = workers
+        self.mode = mode
+        self.enqueue_timeout = enqueue_timeout
+        self._stop = None
+        self._workers = []
+
+    def start(self):
+        if self.mode == "process":
+            context = multiprocessing.get_context("spawn")
+            self._stop = context.Event()
+            self._workers = [context.Process(target=_process_worker, args=(self._stop,), daemon=True,
+                                             name=f"email-worker-{i}") for i in range(self.workers)]
+        else:
+            self._stop = threading.Event()
+            self._workers = [threading.Thread(target=worker_loop, args=(self.backend, self._stop), daemon=True,
+                                              name=f"email-worker-{i}") for i in range(self.workers)]
+        for worker in self._workers:
+            worker.start()
+        LOGGER.info(f"Started {self.workers} email {self.mode} workers")
+
+    def stop(self, timeout=10):
+        if self._stop is None:
+            return
+        self._stop.set()
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(0.0, deadline - time.monotonic()))
+        self._workers = []
+
+    def enqueue(self, kind, payload):
+        """Returns the job id, or None when the queue is full (backpressure)."""
+        job = new_job(kind, payload)
+        if not self.backend.put(job, timeout=self.enqueue_timeout):
+            LOGGER.warning(f"Job queue full, rejected {kind} job")
+            return None
+        return job["id"]
+
+    def get(self, job_id):
+        job = self.backend.get(job_id)
+        return public_view(job) if job else None
+
+    def stats(self):
+        return {"backend": type(self.backend).__name__, "mode": self.mode,
+                "workers": self.workers, "depth": self.backend.depth()}
+
+
+def backend_for(workers, config=None):
+    """
+    The [JOBS] BACKEND to run with `workers` server processes. The memory
+    backend only knows the jobs of its own worker, so a status poll answered by
+    another worker finds nothing: unset, BACKEND is mysql for more than one
+    worker (memory otherwise), and memory set explicitly is warned about.
+    """
+    backend = (config or get_config()).get("JOBS", "BACKEND", "")
+    if workers > 1 and not backend:
+        return "mysql"
+    if workers > 1 and backend == "memory":
+        LOGGER.warning(f"[JOBS] BACKEND = memory with {workers} workers: "
+                       "/api/jobs/<id> only finds jobs queued by the worker that answers it")
+    return backend or "memory"
+
+_QUEUE = None
+_LOCK = threading.Lock()
+
+def get_job_queue():
+    """Returns the process-wide JobQueue, starting its workers on first use."""
+    global _QUEUE
+    if _QUEUE is None:
+        with _LOCK:
+            if _QUEUE is None:
+                config = get_config()
+                capacity = config.get_int("JOBS", "CAPACITY", 1000)
+                if config.get("JOBS", "BACKEND", "memory") == "mysql":
+                    backend = DbBackend(capacity=capacity,
+                                        poll_interval=config.get_float("JOBS", "POLL_INTERVAL", 0.5))
+                else:
+                    backend = InProcessBackend(capacity=capacity)
+                job_queue = JobQueue(
+                    backend,
+                    workers=config.get_int("JOBS", "WORKERS", 4),
+                    mode=config.get("JOBS", "WORKER_MODE", "thread"),
+                    enqueue_timeout=config.get_float("JOBS", "ENQUEUE_TIMEOUT", 0.5),
+                )
+                job_queue.start()
+                _QUEUE = job_queue
+    return _QUEUE
+
+def is_async_enabled(data=None):
+    """
+    Async mode is on when the request body asks for it ("async": true, or
+    "true"/"1"/"yes" from a form), otherwise when [JOBS] ASYNC is set.
+    """
+    if data and "async" in data:
+        try:
+            return parse_bool(data["async"])
+        except ValueError:
+            LOGGER.warning(f"Ignoring invalid async value {data['async']!r}")
+    return get_config().get_bool("JOBS", "ASYNC", False)
+
+def shutdown(timeout=10):
+    global _QUEUE
+    with _LOCK:
+        job_queue, _QUEUE = _QUEUE, None
+    if job_queue:
+        job_queue.stop(timeout)
+
+def reset_after_fork():
+    """The parent's worker threads do not exist in a forked child; the queue restarts on first use."""
+    global _QUEUE
+    _QUEUE = None
@@ -0,0 +1,35 @@
+import importlib
+import sys
+
+
+class LazyModule:
+    """
+    Stands in for a module that is imported on first attribute access, so
+    provider SDKs (googleapiclient, msal, aiohttp, ...) are only loaded by
+    workers that use them. Importing is thread-safe: the import system locks
+    each module while it is being loaded.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}{' (loaded)' if is_loaded(self) else ''}>"
+
+
+def lazy_import(name):
+    """Returns a LazyModule for `name`, or the module itself when it is already imported."""
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def is_loaded(module):
+    """Whether a module (or a LazyModule's module) has been imported in this process."""
+    name = module._name if isinstance(module, LazyModule) else module.__name__
+    return name in sys.modules
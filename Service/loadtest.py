@@ -0,0 +1,141 @@
+"""
+Load test of the production launcher: starts serve.py with each worker count
+in turn, drives it with keep-alive HTTP clients and reports requests/sec and
+latency percentiles, showing how throughput scales with worker processes.
+
+Usage:
+    python loadtest.py --worker-counts 1 2 4 --threads 4 --concurrency 32 --duration 10
+    python loadtest.py --path /api/db/pool_stats --client-processes 4
+
+Run from the Service directory so myConfig.ini is picked up.
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from benchmark import report
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/")
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def client_process(port, path, threads, duration, results):
+    """One client process running `threads` keep-alive connections for `duration` seconds."""
+    samples = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        local, failed = [], 0
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                continue
+            local.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            samples.extend(local)
+            errors[0] += failed
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    results.put((samples, errors[0]))
+
+
+def run(workers, args):
+    port = free_port()
+    env = dict(os.environ)
+    # Per-request DEBUG logging would dominate the measurement
+    env.setdefault("MYOAUTH__LOG__LEVEL", "INFO")
+    env.setdefault("MYOAUTH__REFRESH__ENABLED", "false")
+    server = subprocess.Popen(
+        [sys.executable, "serve.py", "--bind", f"127.0.0.1:{port}",
+         "--workers", str(workers), "--threads", str(args.threads)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not wait_until_ready(port):
+            print(f"workers={workers}: server did not start")
+            return
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        per_process = max(1, args.concurrency // args.client_processes)
+        clients = [context.Process(target=client_process,
+                                   args=(port, args.path, per_process, args.duration, results))
+                   for _ in range(args.client_processes)]
+        start = time.perf_counter()
+        for c in clients:
+            c.start()
+        samples, errors = [], 0
+        for _ in clients:
+            s, e = results.get()
+            samples.extend(s)
+            errors += e
+        for c in clients:
+            c.join()
+        elapsed = time.perf_counter() - start
+        report(f"workers={workers} threads={args.threads}", samples, elapsed)
+        if errors:
+            print(f"{'':<28} errors={errors}")
+    finally:
+        # SIGTERM exercises the graceful shutdown path
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--worker-counts", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker process")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent client connections")
+    parser.add_argument("--client-processes", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per worker count")
+    parser.add_argument("--path", default="/metrics")
+    args = parser.parse_args()
+    print(f"GET {args.path}, {args.concurrency} connections, {args.duration:g}s per run")
+    for workers in args.worker_counts:
+        run(workers, args)
+
+
+if __name__ == "__main__":
+    main()
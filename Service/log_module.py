@@ -1,26 +1,172 @@
 import os
+import atexit
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 
-def setup_logger(log_name='default', log_dir='logs/default'):
-    import logging
-    from logging.handlers import TimedRotatingFileHandler
+from config_module import get_config
+
+_LOCK = threading.Lock()
+_LISTENER = None
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    QueueHandler for a bounded queue. When the queue is full the record is
+    dropped (and counted) instead of blocking the request thread, unless the
+    overflow policy is 'block'.
+    """
+
+    def __init__(self, log_queue, block=False):
+        super().__init__(log_queue)
+        self.block = block
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting (and big5 encoding) is left to the listener thread; records
+        # never leave the process so they need not be made picklable here.
+        return record
+
+    def enqueue(self, record):
+        if self.block:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LoggerDispatcher(QueueListener):
+    """Single listener thread that hands each record to its logger's file handler."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.targets = {}
+
+    def handle(self, record):
+        handler = self.targets.get(record.name)
+        if handler is not None and record.levelno >= handler.level:
+            handler.handle(record)
+
+
+DEFAULT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class DelayedFileHandler(TimedRotatingFileHandler):
+    """
+    Opens its file, creating the log directory, when the first record is
+    written instead of when the logger is set up at import time.
+    """
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
 
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    
-    log_path = os.path.join(log_dir, f'{log_name}.log')
-    logger = logging.getLogger(log_name)
-    logger.setLevel(logging.DEBUG)
 
-    handler = TimedRotatingFileHandler(
+def _file_handler(log_path, fmt=DEFAULT_FORMAT):
+    handler = DelayedFileHandler(
         filename=log_path,
         encoding='big5',
         when='midnight',  # 每天午夜切割
         interval=1,       # 每 1 天
         backupCount=14,   # 保留 14 天的檔案
-        errors='ignore'   # 遇到無法編碼的字元時忽略
+        errors='ignore',  # 遇到無法編碼的字元時忽略
+        delay=True
     )
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter(fmt)
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    
-    return logger
\ No newline at end of file
+    return handler
+
+
+def _get_listener():
+    global _LISTENER
+    if _LISTENER is None:
+        config = get_config()
+        log_queue = queue.Queue(maxsize=config.get_int("LOG", "QUEUE_SIZE", 10000))
+        _LISTENER = LoggerDispatcher(log_queue)
+        _LISTENER.start()
+        atexit.register(stop_logging)
+    return _LISTENER
+
+
+def setup_logger(log_name='default', log_dir='logs/default', fmt=DEFAULT_FORMAT):
+    """
+    Returns the named logger writing to <log_dir>/<log_name>.log.
+    Calling it again for the same name returns the same logger without adding
+    another handler. With [LOG] ASYNC = true records go through a bounded
+    queue and are written by a background thread.
+    """
+    logger = logging.getLogger(log_name)
+    with _LOCK:
+        if getattr(logger, '_myoauth_configured', False):
+            return logger
+
+        config = get_config()
+        logger.setLevel(config.get("LOG", "LEVEL", "DEBUG").upper())
+
+        handler = _file_handler(os.path.join(log_dir, f'{log_name}.log'), fmt)
+
+        if config.get_bool("LOG", "ASYNC", False):
+            listener = _get_listener()
+            listener.targets[log_name] = handler
+            block = config.get("LOG", "OVERFLOW", "drop") == "block"
+            logger.addHandler(BoundedQueueHandler(listener.queue, block=block))
+        else:
+            logger.addHandler(handler)
+
+        logger._myoauth_configured = True
+    return logger
+
+
+def reset_after_fork():
+    """
+    Restarts the listener in a forked worker (its thread stays in the parent),
+    keeping the file handlers and pointing the loggers at the new queue.
+    """
+    global _LISTENER
+    with _LOCK:
+        old = _LISTENER
+        if old is None:
+            return
+        listener = LoggerDispatcher(queue.Queue(maxsize=old.queue.maxsize))
+        listener.targets = old.targets
+        for logger in logging.Logger.manager.loggerDict.values():
+            for handler in getattr(logger, 'handlers', []):
+                if isinstance(handler, BoundedQueueHandler):
+                    handler.queue = listener.queue
+        listener.start()
+        _LISTENER = listener
+
+
+def get_dropped_records():
+    """Number of records discarded because the async log queue was full, per logger."""
+    dropped = {}
+    for name, logger in logging.Logger.manager.loggerDict.items():
+        for handler in getattr(logger, 'handlers', []):
+            if isinstance(handler, BoundedQueueHandler):
+                dropped[name] = handler.dropped
+    return dropped
+
+
+def stop_logging():
+    """
+    Flushes queued records and stops the listener thread. The loggers get
+    their file handlers back first, so records logged during shutdown are
+    written directly instead of going to a queue nobody reads.
+    """
+    global _LISTENER
+    with _LOCK:
+        listener, _LISTENER = _LISTENER, None
+        if listener is None:
+            return
+        for name, handler in listener.targets.items():
+            logger = logging.getLogger(name)
+            for queued in [h for h in logger.handlers if isinstance(h, BoundedQueueHandler)]:
+                logger.removeHandler(queued)
+            logger.addHandler(handler)
+    listener.stop()
+    # Flushed and closed; a record logged later reopens the file
+    for handler in listener.targets.values():
+        handler.close()
@@ -0,0 +1,186 @@
+import bisect
+import contextvars
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from log_module import setup_logger
+
+# One JSON object per line, no text prefix
+ACCESS_LOGGER = setup_logger("access", "logs/access", fmt="%(message)s")
+
+# Downstream systems timed per request
+COMPONENTS = ("db", "google", "graph")
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUANTILES = (0.5, 0.95, 0.99)
+# Quantiles are computed over the most recent observations of each series
+WINDOW = 1024
+
+
+class Histogram:
+    """Cumulative Prometheus-style buckets plus a sliding window for quantiles."""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.window = deque(maxlen=WINDOW)
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.window.append(value)
+
+    def quantile(self, q):
+        if not self.window:
+            return 0.0
+        values = sorted(self.window)
+        return values[min(len(values) - 1, int(len(values) * q))]
+
+
+class RequestTimings:
+    """Time spent in each downstream component during one request."""
+
+    def __init__(self, endpoint, method):
+        self.endpoint = endpoint
+        self.method = method
+        self.start = time.perf_counter()
+        self.durations = dict.fromkeys(COMPONENTS, 0.0)
+        self.calls = dict.fromkeys(COMPONENTS, 0)
+        self._lock = threading.Lock()  # batch helpers report from worker threads
+
+    def add(self, component, elapsed):
+        with self._lock:
+            self.durations[component] += elapsed
+            self.calls[component] += 1
+
+
+_current = contextvars.ContextVar("request_timings", default=None)
+_LOCK = threading.Lock()
+_REQUESTS = {}     # (endpoint, method) -> Histogram
+_DOWNSTREAM = {}   # (component, endpoint) -> Histogram
+_STATUS = {}       # (endpoint, method, status) -> count
+
+
+def _observe(table, key, value):
+    with _LOCK:
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram()
+        histogram.observe(value)
+
+
+def start_request(endpoint, method):
+    """Begins timing the current request; returns a token for finish_request."""
+    return _current.set(RequestTimings(endpoint, method))
+
+
+def current_timings():
+    return _current.get()
+
+
+@contextmanager
+def track(component):
+    """Times a downstream call (db / google / graph) and charges it to the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = _current.get()
+        if timings is not None:
+            timings.add(component, elapsed)
+        _observe(_DOWNSTREAM, (component, timings.endpoint if timings else "background"), elapsed)
+
+
+def finish_request(token, path, status, remote_addr):
+    """Records the request in the histograms and writes one JSON access-log line."""
+    timings = _current.get()
+    _current.reset(token)
+    if timings is None:
+        return
+    duration = time.perf_counter() - timings.start
+    _observe(_REQUESTS, (timings.endpoint, timings.method), duration)
+    with _LOCK:
+        key = (timings.endpoint, timings.method, status)
+        _STATUS[key] = _STATUS.get(key, 0) + 1
+
+    entry = {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "ip": remote_addr,
+        "method": timings.method,
+        "path": path,
+        "endpoint": timings.endpoint,
+        "status": status,
+        "duration_ms": round(duration * 1000, 3),
+    }
+    for component in COMPONENTS:
+        entry[f"{component}_ms"] = round(timings.durations[component] * 1000, 3)
+        entry[f"{component}_calls"] = timings.calls[component]
+    ACCESS_LOGGER.info(json.dumps(entry))
+
+
+# --- Prometheus text exposition ---
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+
+
+def _render_histogram(lines, name, help_text, table, label_names):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, histogram in sorted(table.items()):
+        labels = dict(zip(label_names, key))
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram.buckets):
+            cumulative += count
+            lines.append(f"{name}_bucket{{{_labels(**labels, le=bound)}}} {cumulative}")
+        lines.append(f"{name}_sum{{{_labels(**labels)}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{_labels(**labels)}}} {histogram.count}")
+
+
+def _render_quantiles(lines, name, help_text, table, label_names):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} summary")
+    for key, histogram in sorted(table.items()):
+        labels = dict(zip(label_names, key))
+        for q in QUANTILES:
+            lines.append(f"{name}{{{_labels(**labels, quantile=q)}}} {histogram.quantile(q)}")
+        lines.append(f"{name}_sum{{{_labels(**labels)}}} {histogram.sum}")
+        lines.append(f"{name}_count{{{_labels(**labels)}}} {histogram.count}")
+
+
+def render(extra_gauges=None):
+    """Returns all metrics in Prometheus text format (version 0.0.4)."""
+    lines = []
+    with _LOCK:
+        _render_histogram(lines, "myoauth_request_duration_seconds", "Request latency by endpoint.",
+                          _REQUESTS, ("endpoint", "method"))
+        _render_quantiles(lines, "myoauth_request_latency_seconds",
+                          f"Request latency quantiles over the last {WINDOW} requests per endpoint.",
+                          _REQUESTS, ("endpoint", "method"))
+        _render_histogram(lines, "myoauth_downstream_duration_seconds",
+                          "Time spent in the database, Google APIs and Microsoft Graph.",
+                          _DOWNSTREAM, ("component", "endpoint"))
+        _render_quantiles(lines, "myoauth_downstream_latency_seconds",
+                          f"Downstream call latency quantiles over the last {WINDOW} calls.",
+                          _DOWNSTREAM, ("component", "endpoint"))
+        lines.append("# HELP myoauth_requests_total Requests by endpoint and status code.")
+        lines.append("# TYPE myoauth_requests_total counter")
+        for (endpoint, method, status), count in sorted(_STATUS.items()):
+            lines.append(f"myoauth_requests_total{{{_labels(endpoint=endpoint, method=method, status=status)}}} {count}")
+
+    for name, (help_text, values) in (extra_gauges or {}).items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for key, value in sorted(values.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"{name}{{{_labels(stat=key)}}} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,77 @@
+import hashlib
+import threading
+
+import requests
+
+import api_module
+import graph_module
+import ratelimit_module
+from cache_module import LRUCache
+from config_module import get_config
+from log_module import setup_logger
+
+LOGGER = setup_logger("photo", "logs/service")
+
+# Cached for users without a photo so Graph is not asked again until the TTL expires
+NO_PHOTO = ()
+
+_CACHE = None
+_LOCK = threading.Lock()
+
+
+def get_cache():
+    """Per-user thumbnails: user id -> (etag, content type, bytes) or NO_PHOTO."""
+    global _CACHE
+    if _CACHE is None:
+        with _LOCK:
+            if _CACHE is None:
+                config = get_config()
+                _CACHE = LRUCache(maxsize=config.get_int("PHOTOS", "CACHE_SIZE", 1000),
+                                  ttl=config.get_float("PHOTOS", "CACHE_TTL", 3600))
+    return _CACHE
+
+
+def fetch_photo(access_token):
+    """
+    Downloads the signed-in user's thumbnail ([PHOTOS] SIZE, resized by Graph).
+    Returns (etag, content type, bytes), or NO_PHOTO when there is none or it
+    exceeds [PHOTOS] MAX_BYTES.
+    """
+    config = get_config()
+    size = config.get("PHOTOS", "SIZE", "96x96")
+    max_bytes = config.get_int("PHOTOS", "MAX_BYTES", 65536)
+    try:
+        response = graph_module.get_graph_client().get(f'me/photos/{size}/$value', access_token)
+    except (requests.RequestException, ratelimit_module.RateLimitExceeded) as error:
+        # The photo is optional: a login must not fail because Graph is throttling us
+        LOGGER.error(f"Error fetching photo: {error}")
+        return NO_PHOTO
+    if response.status_code != 200:
+        return NO_PHOTO
+    if len(response.content) > max_bytes:
+        LOGGER.warning(f"Photo of {len(response.content)} bytes exceeds MAX_BYTES, not served")
+        return NO_PHOTO
+    etag = hashlib.sha1(response.content).hexdigest()[:20]
+    return etag, response.headers.get('Content-Type', 'image/jpeg'), response.content
+
+
+def store(user_id, photo):
+    get_cache().set(user_id, photo)
+
+
+def get_photo(user_id):
+    """The user's cached thumbnail, fetched from Graph on a miss."""
+    cache = get_cache()
+    photo = cache.get(user_id)
+    if photo is None:
+        credentials = api_module.get_microsoft_credentials(user_id)
+        if not credentials:
+            return NO_PHOTO
+        photo = fetch_photo(credentials['access_token'])
+        cache.set(user_id, photo)
+    return photo
+
+
+def forget(user_id):
+    if user_id is not None:
+        get_cache().delete(user_id)
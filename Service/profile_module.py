@@ -0,0 +1,250 @@
+import cProfile
+import heapq
+import hmac
+import itertools
+import marshal
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Blueprint, Response, g, jsonify, request
+
+from config_module import get_config
+from log_module import setup_logger
+
+LOGGER = setup_logger("profile", "logs/service")
+
+profile_bp = Blueprint('profile_bp', __name__)
+
+_ids = itertools.count(1)
+_LOCK = threading.Lock()
+# cProfile can only run once at a time on Python 3.12+ (sys.monitoring), so at
+# most one request is profiled concurrently; others are simply not profiled.
+_PROFILER_LOCK = threading.Lock()
+_SLOWEST = []  # min-heap of (duration, id, entry): the slowest KEEP profiles
+_settings = {"admin_token": "", "keep": 20, "profile_all": False, "interval": 0.005}
+
+
+def _frame_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class StackSampler:
+    """
+    Wall-clock sampler: every `interval` seconds records the stack of each
+    watched thread (or of all threads) as collapsed stacks, the input format
+    of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.all_threads = False
+        self.stacks = Counter()
+        self.samples = 0
+        self._watched = {}  # thread ident -> Counter for a profiled request
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_running(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self.all_threads and not self._watched:
+                    self._thread = None
+                    return
+                frames = sys._current_frames()
+                if self.all_threads:
+                    self.samples += 1
+                    for ident, frame in frames.items():
+                        if ident != own:
+                            self.stacks[_frame_stack(frame)] += 1
+                for ident, counter in self._watched.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counter[_frame_stack(frame)] += 1
+            time.sleep(self.interval)
+
+    def watch(self, ident):
+        counter = Counter()
+        with self._lock:
+            self._watched[ident] = counter
+            self._ensure_running()
+        return counter
+
+    def unwatch(self, ident):
+        with self._lock:
+            self._watched.pop(ident, None)
+
+    def start(self, interval=None):
+        with self._lock:
+            if interval:
+                self.interval = interval
+            self.all_threads = True
+            self.stacks.clear()
+            self.samples = 0
+            self._ensure_running()
+
+    def stop(self):
+        with self._lock:
+            self.all_threads = False
+
+    def collapsed(self):
+        with self._lock:
+            return collapsed_text(self.stacks)
+
+
+def collapsed_text(stacks):
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+SAMPLER = StackSampler()
+
+
+def _is_admin_token(value):
+    # compare_digest only takes ASCII str; header values may hold any character
+    return hmac.compare_digest(value.encode(), _settings["admin_token"].encode())
+
+
+# --- Request hooks (only registered when profiling is enabled) ---
+
+def _start_request_profile():
+    wanted = _settings["profile_all"] or _is_admin_token(request.headers.get("X-Profile", ""))
+    if not wanted or not _PROFILER_LOCK.acquire(blocking=False):
+        return
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiling tool is active
+        _PROFILER_LOCK.release()
+        return
+    g.profile = (profiler, time.perf_counter(), SAMPLER.watch(threading.get_ident()))
+
+
+def _finish_request_profile(exc):
+    state = g.pop("profile", None)
+    if state is None:
+        return
+    profiler, start, stacks = state
+    profiler.disable()
+    _PROFILER_LOCK.release()
+    SAMPLER.unwatch(threading.get_ident())
+    duration = time.perf_counter() - start
+
+    profiler.create_stats()
+    entry = {
+        "id": next(_ids),
+        "endpoint": request.url_rule.rule if request.url_rule else "unmatched",
+        "method": request.method,
+        "path": request.path,
+        "duration_ms": round(duration * 1000, 3),
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "pstats": marshal.dumps(profiler.stats),
+        "collapsed": collapsed_text(stacks),
+    }
+    with _LOCK:
+        item = (duration, entry["id"], entry)
+        if len(_SLOWEST) < _settings["keep"]:
+            heapq.heappush(_SLOWEST, item)
+        elif duration > _SLOWEST[0][0]:
+            heapq.heapreplace(_SLOWEST, item)
+
+
+def init_app(app):
+    """
+    Registers the profiling hooks and admin endpoints when [PROFILING] ENABLED
+    is set. When disabled nothing is registered, so requests pay nothing.
+    """
+    config = get_config()
+    if not config.get_bool("PROFILING", "ENABLED", False):
+        return False
+    admin_token = config.get("PROFILING", "ADMIN_TOKEN", "")
+    if not admin_token:
+        LOGGER.error("[PROFILING] ENABLED requires ADMIN_TOKEN; profiling stays off")
+        return False
+    _settings.update(
+        admin_token=admin_token,
+        keep=config.get_int("PROFILING", "KEEP", 20),
+        profile_all=config.get_bool("PROFILING", "PROFILE_ALL", False),
+        interval=config.get_float("PROFILING", "SAMPLE_INTERVAL", 0.005),
+    )
+    SAMPLER.interval = _settings["interval"]
+    app.before_request(_start_request_profile)
+    app.teardown_request(_finish_request_profile)
+    app.register_blueprint(profile_bp, url_prefix='/api/admin/profiling')
+    LOGGER.info("Profiling enabled")
+    return True
+
+
+# --- Admin endpoints ---
+
+@profile_bp.before_request
+def require_admin():
+    if not _is_admin_token(request.headers.get("X-Admin-Token", "")):
+        return jsonify({"status": "error", "data": "", "message": "Forbidden"}), 403
+
+
+def _find(profile_id):
+    with _LOCK:
+        for _, _, entry in _SLOWEST:
+            if entry["id"] == profile_id:
+                return entry
+    return None
+
+
+@profile_bp.route("/profiles")
+def list_profiles():
+    """The slowest profiled requests, slowest first."""
+    with _LOCK:
+        entries = sorted(_SLOWEST, reverse=True)
+    data = [{k: v for k, v in entry.items() if k not in ("pstats", "collapsed")} for _, _, entry in entries]
+    return jsonify({"status": "success", "data": data, "message": ""})
+
+
+@profile_bp.route("/profiles/<int:profile_id>.pstats")
+def download_pstats(profile_id):
+    """cProfile output, loadable with pstats.Stats(path) or snakeviz."""
+    entry = _find(profile_id)
+    if entry is None:
+        return jsonify({"status": "warning", "data": "", "message": "Profile not found"})
+    return Response(entry["pstats"], mimetype="application/octet-stream",
+                    headers={"Content-Disposition": f"attachment; filename=request-{profile_id}.pstats"})
+
+
+@profile_bp.route("/profiles/<int:profile_id>.collapsed")
+def download_request_stacks(profile_id):
+    """Sampled stacks of the request thread in collapsed format."""
+    entry = _find(profile_id)
+    if entry is None:
+        return jsonify({"status": "warning", "data": "", "message": "Profile not found"})
+    return Response(entry["collapsed"], mimetype="text/plain")
+
+
+@profile_bp.route("/sampler/start", methods=["POST"])
+def start_sampler():
+    """Starts sampling every thread of the process."""
+    interval = request.args.get("interval", type=float)
+    SAMPLER.start(interval)
+    return jsonify({"status": "success", "data": {"interval": SAMPLER.interval}, "message": "Sampler started"})
+
+
+@profile_bp.route("/sampler/stop", methods=["POST"])
+def stop_sampler():
+    SAMPLER.stop()
+    return jsonify({"status": "success", "data": {"samples": SAMPLER.samples}, "message": "Sampler stopped"})
+
+
+@profile_bp.route("/sampler.collapsed")
+def download_sampler_stacks():
+    """Whole-process collapsed stacks gathered since the sampler was started."""
+    return Response(SAMPLER.collapsed(), mimetype="text/plain")
@@ -0,0 +1,255 @@
+import asyncio
+import contextlib
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+
+from config_module import get_config
+from log_module import setup_logger
+
+LOGGER = setup_logger("ratelimit", "logs/service")
+
+GOOGLE = "google"
+MICROSOFT = "microsoft"
+PROVIDERS = (GOOGLE, MICROSOFT)
+THROTTLED_STATUS = (429, 503)
+# Above this fraction of the rate that was last throttled, the rate grows PROBE_FACTOR times slower
+CEILING_MARGIN = 0.9
+# The rate is lowered at most once per this many seconds (or per Retry-After)
+DECREASE_INTERVAL = 1.0
+PROBE_FACTOR = 0.1
+
+# User whose calls are being made; set by api_module when it resolves the user's credentials
+_user = contextvars.ContextVar("ratelimit_user", default=None)
+
+
+class RateLimitExceeded(Exception):
+    """A call would have had to queue longer than [RATELIMIT] MAX_WAIT seconds."""
+
+    def __init__(self, key, wait):
+        super().__init__(f"Rate limit for {key} reached, retry in {wait:.1f}s")
+        self.key = key
+        self.retry_after = wait
+
+
+class AdaptiveLimiter:
+    """
+    Token bucket (as a GCRA schedule) whose rate adapts to the provider: each
+    successful call adds `increase / rate` requests/s (about `increase` per
+    second of traffic, ten times less close to the rate that was last
+    throttled), a 429/503 multiplies the rate by `decrease` (once per
+    Retry-After, however many calls were throttled) and pauses the key for
+    Retry-After. When the provider sends RateLimit-Remaining
+    / RateLimit-Reset quota headers, the rate is set to spread what is left of
+    the window until it resets. Calls queue in arrival order for at most
+    `max_wait` seconds.
+    """
+
+    def __init__(self, key, rate, min_rate=0.5, burst=5, increase=1.0, decrease=0.7, max_wait=5.0):
+        self.key = key
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.max_wait = max_wait
+        self.waiting = 0
+        self._tat = 0.0            # theoretical arrival time of the next call
+        self._blocked_until = 0.0  # Retry-After / exhausted quota
+        self._ceiling = float("inf")  # rate at the last 429/503
+        self._next_decrease = 0.0
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "queued": 0, "rejected": 0, "throttled": 0}
+
+    def reserve(self):
+        """Books the next slot; returns the seconds to wait for it, or raises RateLimitExceeded."""
+        return _reserve((self,))
+
+    # The following three are called with self._lock held
+
+    def _next_start(self, now):
+        """When the next call may start."""
+        tat = max(self._tat, now)
+        return max(now, tat - (self.burst - 1) / self.rate, self._blocked_until)
+
+    def _check(self, wait):
+        if wait > self.max_wait:
+            self._stats["rejected"] += 1
+            LOGGER.warning(f"Rate limit for {self.key} reached at {self.rate:.2f}/s, call rejected")
+            raise RateLimitExceeded(self.key, wait)
+
+    def _book(self, start, now):
+        self._tat = max(self._tat, start) + 1.0 / self.rate
+        self._stats["admitted"] += 1
+        if start > now:
+            self._stats["queued"] += 1
+
+    def observe(self, status, headers=None):
+        """Adapts the rate to a response's status and rate limit headers."""
+        headers = {name.lower(): value for name, value in (headers or {}).items()}
+        with self._lock:
+            now = time.monotonic()
+            if status in THROTTLED_STATUS:
+                self._stats["throttled"] += 1
+                retry_after = _seconds(headers.get("retry-after"))
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+                # Calls already in flight when the limit was hit are throttled together; back off once
+                if now >= self._next_decrease:
+                    self._ceiling = self.rate
+                    self.rate = max(self.min_rate, self.rate * self.decrease)
+                    self._next_decrease = now + max(retry_after or 0, DECREASE_INTERVAL)
+            else:
+                step = self.increase / self.rate
+                if self.rate >= self._ceiling * CEILING_MARGIN:
+                    step *= PROBE_FACTOR  # close to where we were last throttled: probe slowly
+                self.rate = min(self.max_rate, self.rate + step)
+
+            remaining = _seconds(headers.get("ratelimit-remaining") or headers.get("x-ratelimit-remaining"))
+            reset = _seconds(headers.get("ratelimit-reset") or headers.get("x-ratelimit-reset"))
+            if remaining is not None and reset:
+                if remaining < 1:
+                    self._blocked_until = max(self._blocked_until, now + reset)
+                else:
+                    # Spread what is left of the window over the time until it resets
+                    self.rate = min(self.max_rate, max(self.min_rate, remaining / reset))
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, rate=round(self.rate, 3), max_rate=self.max_rate, waiting=self.waiting)
+
+
+def _seconds(value):
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None  # e.g. an HTTP-date Retry-After
+
+
+_LIMITERS = OrderedDict()  # (provider, user id or None for the whole app) -> AdaptiveLimiter
+_LOCK = threading.Lock()
+
+
+def bind_user(user_id):
+    """Charges the following outbound calls in this context to `user_id` (None: the app only)."""
+    _user.set(user_id)
+
+
+def get_limiter(provider, user_id=None):
+    """The limiter of a (provider, user) key; user_id None is the provider-wide limiter."""
+    key = (provider, user_id)
+    with _LOCK:
+        limiter = _LIMITERS.get(key)
+        if limiter is not None:
+            _LIMITERS.move_to_end(key)
+            return limiter
+        config = get_config()
+        scope = "USER" if user_id is not None else "APP"
+        limiter = _LIMITERS[key] = AdaptiveLimiter(
+            key,
+            rate=config.get_float("RATELIMIT", f"{provider.upper()}_{scope}_RATE", 1000 if user_id is None else 10),
+            min_rate=config.get_float("RATELIMIT", "MIN_RATE", 0.5),
+            burst=config.get_int("RATELIMIT", "BURST", 5),
+            increase=config.get_float("RATELIMIT", "INCREASE", 1.0),
+            decrease=config.get_float("RATELIMIT", "DECREASE", 0.7),
+            max_wait=config.get_float("RATELIMIT", "MAX_WAIT", 5.0),
+        )
+        # Least recently used users are forgotten (and start again at the full rate)
+        while len(_LIMITERS) > config.get_int("RATELIMIT", "MAX_KEYS", 10000):
+            _LIMITERS.popitem(last=False)
+    return limiter
+
+
+def _limiters(provider):
+    if not get_config().get_bool("RATELIMIT", "ENABLED", True):
+        return ()
+    user_id = _user.get()
+    if user_id is None:
+        return (get_limiter(provider),)
+    return (get_limiter(provider, user_id), get_limiter(provider))
+
+
+def _reserve(limiters):
+    """
+    Books a slot of every limiter, or of none: the call starts once all of
+    them allow it, and when that is too far away for any of them it is
+    rejected before a slot is booked, so it uses no key's budget.
+    """
+    with contextlib.ExitStack() as stack:
+        # Always the user's before the provider-wide lock, so callers cannot deadlock
+        for limiter in limiters:
+            stack.enter_context(limiter._lock)
+        now = time.monotonic()
+        start = max((limiter._next_start(now) for limiter in limiters), default=now)
+        for limiter in limiters:
+            limiter._check(start - now)
+        for limiter in limiters:
+            limiter._book(start, now)
+    return start - now
+
+
+def acquire(provider):
+    """
+    Waits for a slot of the current user's and the provider-wide limiter;
+    raises RateLimitExceeded instead when that would take longer than MAX_WAIT.
+    """
+    limiters = _limiters(provider)
+    wait = _reserve(limiters)
+    if wait > 0:
+        _set_waiting(limiters, 1)
+        try:
+            time.sleep(wait)
+        finally:
+            _set_waiting(limiters, -1)
+
+
+async def acquire_async(provider):
+    """acquire() for the event loop: queued calls sleep without holding a thread."""
+    limiters = _limiters(provider)
+    wait = _reserve(limiters)
+    if wait > 0:
+        _set_waiting(limiters, 1)
+        try:
+            await asyncio.sleep(wait)
+        finally:
+            _set_waiting(limiters, -1)
+
+
+def _set_waiting(limiters, delta):
+    for limiter in limiters:
+        with limiter._lock:
+            limiter.waiting += delta
+
+
+def report(provider, status, headers=None):
+    """
+    Feeds a response (or $batch / batch item) status and headers back to the
+    current keys. A 429/503 or quota headers on a user's call describe that
+    user's quota, so they only adapt the user's limiter; one user being
+    throttled must not slow down everyone else.
+    """
+    limiters = _limiters(provider)
+    if len(limiters) < 2:
+        for limiter in limiters:
+            limiter.observe(status, headers)
+        return
+    user, provider_wide = limiters
+    user.observe(status, headers)
+    if status not in THROTTLED_STATUS:
+        provider_wide.observe(status)
+
+
+def get_limiter_stats():
+    """Current rate, queue depth and counters of every key."""
+    with _LOCK:
+        limiters = list(_LIMITERS.values())
+    return [dict(limiter.stats(), provider=limiter.key[0], user_id=limiter.key[1]) for limiter in limiters]
+
+
+def get_provider_stats():
+    """Stats of the provider-wide limiters, by provider (for /metrics)."""
+    with _LOCK:
+        limiters = {provider: _LIMITERS.get((provider, None)) for provider in PROVIDERS}
+    return {provider: limiter.stats() for provider, limiter in limiters.items() if limiter is not None}
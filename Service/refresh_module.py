@@ -0,0 +1,263 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+import requests
+
+import db_module
+import token_module
+from config_module import get_config
+from lazy_module import lazy_import
+from log_module import setup_logger
+
+LOGGER = setup_logger("refresh", "logs/service")
+
+google_auth_exceptions = lazy_import("google.auth.exceptions")
+google_auth_requests = lazy_import("google.auth.transport.requests")
+
+SCAN_LOCK_NAME = "myoauth_token_refresh_scan"
+# Requests refresh tokens expiring within this many seconds (see api_module.ensure_fresh_tokens)
+REQUEST_THRESHOLD = 30
+
+
+class RevokedTokenError(Exception):
+    """The provider rejected the refresh token (invalid_grant)."""
+
+
+_LOCK = threading.Lock()
+_INFLIGHT = {}   # user id -> Future of the refresh in progress
+_RETRY_AT = {}   # user id -> (failures, monotonic time before which we do not retry)
+_STATS = {
+    "refreshes": 0,
+    "failures": 0,
+    "revoked": 0,
+    "deduplicated": 0,
+    "already_fresh": 0,
+    "scans": 0,
+    "lead_time_min": None,
+    "lead_time_sum": 0.0,
+    "last_scan_at": None,
+}
+_http_request = None  # google.auth transport for Google refreshes, made on first use
+
+
+def get_refresh_stats():
+    """Refresh counters; lead time is how many seconds before expiry tokens were refreshed."""
+    with _LOCK:
+        stats = dict(_STATS)
+        stats["inflight"] = len(_INFLIGHT)
+        stats["backing_off"] = len(_RETRY_AT)
+    stats["lead_time_avg"] = stats["lead_time_sum"] / stats["refreshes"] if stats["refreshes"] else None
+    return stats
+
+
+def _refresh_google(record):
+    global _http_request
+    if _http_request is None:
+        _http_request = google_auth_requests.Request(session=requests.Session())
+    credentials = token_module.build_google_credentials(record)
+    try:
+        credentials.refresh(_http_request)
+    except google_auth_exceptions.RefreshError as e:
+        if "invalid_grant" in str(e):
+            raise RevokedTokenError(str(e))
+        raise
+    return credentials.token, credentials.refresh_token, credentials.expiry
+
+
+def _refresh_microsoft(record):
+    import auth_module  # avoid importing the blueprint module at startup
+
+    result = auth_module.get_msal_app().acquire_token_by_refresh_token(
+        record["refresh_token"], scopes=get_config().get_list("MSAL", "scopes"))
+    if "error" in result:
+        if result["error"] == "invalid_grant":
+            raise RevokedTokenError(result.get("error_description"))
+        raise RuntimeError(f"{result['error']}: {result.get('error_description')}")
+    expiry = datetime.utcnow() + timedelta(seconds=int(result.get("expires_in", 3600)))
+    return result["access_token"], result.get("refresh_token"), expiry
+
+
+def _do_refresh(user_id, threshold):
+    # Read from the database rather than the cache: another worker may have rotated the tokens
+    record = db_module.get_user_by_id(user_id)
+    if not record or not record["refresh_token"]:
+        return False
+    lead_time = None
+    if record["token_expiry"] is not None:
+        lead_time = (record["token_expiry"] - datetime.utcnow()).total_seconds()
+        if lead_time > threshold:
+            # Another worker refreshed them; drop the stale record this worker cached
+            token_module.forget(user_id)
+            with _LOCK:
+                _STATS["already_fresh"] += 1
+                _RETRY_AT.pop(user_id, None)
+            return True
+
+    try:
+        if record["auth_provider"] == token_module.GOOGLE:
+            access_token, refresh_token, expiry = _refresh_google(record)
+        elif record["auth_provider"] == token_module.MICROSOFT:
+            access_token, refresh_token, expiry = _refresh_microsoft(record)
+        else:
+            return False
+    except RevokedTokenError as e:
+        LOGGER.warning(f"Refresh token of user {user_id} was revoked: {e}")
+        db_module.clear_refresh_token(user_id)
+        token_module.forget(user_id)
+        with _LOCK:
+            _STATS["revoked"] += 1
+        return False
+
+    token_module.update_tokens(user_id, access_token, refresh_token, expiry)
+    with _LOCK:
+        _STATS["refreshes"] += 1
+        _RETRY_AT.pop(user_id, None)
+        if lead_time is not None:
+            _STATS["lead_time_sum"] += lead_time
+            if _STATS["lead_time_min"] is None or lead_time < _STATS["lead_time_min"]:
+                _STATS["lead_time_min"] = lead_time
+    return True
+
+
+def is_backing_off(user_id):
+    """Whether the last refresh of this user failed and its retry delay has not passed yet."""
+    with _LOCK:
+        entry = _RETRY_AT.get(user_id)
+    return entry is not None and entry[1] > time.monotonic()
+
+
+def refresh_user(user_id, threshold=REQUEST_THRESHOLD):
+    """
+    Refreshes a user's tokens unless the stored ones expire in more than
+    `threshold` seconds. Concurrent calls for the same user share one provider
+    round trip (single flight). Returns True when fresh tokens are stored.
+    """
+    with _LOCK:
+        future = _INFLIGHT.get(user_id)
+        owner = future is None
+        if owner:
+            future = _INFLIGHT[user_id] = Future()
+        else:
+            _STATS["deduplicated"] += 1
+    if not owner:
+        return future.result()
+
+    try:
+        result = _do_refresh(user_id, threshold)
+    except Exception as e:
+        LOGGER.error(f"Failed to refresh tokens of user {user_id}: {e}")
+        with _LOCK:
+            _STATS["failures"] += 1
+            failures = _RETRY_AT.get(user_id, (0, 0))[0] + 1
+            _RETRY_AT[user_id] = (failures, time.monotonic() + min(3600, 30 * 2 ** failures))
+        result = False
+    finally:
+        with _LOCK:
+            _INFLIGHT.pop(user_id, None)
+    future.set_result(result)
+    return result
+
+
+class RefreshScheduler:
+    """
+    Background thread that refreshes tokens expiring within `lead_time` seconds,
+    `batch_size` users per query and `concurrency` refreshes at a time.
+    """
+
+    def __init__(self, lead_time=300, scan_interval=60, batch_size=100, concurrency=4):
+        self.lead_time = lead_time
+        self.scan_interval = scan_interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._stop = threading.Event()
+        self._thread = None
+        self._executor = None
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="token-refresh")
+        self._thread = threading.Thread(target=self._run, name="token-refresh-scheduler", daemon=True)
+        self._thread.start()
+        LOGGER.info(f"Token refresh scheduler started (lead time {self.lead_time}s)")
+
+    def stop(self, timeout=10):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                LOGGER.error(f"Token refresh scan failed: {e}")
+            self._stop.wait(self.scan_interval)
+
+    def run_once(self):
+        """Refreshes every token due within the lead time. Returns the number refreshed."""
+        refreshed = 0
+        # Only one process scans at a time; the others skip this round
+        with db_module.named_lock(SCAN_LOCK_NAME) as acquired:
+            if not acquired:
+                return 0
+            with _LOCK:
+                _STATS["scans"] += 1
+                _STATS["last_scan_at"] = datetime.utcnow().isoformat()
+            while not self._stop.is_set():
+                now = time.monotonic()
+                with _LOCK:
+                    for user_id, (_, retry_at) in list(_RETRY_AT.items()):
+                        if retry_at <= now:
+                            del _RETRY_AT[user_id]
+                    skipped = set(_RETRY_AT)
+                before = datetime.utcnow() + timedelta(seconds=self.lead_time)
+                rows = db_module.get_expiring_users(before, self.batch_size + len(skipped))
+                due = [row["id"] for row in rows if row["id"] not in skipped][:self.batch_size]
+                if not due:
+                    break
+                futures = [self._executor.submit(refresh_user, user_id, self.lead_time) for user_id in due]
+                wait(futures)
+                done = sum(1 for f in futures if f.result())
+                refreshed += done
+                if not done or len(due) < self.batch_size:
+                    break
+        return refreshed
+
+
+_SCHEDULER = None
+
+def start_scheduler():
+    """Starts the process-wide scheduler when [REFRESH] ENABLED is set."""
+    global _SCHEDULER
+    config = get_config()
+    if _SCHEDULER is not None or not config.get_bool("REFRESH", "ENABLED", False):
+        return _SCHEDULER
+    _SCHEDULER = RefreshScheduler(
+        lead_time=config.get_float("REFRESH", "LEAD_TIME", 300),
+        scan_interval=config.get_float("REFRESH", "SCAN_INTERVAL", 60),
+        batch_size=config.get_int("REFRESH", "BATCH_SIZE", 100),
+        concurrency=config.get_int("REFRESH", "CONCURRENCY", 4),
+    )
+    _SCHEDULER.start()
+    return _SCHEDULER
+
+def stop_scheduler(timeout=10):
+    global _SCHEDULER
+    scheduler, _SCHEDULER = _SCHEDULER, None
+    if scheduler:
+        scheduler.stop(timeout)
+
+def reset_after_fork():
+    """
+    Called in a forked worker: in-flight refreshes, the scheduler thread and the
+    HTTP session belong to the parent. A scheduler running there is restarted here.
+    """
+    global _SCHEDULER, _http_request
+    _INFLIGHT.clear()
+    _http_request = None
+    if _SCHEDULER is not None:
+        _SCHEDULER = None
+        start_scheduler()
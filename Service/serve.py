@@ -0,0 +1,131 @@
+"""
+Production launcher.
+
+    python serve.py
+    python serve.py --workers 4 --threads 8 --bind 0.0.0.0:5000
+
+Runs the app under gunicorn: the master process pre-forks [SERVER] WORKERS
+processes, each serving up to THREADS requests at a time (gthread workers).
+Every worker builds its own app with Service.create_app() after the fork.
+SIGTERM/SIGINT stop gracefully: workers finish in-flight requests (up to
+GRACEFUL_TIMEOUT seconds), then drain their background work.
+
+With --asgi (or [SERVER] MODE = asgi) uvicorn serves asgi_module instead,
+which handles the Microsoft Graph endpoints on asyncio (see asgi_module).
+
+gunicorn does not run on Windows; use `python Service.py` there.
+"""
+import argparse
+import os
+import secrets
+
+from gunicorn.app.base import BaseApplication
+
+from config_module import get_config, reload_config
+
+
+# --- gunicorn server hooks ---
+
+def on_starting(server):
+    """Runs once in the master before any worker is forked."""
+    import db_module
+    try:
+        db_module.create_user_table()
+    except Exception as e:
+        db_module.LOGGER.error(f"Could not create the users table: {e}")
+    # Close the master's connections so no socket is shared with the workers
+    db_module.dispose_pool()
+
+def post_fork(server, worker):
+    import Service
+    Service.reset_after_fork()
+
+def worker_exit(server, worker):
+    import Service
+    Service.shutdown(timeout=server.cfg.graceful_timeout)
+
+
+class ServiceApplication(BaseApplication):
+    """Embeds gunicorn so the settings come from myConfig.ini instead of a gunicorn.conf.py."""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        import Service
+        return Service.create_app()
+
+
+def run_asgi(args, config):
+    """uvicorn workers are spawned (not forked), so each one starts clean."""
+    import uvicorn
+
+    os.environ["MYOAUTH__SERVER__THREADS"] = str(args.threads)
+    reload_config()
+    on_starting(None)
+    host, _, port = args.bind.rpartition(":")
+    uvicorn.run(
+        "asgi_module:create_asgi_app", factory=True,
+        host=host or "0.0.0.0", port=int(port), workers=args.workers,
+        timeout_graceful_shutdown=config.get_int("SERVER", "GRACEFUL_TIMEOUT", 30),
+        lifespan="on", access_log=False,
+    )
+
+
+def main():
+    config = get_config()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bind", default=config.get("SERVER", "BIND", "0.0.0.0:5000"))
+    parser.add_argument("--workers", type=int, default=config.get_int("SERVER", "WORKERS", os.cpu_count() or 1))
+    parser.add_argument("--threads", type=int, default=config.get_int("SERVER", "THREADS", 8))
+    parser.add_argument("--asgi", action="store_true", default=config.get("SERVER", "MODE", "wsgi") == "asgi",
+                        help="serve asgi_module with uvicorn workers")
+    args = parser.parse_args()
+
+    if not config.get("SERVER", "SECRET_KEY"):
+        # Workers must share the session signing key; the environment override is
+        # inherited by every worker. Sessions still end when the server restarts.
+        os.environ["MYOAUTH__SERVER__SECRET_KEY"] = secrets.token_hex(32)
+        config = reload_config()
+    import job_module
+    # Inherited by every worker, like the secret key
+    os.environ["MYOAUTH__JOBS__BACKEND"] = job_module.backend_for(args.workers, config)
+    # Token caches are shared through Redis by several workers (see token_module)
+    os.environ["MYOAUTH__SERVER__WORKERS"] = str(args.workers)
+    config = reload_config()
+    if args.workers > 1 and config.get("CACHE", "BACKEND", "memory") != "redis":
+        import token_module
+        token_module.LOGGER.warning(f"[CACHE] BACKEND is not redis with {args.workers} workers: each worker "
+                                    "caches tokens for up to [TOKENS] CACHE_TTL seconds after another refreshes them")
+
+    if args.asgi:
+        run_asgi(args, config)
+        return
+
+    options = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "threads": args.threads,
+        "worker_class": "gthread",
+        "timeout": config.get_int("SERVER", "TIMEOUT", 30),
+        "graceful_timeout": config.get_int("SERVER", "GRACEFUL_TIMEOUT", 30),
+        "keepalive": config.get_int("SERVER", "KEEPALIVE", 5),
+        "max_requests": config.get_int("SERVER", "MAX_REQUESTS", 0),
+        "max_requests_jitter": config.get_int("SERVER", "MAX_REQUESTS_JITTER", 0),
+        "preload_app": config.get_bool("SERVER", "PRELOAD", False),
+        "on_starting": on_starting,
+        "post_fork": post_fork,
+        "worker_exit": worker_exit,
+        # Requests are already logged to logs/access as JSON by metrics_module
+        "accesslog": None,
+    }
+    ServiceApplication(options).run()
+
+
+if __name__ == "__main__":
+    main()
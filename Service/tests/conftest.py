@@ -0,0 +1,42 @@
+"""
+Shared fixtures. Run from the Service directory:
+
+    python -m pytest -q tests
+"""
+import os
+import sys
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if SERVICE_DIR not in sys.path:
+    sys.path.insert(0, SERVICE_DIR)
+
+# Before the first import of the service modules, which load the config
+os.environ.setdefault("MYOAUTH__REFRESH__ENABLED", "false")
+
+from config_module import ENV_PREFIX, reload_config  # noqa: E402
+
+
+@pytest.fixture
+def configure():
+    """
+    configure(SECTION__KEY=value, ...) sets MYOAUTH__SECTION__KEY overrides and
+    reloads the config; the previous values are restored after the test.
+    """
+    saved = {}
+
+    def apply(**overrides):
+        for name, value in overrides.items():
+            key = ENV_PREFIX + name
+            saved.setdefault(key, os.environ.get(key))
+            os.environ[key] = str(value)
+        return reload_config()
+
+    yield apply
+    for key, value in saved.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+    reload_config()
@@ -0,0 +1,271 @@
+"""
+Stub servers, mock transports and checks shared by the tests and benchmark.py
+(which imports them from here).
+"""
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# --- Microsoft Graph ---
+
+class StubGraphHandler(BaseHTTPRequestHandler):
+    """
+    Minimal Microsoft Graph stand-in. Every `throttle_every`-th request is
+    answered with 429 and Retry-After: 0 to exercise the retry path; every
+    answer is delayed by `latency` seconds.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; Nagle + delayed ACK would add ~40ms
+    disable_nagle_algorithm = True
+    throttle_every = 0
+    latency = 0.0
+    counter = 0
+    counter_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload=None, headers=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_bytes(self, content, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _throttled(self):
+        cls = type(self)
+        if not cls.throttle_every:
+            return False
+        with cls.counter_lock:
+            cls.counter += 1
+            hit = cls.counter % cls.throttle_every == 0
+        if hit:
+            self._send(429, {"error": {"code": "TooManyRequests", "message": "throttled"}},
+                       {"Retry-After": "0"})
+        return hit
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        if self._throttled():
+            return
+        if self.path.endswith("/me"):
+            self._send(200, {"displayName": "Benchmark User", "mail": "bench@example.com"})
+        elif self.path.endswith("/me/photo/$value"):
+            self._send_bytes(b"\xff" * 48 * 1024, "image/jpeg")  # full-size photo
+        elif "/me/photos/" in self.path and self.path.endswith("/$value"):
+            self._send_bytes(b"\xff" * 3 * 1024, "image/jpeg")   # Graph-resized thumbnail
+        else:
+            self._send(404, {"error": {"code": "NotFound", "message": self.path}})
+
+    def _batch(self, payload):
+        responses = []
+        for item in payload.get("requests", []):
+            cls = type(self)
+            with cls.counter_lock:
+                cls.counter += 1
+                throttled = cls.throttle_every and cls.counter % cls.throttle_every == 0
+            if throttled:
+                responses.append({"id": item["id"], "status": 429, "headers": {"Retry-After": "0"},
+                                  "body": {"error": {"code": "TooManyRequests", "message": "throttled"}}})
+            elif item["url"].endswith("/me/sendMail"):
+                responses.append({"id": item["id"], "status": 202, "headers": {}, "body": None})
+            elif item["url"].endswith("/me/events"):
+                responses.append({"id": item["id"], "status": 201, "headers": {},
+                                  "body": {"id": f"event-{item['id']}"}})
+            else:
+                responses.append({"id": item["id"], "status": 404, "headers": {},
+                                  "body": {"error": {"code": "NotFound", "message": item["url"]}}})
+        self._send(200, {"responses": responses})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.latency)
+        if self.path.endswith("/$batch"):
+            self._batch(json.loads(body))
+            return
+        if self._throttled():
+            return
+        if self.path.endswith("/me/sendMail"):
+            self._send(202)
+        elif self.path.endswith("/me/events"):
+            self._send(201, {"id": "event", "webLink": "http://localhost/event"})
+        elif self.path.endswith("/me/messages"):
+            self._send(201, {"id": "draft"})
+        elif self.path.endswith("/attachments/createUploadSession"):
+            self._send(201, {"uploadUrl": f"http://{self.headers['Host']}/upload/draft"})
+        elif self.path.endswith("/attachments"):
+            self._send(201, {"id": "attachment"})
+        elif self.path.endswith("/send"):
+            self._send(202)
+        else:
+            self._send(404, {"error": {"code": "NotFound", "message": self.path}})
+
+    def do_PUT(self):
+        # Upload session ranges; read in small pieces so the stub adds little to peak memory
+        remaining = int(self.headers.get("Content-Length") or 0)
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 65536)))
+        time.sleep(self.latency)
+        start, end, total = map(int, self.headers["Content-Range"].split(" ")[1].replace("/", "-").split("-"))
+        cls = type(self)
+        with cls.counter_lock:
+            cls.counter += end - start + 1
+        if end + 1 == total:
+            self._send(201)
+        else:
+            self._send(200, {"nextExpectedRanges": [f"{end + 1}-"]})
+
+    def do_DELETE(self):
+        self._send(204)
+
+
+class StubRateLimitedHandler(StubGraphHandler):
+    """
+    StubGraphHandler whose sendMail accepts `rate` calls per one-second window;
+    excess calls get 429 with Retry-After: 1 (whole seconds, as Graph sends it). With
+    `quota_headers` every answer carries RateLimit-Remaining / RateLimit-Reset.
+    """
+
+    rate = 20
+    quota_headers = False
+    window = 0
+    used = 0
+    accepted = 0
+    rejected = 0
+
+    @classmethod
+    def reset(cls, rate, quota_headers):
+        cls.rate, cls.quota_headers = int(rate), quota_headers
+        cls.window = cls.used = cls.accepted = cls.rejected = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        cls = type(self)
+        with cls.counter_lock:
+            now = time.monotonic()
+            if int(now) != cls.window:
+                cls.window, cls.used = int(now), 0
+            allowed = cls.used < cls.rate
+            if allowed:
+                cls.used += 1
+                cls.accepted += 1
+            else:
+                cls.rejected += 1
+            remaining, reset = cls.rate - cls.used, cls.window + 1 - now
+        headers = {"RateLimit-Remaining": str(remaining), "RateLimit-Reset": f"{reset:.3f}"} \
+            if cls.quota_headers else {}
+        if allowed:
+            self._send(202, headers=headers)
+        else:
+            self._send(429, {"error": {"code": "TooManyRequests", "message": "throttled"}},
+                       dict(headers, **{"Retry-After": "1"}))
+
+
+def start_stub_server(handler, ssl_context=None):
+    """
+    Starts a threaded stub HTTP server on a free local port, returns (server, base_url).
+    With an ssl_context it serves HTTPS.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.request_queue_size = 1024  # the default backlog of 5 stalls bursts of connects
+    server.server_bind()
+    server.server_activate()
+    if ssl_context is not None:
+        # The handshake then runs in the handler thread instead of blocking the accept loop
+        server.socket = ssl_context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    scheme = "https" if ssl_context is not None else "http"
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}"
+
+
+# --- Gmail ---
+
+class MockGmailHttp:
+    """httplib2-compatible transport answering Gmail sends and batch calls locally."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        import email.parser
+        import httplib2
+
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if "/batch/" not in uri:
+            return httplib2.Response({"status": "200", "content-type": "application/json"}), \
+                b'{"id": "mock-message", "threadId": "mock-thread"}'
+
+        content_type = headers["content-type"]
+        parsed = email.parser.Parser().parsestr(f"content-type: {content_type}\r\n\r\n{body}")
+        boundary = "mock-batch-response"
+        parts = []
+        for i, part in enumerate(parsed.get_payload()):
+            content_id = part["Content-ID"].strip("<>")
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n"
+                f'{{"id": "mock-message-{i}", "threadId": "mock-thread"}}\r\n'
+            )
+        content = "".join(parts) + f"--{boundary}--\r\n"
+        return httplib2.Response({"status": "200", "content-type": f"multipart/mixed; boundary={boundary}"}), \
+            content.encode()
+
+
+class MockResumableGmailHttp:
+    """httplib2-compatible transport accepting Gmail resumable uploads locally and counting the bytes."""
+
+    def __init__(self):
+        self.received = 0
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        import httplib2
+
+        if method == "POST":
+            return httplib2.Response({"status": "200", "location": "http://mock/upload/session"}), b""
+        self.received += len(body)
+        content_range = headers["Content-Range"].split(" ")[1]
+        end, total = content_range.split("-")[1].split("/")
+        if total != "*" and int(end) + 1 == int(total):
+            return httplib2.Response({"status": "200", "content-type": "application/json"}), \
+                b'{"id": "mock-message", "threadId": "mock-thread"}'
+        return httplib2.Response({"status": "308", "range": f"bytes=0-{end}"}), b""
+
+
+# --- Startup ---
+
+# Provider SDKs a worker only loads once it talks to that provider (see lazy_module)
+LAZY_IMPORTS = ("googleapiclient", "google_auth_httplib2", "google_auth_oauthlib", "google.oauth2.credentials",
+                "google.auth.transport.requests", "msal", "aiohttp", "jwt")
+
+
+def eagerly_loaded_sdks():
+    """Which of LAZY_IMPORTS a fresh interpreter has loaded once Service.create_app() returns."""
+    env = dict(os.environ, MYOAUTH__REFRESH__ENABLED="false")
+    check = ("import json, sys, Service; Service.create_app(); "
+             f"print(json.dumps([name for name in {LAZY_IMPORTS!r} if name in sys.modules]))")
+    result = subprocess.run([sys.executable, "-c", check], capture_output=True, text=True,
+                            env=env, cwd=SERVICE_DIR, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
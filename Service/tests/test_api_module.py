@@ -0,0 +1,44 @@
+import base64
+import email
+from unittest import mock
+
+import pytest
+
+import api_module
+import google_module
+
+MESSAGE = {"recipient": "a@example.com", "subject": "Hello", "body": "Hi"}
+
+
+def decode(raw):
+    return email.message_from_bytes(base64.urlsafe_b64decode(raw))
+
+
+def test_batch_messages_share_the_template():
+    first, second = api_module.encode_google_messages([MESSAGE, dict(MESSAGE, recipient="b@example.com")])
+
+    assert decode(first)["To"] == "a@example.com"
+    assert decode(second)["To"] == "b@example.com"
+    assert decode(second)["Subject"] == "Hello"
+
+
+@pytest.mark.parametrize("fields", [{"recipient": "a@example.com\r\nBcc: x@example.com"},
+                                    {"recipient": "a@example.com\nBcc: x@example.com"},
+                                    {"subject": "Hello\r\nBcc: x@example.com"}])
+def test_header_injection_is_rejected(fields):
+    (encoded,) = api_module.encode_google_messages([dict(MESSAGE, **fields)])
+    assert isinstance(encoded, ValueError)
+
+
+def test_bulk_send_reports_invalid_messages_without_sending():
+    messages = [MESSAGE, dict(MESSAGE, recipient="x@example.com\r\nBcc: y@example.com"), MESSAGE]
+    with mock.patch.object(api_module, "get_google_credentials", return_value=object()), \
+            mock.patch.object(google_module, "get_resource"), \
+            mock.patch.object(google_module, "execute_batch",
+                              side_effect=lambda api, version, requests_, creds:
+                              [({"id": str(i)}, None) for i in range(len(requests_))]) as execute_batch:
+        result = api_module.send_google_emails(messages)
+
+    assert [r["status"] for r in result["data"]] == ["success", "error", "success"]
+    assert result["message"] == "2/3 sent"
+    assert len(execute_batch.call_args.args[2]) == 2
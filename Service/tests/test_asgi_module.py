@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import pytest
+
+import asgi_module
+import Service
+
+ORIGIN = "https://frontend.example"
+
+
+@pytest.fixture(scope="module")
+def flask_app():
+    return Service.create_app()
+
+
+@pytest.fixture(scope="module")
+def asgi_app(flask_app):
+    app = asgi_module.AsgiApp(flask_app, threads=2)
+    yield app
+    app.executor.shutdown()
+
+
+def call(app, method, path, headers=(), body=b""):
+    """Runs one request through the ASGI app; returns (status, headers, body)."""
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"",
+             "headers": [(name.lower().encode(), value.encode()) for name, value in headers]}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    response_headers = {name.decode(): value.decode() for name, value in sent[0]["headers"]}
+    return sent[0]["status"], response_headers, sent[1]["body"]
+
+
+def cors(headers):
+    return {name: value for name, value in headers.items() if name.startswith("Access-Control-")}
+
+
+def test_preflight_matches_flask(flask_app, asgi_app):
+    request_headers = [("Origin", ORIGIN), ("Access-Control-Request-Method", "POST"),
+                       ("Access-Control-Request-Headers", "Content-Type")]
+    flask_response = flask_app.test_client().options("/api/send_microsoft_email", headers=request_headers)
+
+    status, headers, body = call(asgi_app, "OPTIONS", "/api/async/send_microsoft_email", request_headers)
+
+    assert status == 200
+    assert cors(headers) == cors(flask_response.headers)
+    assert headers["Access-Control-Allow-Origin"] == ORIGIN
+    assert headers["Access-Control-Allow-Credentials"] == "true"
+
+
+def test_async_route_sends_cors_headers(flask_app, asgi_app):
+    flask_response = flask_app.test_client().get("/api/auth/me", headers={"Origin": ORIGIN})
+
+    status, headers, body = call(asgi_app, "GET", "/api/async/microsoft/me", [("Origin", ORIGIN)])
+
+    assert status == 200
+    assert json.loads(body)["message"] == "Not logged in to Microsoft"
+    assert cors(headers) == cors(flask_response.headers)
+    assert headers["Access-Control-Allow-Origin"] == ORIGIN
+
+
+@pytest.mark.parametrize("body", [b"[]", b'"x"', b"5", b"null"])
+def test_non_object_body_is_a_warning(asgi_app, body):
+    status, headers, payload = call(asgi_app, "POST", "/api/async/send_microsoft_email",
+                                    [("Content-Type", "application/json")], body)
+
+    assert status == 200
+    assert json.loads(payload) == {"status": "warning", "data": "",
+                                   "message": "Invalid request: a JSON object body is required"}
@@ -0,0 +1,69 @@
+"""
+Peak Python memory (tracemalloc) of /api/send_*_email with attachments of
+1 to 64 MB. Attachments are streamed, so the peak must not grow with them.
+"""
+import tempfile
+import tracemalloc
+from unittest import mock
+
+import pytest
+from google.oauth2.credentials import Credentials
+
+import api_module
+import google_module
+import Service
+from tests.support import MockResumableGmailHttp, StubGraphHandler, start_stub_server
+
+MB = 1024 * 1024
+SIZES_MB = (1, 16, 64)
+# Peak allowed for any size, and growth allowed from the smallest to the largest attachment
+PEAK_LIMIT = 16 * MB
+GROWTH_LIMIT = 4 * MB
+
+
+class UploadGraphHandler(StubGraphHandler):
+    """StubGraphHandler with its own count of upload session bytes."""
+
+
+@pytest.fixture
+def client(configure):
+    server, base_url = start_stub_server(UploadGraphHandler)
+    configure(GRAPH__BASE_URL=f"{base_url}/v1.0", RATELIMIT__ENABLED="false")
+    http = MockResumableGmailHttp()
+    with mock.patch.object(google_module, "authorized_http", lambda credentials: http), \
+            mock.patch.object(api_module, "get_google_credentials", lambda user_id=None: Credentials(token="x")), \
+            mock.patch.object(api_module, "get_microsoft_credentials", lambda user_id=None: {"access_token": "x"}):
+        client = Service.create_app().test_client()
+        client.gmail_http = http
+        yield client
+    server.shutdown()
+
+
+@pytest.mark.parametrize("provider", ["google", "microsoft"])
+def test_peak_memory_does_not_grow_with_the_attachment(client, provider):
+    peaks = {}
+    tracemalloc.start()
+    try:
+        for megabytes in SIZES_MB:
+            client.gmail_http.received = UploadGraphHandler.counter = 0
+            with tempfile.TemporaryFile() as attachment:
+                attachment.truncate(megabytes * MB)
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                response = client.post(f"/api/send_{provider}_email", content_type="multipart/form-data", data={
+                    "recipient": "test@example.com", "subject": "test", "body": "hello",
+                    "attachments": (attachment, "test.bin", "application/octet-stream"),
+                })
+                peaks[megabytes] = tracemalloc.get_traced_memory()[1] - baseline
+            assert response.get_json()["status"] == "success"
+            if provider == "google":
+                # base64 makes the message a third larger than the attachment
+                assert client.gmail_http.received > megabytes * MB
+            elif megabytes * MB >= api_module.graph_module.UPLOAD_SESSION_MIN_BYTES:
+                assert UploadGraphHandler.counter == megabytes * MB
+    finally:
+        tracemalloc.stop()
+
+    summary = ", ".join(f"{mb} MB: {peak / MB:.1f} MB" for mb, peak in peaks.items())
+    assert max(peaks.values()) < PEAK_LIMIT, summary
+    assert peaks[SIZES_MB[-1]] - peaks[SIZES_MB[0]] < GROWTH_LIMIT, summary
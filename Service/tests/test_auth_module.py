@@ -0,0 +1,104 @@
+from unittest import mock
+
+import pytest
+
+import msal
+
+import auth_module
+import google_module
+import graph_module
+import id_token_module
+
+
+@pytest.fixture
+def claims():
+    """Claims verify_id_token returns for the next login."""
+    claims = {}
+    with mock.patch.object(id_token_module, "verify_id_token", side_effect=lambda *args: claims or None), \
+            mock.patch.object(google_module, "get_client_config", return_value={"web": {"client_id": "c"}}):
+        yield claims
+
+
+@pytest.fixture
+def google_userinfo():
+    with mock.patch.object(google_module, "get_resource"), \
+            mock.patch.object(google_module, "execute") as execute:
+        yield execute
+
+
+@pytest.fixture
+def graph_me():
+    client = mock.Mock()
+    with mock.patch.object(graph_module, "get_graph_client", return_value=client):
+        yield client.get
+
+
+@pytest.mark.parametrize("verified, email", [(True, "a@example.com"), ("true", "a@example.com"),
+                                             (False, None), (None, None)])
+def test_google_email_must_be_verified(claims, verified, email):
+    claims.update(email="a@example.com", name="A")
+    if verified is not None:
+        claims["email_verified"] = verified
+
+    user_info = auth_module.google_user_info(mock.Mock(id_token="t"))
+
+    assert user_info["email"] == email
+    assert user_info["name"] == "A"
+
+
+def test_google_userinfo_fallback_checks_verified_email(claims, google_userinfo):
+    google_userinfo.return_value = {"email": "a@example.com", "verified_email": False}
+    assert auth_module.google_user_info(mock.Mock(id_token=None))["email"] is None
+
+    google_userinfo.return_value = {"email": "a@example.com", "verified_email": True}
+    assert auth_module.google_user_info(mock.Mock(id_token=None))["email"] == "a@example.com"
+
+
+def test_microsoft_verified_email_claim_is_used(claims, graph_me):
+    claims.update(email="a@example.com", xms_edov=True, preferred_username="alias@example.com", name="A")
+
+    user_info = auth_module.microsoft_user_info({"id_token": "t", "access_token": "x"})
+
+    assert user_info["mail"] == "a@example.com"
+    graph_me.assert_not_called()
+
+
+def test_microsoft_preferred_username_is_not_an_email(claims, graph_me):
+    claims.update(preferred_username="alias@example.com", name="A")
+    graph_me.return_value.json.return_value = {"mail": "a@example.com", "displayName": "A"}
+
+    user_info = auth_module.microsoft_user_info({"id_token": "t", "access_token": "x"})
+
+    assert user_info["mail"] == "a@example.com"
+    graph_me.assert_called_once_with("me", "x")
+
+
+@pytest.mark.parametrize("xms_edov", [None, False, "false"])
+def test_microsoft_unverified_email_claim_is_not_used(claims, graph_me, xms_edov):
+    # Any tenant admin can set the email claim to someone else's address
+    claims.update(email="victim@example.com", name="A")
+    if xms_edov is not None:
+        claims["xms_edov"] = xms_edov
+    graph_me.return_value.json.return_value = {"mail": "a@attacker.example", "displayName": "A"}
+
+    user_info = auth_module.microsoft_user_info({"id_token": "t", "access_token": "x"})
+
+    assert user_info["mail"] == "a@attacker.example"
+    graph_me.assert_called_once_with("me", "x")
+
+
+def test_msal_app_keeps_no_tokens(configure):
+    configure(AZURE__CLIENT_ID="c")  # a new config version, so the app is rebuilt
+    with mock.patch.object(msal, "ConfidentialClientApplication") as app_class:
+        auth_module.get_msal_app()
+    auth_module.reset_msal_app()
+    cache = app_class.call_args.kwargs["token_cache"]
+
+    # What MSAL hands its cache after a code or refresh token redemption
+    cache.add({"client_id": "c", "scope": ["User.Read"], "environment": "login.microsoftonline.com",
+               "token_endpoint": "https://login.microsoftonline.com/t/oauth2/v2.0/token", "params": {}, "data": {},
+               "response": {"access_token": "a", "refresh_token": "r", "expires_in": 3600, "token_type": "Bearer",
+                            "client_info": "eyJ1aWQiOiJ1IiwidXRpZCI6InQifQ"}})
+
+    assert list(cache.search(cache.CredentialType.ACCESS_TOKEN)) == []
+    assert list(cache.search(cache.CredentialType.REFRESH_TOKEN)) == []
@@ -0,0 +1,204 @@
+"""
+The ConnectionPool tests use fake connections. The others run against the
+[DATABASE] of myConfig.ini (or MYOAUTH__DATABASE__* overrides) and are skipped
+when that server cannot be reached; their rows are written under a random
+auth_provider and deleted afterwards.
+"""
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+from mysql.connector import Error
+
+import db_module
+
+
+class FakeConnection:
+    """Stands in for a mysql.connector connection."""
+
+    unread_result = False
+    in_transaction = False
+
+    def __init__(self, **connect_args):
+        self.closed = False
+
+    def ping(self, reconnect=False):
+        if self.closed:
+            raise Error("closed")
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connect():
+    with mock.patch.object(db_module.mysql.connector, "connect", side_effect=FakeConnection) as connect:
+        yield connect
+
+
+def make_pool(**kwargs):
+    return db_module.ConnectionPool({}, **dict({"size": 2, "max_overflow": 1, "timeout": 0.2}, **kwargs))
+
+
+def test_pool_reuses_the_most_recently_released_connection(connect):
+    pool = make_pool()
+    first, second = pool.acquire(), pool.acquire()
+    pool.release(first)
+    pool.release(second)
+
+    assert pool.acquire() is second
+    assert pool.acquire() is first
+    assert connect.call_count == 2
+    assert pool.stats()["checkouts"] == 4
+
+
+def test_pool_overflow_is_closed_on_release(connect):
+    pool = make_pool()
+    connections = [pool.acquire() for _ in range(3)]
+    assert pool.stats()["total"] == 3
+
+    for conn in connections:
+        pool.release(conn)
+
+    assert [conn.closed for conn in connections] == [False, False, True]
+    assert pool.stats()["idle"] == 2
+    assert pool.stats()["total"] == 2
+
+
+def test_pool_timeout_is_counted_with_its_wait(connect):
+    pool = make_pool(timeout=0.1)
+    connections = [pool.acquire() for _ in range(3)]
+
+    with pytest.raises(db_module.PoolTimeoutError):
+        pool.acquire()
+
+    stats = pool.stats()
+    assert (stats["timeouts"], stats["waits"], stats["checkouts"]) == (1, 1, 3)
+    assert stats["wait_time"] >= 0.1
+    for conn in connections:
+        pool.release(conn)
+
+
+def test_pool_waiter_gets_a_released_connection(connect):
+    pool = make_pool()
+    connections = [pool.acquire() for _ in range(3)]
+    threading.Timer(0.05, pool.release, (connections[0],)).start()
+
+    assert pool.acquire() is connections[0]
+    stats = pool.stats()
+    assert stats["waits"] == 1 and stats["wait_time"] > 0
+    assert stats["checked_out"] == 3
+
+
+def test_pool_failed_connect_is_not_a_checkout(connect):
+    pool = make_pool()
+    connect.side_effect = Error("refused")
+
+    with pytest.raises(Error):
+        pool.acquire()
+
+    stats = pool.stats()
+    assert (stats["checkouts"], stats["checked_out"], stats["total"]) == (0, 0, 0)
+
+
+def test_pool_replaces_a_connection_that_fails_the_ping(connect):
+    pool = make_pool()
+    conn = pool.acquire()
+    pool.release(conn)
+    conn.closed = True
+
+    assert pool.acquire() is not conn
+    assert pool.stats()["invalidated"] == 1
+
+
+def test_pool_recycles_old_connections(connect):
+    pool = make_pool(recycle=0.01)
+    conn = pool.acquire()
+    pool.release(conn)
+    time.sleep(0.02)
+
+    assert pool.acquire() is not conn
+    assert conn.closed
+    assert pool.stats()["recycled"] == 1
+
+
+@pytest.mark.parametrize("server_info, version, sql", [
+    ("8.0.36", (8, 0, 36), db_module.UPSERT_USER_SQL),
+    ("8.0.19", (8, 0, 19), db_module.UPSERT_USER_SQL),
+    ("8.0.18", (8, 0, 18), db_module.UPSERT_USER_SQL_VALUES),
+    ("5.7.44-log", (5, 7, 44), db_module.UPSERT_USER_SQL_VALUES),
+    ("10.11.6-MariaDB", (10, 11, 6), db_module.UPSERT_USER_SQL_VALUES),
+])
+def test_upsert_uses_the_row_alias_where_supported(server_info, version, sql):
+    cursor = mock.Mock()
+    cursor._connection.get_server_info.return_value = server_info
+    cursor._connection.get_server_version.return_value = version
+
+    assert db_module.upsert_user_sql(cursor) == sql
+
+
+@db_module.db_operation
+def _users_of(cursor, provider):
+    db_module.exec_sql(cursor, "SELECT id, email FROM users WHERE auth_provider = %s", (provider,))
+    return cursor.fetchall()
+
+
+@db_module.db_operation
+def _delete_users_of(cursor, provider):
+    db_module.exec_sql(cursor, "DELETE FROM users WHERE auth_provider = %s", (provider,))
+
+
+@pytest.fixture
+def provider():
+    try:
+        db_module.create_user_table()
+    except Error as error:
+        pytest.skip(f"MySQL is not reachable: {error}")
+    provider = f"test-{uuid.uuid4().hex[:8]}"
+    yield provider
+    _delete_users_of(provider)
+
+
+def test_concurrent_logins_create_one_row_per_user(provider):
+    emails = [f"user{i}@example.com" for i in range(4)]
+    ids = defaultdict(set)
+    errors = []
+    lock = threading.Lock()
+
+    def login(i):
+        try:
+            # Providers only send a refresh token on first consent
+            user = db_module.get_or_create_user(emails[i % 4], provider, f"token-{i}",
+                                                "refresh" if i < 4 else None, 3600)
+        except Exception as error:
+            errors.append(error)
+            return
+        with lock:
+            ids[user["email"]].add(user["id"])
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        list(pool.map(login, range(400)))
+
+    assert errors == []
+    rows = _users_of(provider)
+    assert sorted(row["email"] for row in rows) == emails
+    # Every login of a user got the id of its single row
+    assert {row["email"]: {row["id"]} for row in rows} == dict(ids)
+
+
+def test_bulk_upsert_keeps_existing_ids(provider):
+    first = db_module.get_or_create_user("user0@example.com", provider, "a", "r", 3600)
+    users = [{"email": f"user{i}@example.com", "auth_provider": provider, "access_token": "b",
+              "refresh_token": None, "expires_in": 3600} for i in range(3)]
+
+    db_module.upsert_users(users)
+    db_module.upsert_users(users)
+
+    rows = {row["email"]: row["id"] for row in _users_of(provider)}
+    assert len(rows) == 3
+    assert rows["user0@example.com"] == first["id"]
+    assert db_module.get_user_by_id(first["id"])["refresh_token"] == "r"
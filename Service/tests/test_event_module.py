@@ -0,0 +1,155 @@
+import asyncio
+import io
+import json
+from unittest import mock
+
+import pytest
+import requests
+
+import api_module
+import asgi_module
+import db_module
+import event_module
+import graph_async_module
+import Service
+import token_module
+
+EVENT = {"title": "Standup", "start_time": "2024-01-01T09:00:00", "end_time": "2024-01-01T09:15:00"}
+
+
+@pytest.fixture
+def client():
+    with mock.patch.object(db_module, "get_user_profile",
+                           return_value={"id": 1, "auth_provider": token_module.MICROSOFT}):
+        client = Service.create_app().test_client()
+        with client.session_transaction() as session:
+            session[token_module.SESSION_KEYS[token_module.MICROSOFT]] = 1
+        yield client
+
+
+@pytest.fixture
+def graph_async():
+    """Async Graph client whose POSTs create the event."""
+    client = mock.Mock()
+    client.post = mock.AsyncMock(return_value=mock.Mock(status_code=201, json=lambda: {"id": "e1"}))
+    with mock.patch.object(api_module, "get_microsoft_credentials", return_value={"access_token": "x"}), \
+            mock.patch.object(graph_async_module, "get_async_graph_client", return_value=client):
+        yield client.post
+
+
+def test_from_json_dates_and_times():
+    event = event_module.from_json(dict(EVENT, time_zone="Europe/Paris"))
+    assert event["start"] == {"dateTime": "2024-01-01T09:00:00", "timeZone": "Europe/Paris"}
+
+    event = event_module.from_json(dict(EVENT, start_time="2024-01-01", end_time="2024-01-02"))
+    assert event["start"] == {"date": "2024-01-01"}
+    assert event["end"] == {"date": "2024-01-02"}
+
+
+@pytest.mark.parametrize("fields", [{"start_time": 5}, {"end_time": ["2024-01-01"]}, {"start_time": "foo"},
+                                    {"start_time": "2024-13-01"}, {"end_time": "2024-01-01T25:00"},
+                                    {"title": 5}, {"time_zone": {"id": "UTC"}},
+                                    {"end_time": "2024-01-01T08:00:00"}, {"end_time": "2024-01-02"},
+                                    {"start_time": "2024-01-02", "end_time": "2024-01-02"},
+                                    {"start_time": "2024-01-03", "end_time": "2024-01-02"}])
+def test_from_json_rejects_invalid_fields(fields):
+    with pytest.raises(ValueError):
+        event_module.from_json(dict(EVENT, **fields))
+
+
+@pytest.mark.parametrize("dtstart", ["2024", "2024011", "20240101T09", "20241301T090000", "not-a-date"])
+def test_ics_invalid_date_is_reported_per_event(dtstart):
+    ics = (f"BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nSUMMARY:Bad\r\nDTSTART:{dtstart}\r\nEND:VEVENT\r\n"
+           "BEGIN:VEVENT\r\nSUMMARY:Good\r\nDTSTART;TZID=Europe/Paris:20240101T090000\r\nEND:VEVENT\r\n"
+           "END:VCALENDAR\r\n").encode()
+
+    bad, good = event_module.parse_ics(io.BytesIO(ics))
+
+    assert isinstance(bad, ValueError) and "'Bad'" in str(bad)
+    assert good["start"] == good["end"] == {"dateTime": "2024-01-01T09:00:00", "timeZone": "Europe/Paris"}
+
+
+@pytest.mark.parametrize("dtend", ["DTEND:20240101T080000", "DTEND;VALUE=DATE:20240102", "DTEND:20241301T090000"])
+def test_ics_invalid_end_is_reported_per_event(dtend):
+    ics = (f"BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nSUMMARY:Bad\r\nDTSTART:20240101T090000\r\n{dtend}\r\n"
+           "END:VEVENT\r\nEND:VCALENDAR\r\n").encode()
+
+    (bad,) = event_module.parse_ics(io.BytesIO(ics))
+
+    assert isinstance(bad, ValueError) and "'Bad'" in str(bad)
+
+
+def test_ics_end_in_another_time_zone_is_accepted():
+    ics = (b"BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nSUMMARY:Flight\r\nDTSTART;TZID=Europe/Paris:20240101T090000\r\n"
+           b"DTEND;TZID=Europe/London:20240101T085000\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n")
+
+    (event,) = event_module.parse_ics(io.BytesIO(ics))
+
+    assert event["end"] == {"dateTime": "2024-01-01T08:50:00", "timeZone": "Europe/London"}
+
+
+def test_import_reports_invalid_events_and_creates_the_rest():
+    items = [EVENT, dict(EVENT, start_time=5), dict(EVENT, start_time="foo"), EVENT]
+    create = mock.Mock(side_effect=lambda chunk: [({"id": str(i)}, None) for i in range(len(chunk))])
+
+    result = api_module.import_events(
+        event_module.parse_json(io.BytesIO(json.dumps(items).encode())), create, "Test")
+
+    assert [r["status"] for r in result["data"]] == ["success", "error", "error", "success"]
+    assert result["status"] == "warning"
+    assert len(create.call_args.args[0]) == 2
+
+
+def created(chunk):
+    return [({"id": str(i)}, None) for i in range(len(chunk))]
+
+
+@pytest.mark.parametrize("error", [ValueError("Expecting value: line 1 column 1 (char 0)"),
+                                   requests.ConnectionError("connection reset")])
+def test_import_reports_create_errors_per_chunk(configure, error):
+    configure(EVENTS__IMPORT_CHUNK_SIZE="2")
+    calls = []
+
+    def create(chunk):
+        calls.append(chunk)
+        if len(calls) == 2:
+            raise error
+        return created(chunk)
+
+    result = api_module.import_events([event_module.from_json(EVENT)] * 6, create, "Test")
+
+    assert [r["status"] for r in result["data"]] == ["success", "success", "error", "error", "success", "success"]
+    assert result["data"][2]["message"] == str(error)
+    assert result["message"] == "4/6 created"
+
+
+def test_import_reports_a_result_count_mismatch():
+    result = api_module.import_events([event_module.from_json(EVENT)] * 3, lambda chunk: created(chunk)[:1], "Test")
+
+    assert [r["status"] for r in result["data"]] == ["error"] * 3
+    assert result["data"][0]["message"] == "1 results returned for 3 events"
+
+
+@pytest.mark.parametrize("body", [dict(EVENT, start_time=5), dict(EVENT, end_time="foo"), ["not", "an", "object"]])
+def test_create_event_rejects_invalid_body(client, body):
+    with mock.patch.object(api_module, "create_microsoft_event") as create:
+        response = client.post("/api/create-event", json=body)
+
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "warning"
+    create.assert_not_called()
+
+
+def test_async_create_event_uses_the_event_model(graph_async):
+    status, headers, body = asyncio.run(asgi_module.create_event(dict(EVENT, location="Room 1"), 1))
+
+    assert json.loads(body)["status"] == "success"
+    sent = graph_async.call_args.kwargs["json"]
+    assert sent == api_module.build_microsoft_event(event_module.from_json(dict(EVENT, location="Room 1")))
+    assert sent["location"] == {"displayName": "Room 1"}
+
+
+def test_async_create_event_rejects_invalid_times(graph_async):
+    with pytest.raises(ValueError):
+        asyncio.run(asgi_module.create_event(dict(EVENT, start_time="foo"), 1))
+    graph_async.assert_not_called()
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+
+import graph_module
+from tests.support import StubGraphHandler, start_stub_server
+
+
+class ScriptedGraphHandler(StubGraphHandler):
+    """
+    Answers POSTs with the queued `statuses` first (429/503 with Retry-After: 0),
+    then like StubGraphHandler. Records the client port of every connection.
+    """
+
+    statuses = []
+    ports = set()
+    posts = 0
+
+    def do_POST(self):
+        cls = ScriptedGraphHandler
+        with self.counter_lock:
+            cls.ports.add(self.client_address[1])
+            cls.posts += 1
+            status = cls.statuses.pop(0) if cls.statuses else None
+        if status is None:
+            super().do_POST()
+            return
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._send(status, {"error": {"code": "TooManyRequests", "message": "throttled"}}, {"Retry-After": "0"})
+
+
+@pytest.fixture
+def graph(configure):
+    configure(RATELIMIT__ENABLED="false")
+    ScriptedGraphHandler.statuses = []
+    ScriptedGraphHandler.ports = set()
+    ScriptedGraphHandler.posts = 0
+    server, base_url = start_stub_server(ScriptedGraphHandler)
+    yield f"{base_url}/v1.0"
+    server.shutdown()
+
+
+def test_throttled_calls_are_retried(graph):
+    ScriptedGraphHandler.statuses = [429, 503]
+    client = graph_module.GraphClient(base_url=graph, backoff_factor=0)
+
+    response = client.post("me/sendMail", "x", json={})
+
+    assert response.status_code == 202
+    assert ScriptedGraphHandler.posts == 3
+
+
+def test_retries_stop_after_max_retries(graph):
+    ScriptedGraphHandler.statuses = [429] * 5
+    client = graph_module.GraphClient(base_url=graph, backoff_factor=0, max_retries=2)
+
+    response = client.post("me/sendMail", "x", json={})
+
+    assert response.status_code == 429
+    assert ScriptedGraphHandler.posts == 3
+
+
+def test_connections_are_reused(graph):
+    client = graph_module.GraphClient(base_url=graph, pool_maxsize=4)
+
+    for _ in range(20):
+        assert client.post("me/sendMail", "x", json={}).status_code == 202
+    assert len(ScriptedGraphHandler.ports) == 1
+
+    def send():
+        for _ in range(10):
+            client.post("me/sendMail", "x", json={})
+
+    threads = [threading.Thread(target=send) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert ScriptedGraphHandler.posts == 60
+    assert len(ScriptedGraphHandler.ports) <= 4
+
+
+def test_client_is_shared_until_the_config_changes(graph, configure):
+    configure(GRAPH__BASE_URL=graph)
+    client = graph_module.get_graph_client()
+
+    assert graph_module.get_graph_client() is client
+    configure(GRAPH__MAX_RETRIES="1")
+    assert graph_module.get_graph_client() is not client
@@ -0,0 +1,10 @@
+"""
+create_app must not load the provider SDKs, which workers only import once
+they talk to that provider. How long `import Service` takes is measured by
+`python benchmark.py import-time`, not asserted here.
+"""
+from tests.support import eagerly_loaded_sdks
+
+
+def test_create_app_loads_no_provider_sdk():
+    assert eagerly_loaded_sdks() == []
@@ -0,0 +1,30 @@
+import pytest
+
+import job_module
+
+
+@pytest.mark.parametrize("value, expected", [
+    (True, True), (False, False), (1, True), (0, False),
+    ("true", True), ("false", False), ("1", True), ("0", False), ("yes", True), ("no", False),
+    ("On", True), ("OFF", False),
+])
+def test_async_value_from_json_or_form(value, expected, configure):
+    configure(JOBS__ASYNC="false")
+    assert job_module.is_async_enabled({"async": value}) is expected
+
+
+def test_async_defaults_to_the_config(configure):
+    configure(JOBS__ASYNC="true")
+    assert job_module.is_async_enabled({}) is True
+    assert job_module.is_async_enabled({"async": "maybe"}) is True
+    assert job_module.is_async_enabled({"async": "no"}) is False
+
+
+@pytest.mark.parametrize("configured, workers, expected", [
+    ("", 1, "memory"), ("", 4, "mysql"), ("memory", 1, "memory"), ("memory", 4, "memory"), ("mysql", 1, "mysql"),
+])
+def test_backend_for_workers(configure, caplog, configured, workers, expected):
+    config = configure(JOBS__BACKEND=configured)
+    assert job_module.backend_for(workers, config) == expected
+    warned = any("BACKEND = memory" in record.getMessage() for record in caplog.records)
+    assert warned is (configured == "memory" and workers > 1)
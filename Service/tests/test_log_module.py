@@ -0,0 +1,17 @@
+import log_module
+
+
+def test_records_logged_after_stop_are_written(configure, tmp_path):
+    configure(LOG__ASYNC="true", LOG__LEVEL="INFO")
+    logger = log_module.setup_logger("test-shutdown", str(tmp_path))
+    assert any(isinstance(h, log_module.BoundedQueueHandler) for h in logger.handlers)
+
+    logger.info("before stop")
+    log_module.stop_logging()
+    logger.info("during shutdown")
+    for handler in logger.handlers:
+        handler.close()
+
+    assert not any(isinstance(h, log_module.BoundedQueueHandler) for h in logger.handlers)
+    lines = (tmp_path / "test-shutdown.log").read_text(encoding="big5").splitlines()
+    assert [line.rsplit(" - ", 1)[1] for line in lines] == ["before stop", "during shutdown"]
@@ -0,0 +1,86 @@
+import pstats
+import re
+import time
+from unittest import mock
+
+import pytest
+
+import profile_module
+import Service
+
+TOKEN = "admin-secret"
+ADMIN = {"X-Admin-Token": TOKEN}
+
+
+@pytest.fixture(autouse=True)
+def reset_profiles():
+    settings = dict(profile_module._settings)
+    profile_module._SLOWEST.clear()
+    yield
+    profile_module._SLOWEST.clear()
+    profile_module._settings.update(settings)
+
+
+@pytest.fixture
+def app(configure):
+    configure(PROFILING__ENABLED="true", PROFILING__ADMIN_TOKEN=TOKEN, PROFILING__KEEP="2",
+              PROFILING__PROFILE_ALL="true")
+    app = Service.create_app()
+
+    @app.route("/test/slow/<int:ms>")
+    def slow(ms):
+        time.sleep(ms / 1000)
+        return "done"
+
+    return app
+
+
+def test_off_by_default():
+    app = Service.create_app()
+    client = app.test_client()
+    with mock.patch.object(profile_module.cProfile, "Profile", side_effect=AssertionError("profiler started")):
+        assert client.get("/", headers={"X-Profile": TOKEN}).status_code == 200
+    assert client.get("/api/admin/profiling/profiles", headers=ADMIN).status_code == 404
+    assert not profile_module._SLOWEST
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Admin-Token": "wrong"}, {"X-Admin-Token": "sécret"}])
+def test_admin_endpoints_need_the_token(app, headers):
+    client = app.test_client()
+    for path in ("/api/admin/profiling/profiles", "/api/admin/profiling/sampler.collapsed"):
+        response = client.get(path, headers=headers)
+        assert response.status_code == 403
+        assert response.get_json()["status"] == "error"
+    assert client.get("/api/admin/profiling/profiles", headers=ADMIN).status_code == 200
+
+
+def test_keeps_the_slowest_requests(app):
+    client = app.test_client()
+    for ms in (10, 60, 20, 40):
+        assert client.get(f"/test/slow/{ms}").status_code == 200
+
+    profiles = client.get("/api/admin/profiling/profiles", headers=ADMIN).get_json()["data"]
+    assert [p["path"] for p in profiles] == ["/test/slow/60", "/test/slow/40"]
+    assert profiles[0]["duration_ms"] >= profiles[1]["duration_ms"] >= 40
+
+
+def test_downloads(app, tmp_path):
+    client = app.test_client()
+    client.get("/test/slow/60")
+    profile_id = client.get("/api/admin/profiling/profiles", headers=ADMIN).get_json()["data"][0]["id"]
+
+    response = client.get(f"/api/admin/profiling/profiles/{profile_id}.pstats", headers=ADMIN)
+    assert response.status_code == 200
+    path = tmp_path / "request.pstats"
+    path.write_bytes(response.data)
+    stats = pstats.Stats(str(path))
+    assert any("sleep" in function for _, _, function in stats.stats)
+
+    response = client.get(f"/api/admin/profiling/profiles/{profile_id}.collapsed", headers=ADMIN)
+    assert response.status_code == 200
+    lines = response.get_data(as_text=True).splitlines()
+    assert lines and all(re.fullmatch(r"\S.* \d+", line) for line in lines)
+    assert any("test_profile_module.py:slow" in line for line in lines)
+
+    missing = client.get("/api/admin/profiling/profiles/999999.pstats", headers=ADMIN).get_json()
+    assert missing["status"] == "warning"
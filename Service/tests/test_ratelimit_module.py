@@ -0,0 +1,146 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+
+import graph_module
+import photo_module
+import ratelimit_module
+from ratelimit_module import MICROSOFT
+from tests.support import StubRateLimitedHandler, start_stub_server
+
+# Calls/s the throttling stub accepts, and how far the admitted rate may be from it
+STUB_RATE = 50
+TOLERANCE = 0.25
+
+
+class FakeClock:
+    """Stands in for the time module: sleep() moves monotonic() forward."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(0.0, seconds)
+
+
+@pytest.fixture
+def clock(configure):
+    configure(RATELIMIT__ENABLED="true", RATELIMIT__MICROSOFT_USER_RATE="10", RATELIMIT__MICROSOFT_APP_RATE="1000",
+              RATELIMIT__BURST="1", RATELIMIT__DECREASE="0.5", RATELIMIT__INCREASE="1", RATELIMIT__MAX_WAIT="5")
+    ratelimit_module._LIMITERS.clear()
+    clock = FakeClock()
+    with mock.patch.object(ratelimit_module, "time", clock):
+        ratelimit_module.bind_user(1)
+        yield clock
+    ratelimit_module.bind_user(None)
+    ratelimit_module._LIMITERS.clear()
+
+
+def admitted_rate(clock, calls=10):
+    """Calls/s admitted for the bound user, each reported as successful."""
+    ratelimit_module.acquire(MICROSOFT)
+    start = clock.now
+    for _ in range(calls):
+        ratelimit_module.acquire(MICROSOFT)
+        ratelimit_module.report(MICROSOFT, 202)
+    return calls / (clock.now - start)
+
+
+def test_rate_drops_after_429_and_recovers(clock):
+    assert admitted_rate(clock) == pytest.approx(10)
+    user = ratelimit_module.get_limiter(MICROSOFT, 1)
+
+    ratelimit_module.report(MICROSOFT, 429, {"Retry-After": "2"})
+    before = clock.now
+    ratelimit_module.acquire(MICROSOFT)
+    assert clock.now - before >= 2  # paused for Retry-After
+    assert admitted_rate(clock, calls=5) < 6
+
+    for _ in range(500):
+        if user.rate >= 9.5:
+            break
+        ratelimit_module.acquire(MICROSOFT)
+        ratelimit_module.report(MICROSOFT, 202)
+    assert user.rate >= 9.5
+    assert admitted_rate(clock) > 9
+    assert user.stats()["throttled"] == 1
+
+
+def test_rejected_calls_use_no_budget(clock):
+    provider_wide = ratelimit_module.get_limiter(MICROSOFT)
+    user = ratelimit_module.get_limiter(MICROSOFT, 1)
+    provider_wide.observe(429, {"Retry-After": "60"})
+
+    for _ in range(5):
+        with pytest.raises(ratelimit_module.RateLimitExceeded):
+            ratelimit_module.acquire(MICROSOFT)
+    assert user.stats()["admitted"] == 0
+    assert user.stats()["rejected"] == 5
+
+    clock.sleep(60)
+    before = clock.now
+    ratelimit_module.acquire(MICROSOFT)
+    assert clock.now == before
+
+
+def test_user_429_does_not_slow_other_users(clock):
+    provider_wide = ratelimit_module.get_limiter(MICROSOFT)
+    user = ratelimit_module.get_limiter(MICROSOFT, 1)
+    full_rate = provider_wide.rate
+
+    ratelimit_module.report(MICROSOFT, 429, {"Retry-After": "2", "RateLimit-Remaining": "0",
+                                             "RateLimit-Reset": "2"})
+
+    assert user.rate < full_rate / 4
+    assert provider_wide.rate == full_rate
+    assert provider_wide.stats()["throttled"] == 0
+    ratelimit_module.bind_user(2)
+    before = clock.now
+    ratelimit_module.acquire(MICROSOFT)
+    assert clock.now == before
+
+
+class ThrottlingGraphHandler(StubRateLimitedHandler):
+    """StubRateLimitedHandler with its own window and counters."""
+
+
+def test_throughput_stays_near_a_throttling_stub(configure):
+    server, base_url = start_stub_server(ThrottlingGraphHandler)
+    # The limiter starts at twice the rate the stub accepts and has to find it
+    configure(GRAPH__BASE_URL=f"{base_url}/v1.0", RATELIMIT__ENABLED="true",
+              RATELIMIT__MICROSOFT_USER_RATE=str(STUB_RATE * 2))
+    ratelimit_module._LIMITERS.clear()
+    ThrottlingGraphHandler.reset(STUB_RATE, False)
+    client = graph_module.get_graph_client()
+
+    def send(_):
+        ratelimit_module.bind_user(1)
+        return client.post("me/sendMail", "x", json={}).status_code
+
+    try:
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            warm_up = list(pool.map(send, range(STUB_RATE * 2)))
+            accepted, rejected, start = ThrottlingGraphHandler.accepted, ThrottlingGraphHandler.rejected, \
+                time.monotonic()
+            sustained = list(pool.map(send, range(STUB_RATE * 4)))
+            elapsed = time.monotonic() - start
+    finally:
+        server.shutdown()
+        ratelimit_module._LIMITERS.clear()
+    accepted_rate = (ThrottlingGraphHandler.accepted - accepted) / elapsed
+
+    assert set(warm_up + sustained) == {202}
+    assert abs(accepted_rate - STUB_RATE) <= STUB_RATE * TOLERANCE, f"{accepted_rate:.1f}/s"
+    assert ThrottlingGraphHandler.rejected - rejected <= len(sustained) * 0.1
+
+
+def test_photo_is_optional_when_rate_limited():
+    client = mock.Mock()
+    client.get.side_effect = ratelimit_module.RateLimitExceeded((MICROSOFT, 1), 10)
+    with mock.patch.object(photo_module.graph_module, "get_graph_client", return_value=client):
+        assert photo_module.fetch_photo("x") == photo_module.NO_PHOTO
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+
+import api_module
+import refresh_module
+
+
+@pytest.fixture
+def expiring_user():
+    """User 7 with an access token about to expire, whose refreshes fail."""
+    record = {"id": 7, "auth_provider": "google", "refresh_token": "r",
+              "token_expiry": datetime.utcnow() + timedelta(seconds=5)}
+    refresh_module._RETRY_AT.clear()
+    with mock.patch.object(api_module.token_module, "get_tokens", return_value=record), \
+            mock.patch.object(refresh_module, "_do_refresh", side_effect=RuntimeError("token endpoint down")) as refresh:
+        yield refresh
+    refresh_module._RETRY_AT.clear()
+
+
+def test_request_path_honours_the_retry_delay(expiring_user):
+    api_module.ensure_fresh_tokens(7)
+    assert expiring_user.call_count == 1
+    assert refresh_module.is_backing_off(7)
+
+    for _ in range(5):
+        api_module.ensure_fresh_tokens(7)
+    assert expiring_user.call_count == 1
+
+
+def test_refresh_is_retried_once_the_delay_has_passed(expiring_user):
+    api_module.ensure_fresh_tokens(7)
+    failures, _ = refresh_module._RETRY_AT[7]
+    refresh_module._RETRY_AT[7] = (failures, 0.0)
+
+    assert not refresh_module.is_backing_off(7)
+    api_module.ensure_fresh_tokens(7)
+    assert expiring_user.call_count == 2
+    assert refresh_module._RETRY_AT[7][0] == failures + 1
+
+
+def stored(seconds):
+    return {"id": 7, "auth_provider": "google", "refresh_token": "r", "access_token": "new",
+            "token_expiry": datetime.utcnow() + timedelta(seconds=seconds)}
+
+
+def test_tokens_another_worker_refreshed_are_not_refreshed_again():
+    """This worker's cached record is stale; the database row is already fresh."""
+    cache = refresh_module.token_module.get_cache()
+    cache.set(7, dict(stored(5), access_token="old"))
+    try:
+        with mock.patch.object(refresh_module.db_module, "get_user_by_id", return_value=stored(3600)), \
+                mock.patch.object(refresh_module, "_refresh_google") as refresh:
+            assert refresh_module.refresh_user(7)
+        refresh.assert_not_called()
+        assert cache.get(7) is None
+    finally:
+        cache.delete(7)
+
+
+@pytest.mark.parametrize("threshold, refreshed", [(refresh_module.REQUEST_THRESHOLD, False), (300, True)])
+def test_refresh_threshold(threshold, refreshed):
+    """The scheduler's lead time still refreshes tokens a request would leave alone."""
+    with mock.patch.object(refresh_module.db_module, "get_user_by_id", return_value=stored(120)), \
+            mock.patch.object(refresh_module, "_refresh_google",
+                              return_value=("t", None, datetime.utcnow() + timedelta(hours=1))) as refresh, \
+            mock.patch.object(refresh_module.token_module, "update_tokens"):
+        assert refresh_module.refresh_user(7, threshold)
+    assert refresh.called == refreshed
+
+
+def test_token_cache_is_shared_by_several_workers(configure):
+    configure(CACHE__BACKEND="redis", SERVER__WORKERS="4")
+    with mock.patch.object(refresh_module.token_module, "create_cache") as create_cache:
+        refresh_module.token_module._new_cache("tokens")
+    assert create_cache.call_args.kwargs["shared"]
+
+    configure(CACHE__BACKEND="redis", SERVER__WORKERS="1")
+    with mock.patch.object(refresh_module.token_module, "create_cache") as create_cache:
+        refresh_module.token_module._new_cache("tokens")
+    assert not create_cache.call_args.kwargs["shared"]
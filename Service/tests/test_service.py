@@ -0,0 +1,22 @@
+import pytest
+
+import Service
+
+
+@pytest.fixture(scope="module")
+def client():
+    return Service.create_app().test_client()
+
+
+@pytest.mark.parametrize("path", ["/api/db/pool_stats", "/api/tokens/refresh_stats", "/api/ratelimit/stats"])
+def test_stats_routes(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "success"
+
+
+def test_metrics(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert "myoauth_token_refresh" in response.get_data(as_text=True)
@@ -0,0 +1,155 @@
+import threading
+from datetime import datetime
+
+import db_module
+from cache_module import create_cache
+from config_module import get_config
+from lazy_module import lazy_import
+from log_module import setup_logger
+
+LOGGER = setup_logger("token", "logs/service")
+
+google_credentials = lazy_import("google.oauth2.credentials")
+google_module = lazy_import("google_module")
+
+GOOGLE = "google"
+MICROSOFT = "microsoft"
+
+# Session cookies only carry the users.id under these keys; tokens stay server-side
+SESSION_KEYS = {
+    GOOGLE: "google_user_id",
+    MICROSOFT: "microsoft_user_id",
+}
+
+_CACHE = None
+_CREDENTIALS = None
+_LOCK = threading.Lock()
+
+
+def _new_cache(name):
+    # With one worker tokens never leave the process. With several, each worker's
+    # copy would go stale when another refreshes, so [CACHE] BACKEND = redis is used
+    config = get_config()
+    return create_cache(
+        name,
+        maxsize=config.get_int("TOKENS", "CACHE_SIZE", 10000),
+        ttl=config.get_float("TOKENS", "CACHE_TTL", 300),
+        shared=config.get_int("SERVER", "WORKERS", 1) > 1,
+    )
+
+
+def get_cache():
+    """user id -> token record (users row) cache in front of the database."""
+    global _CACHE
+    if _CACHE is None:
+        with _LOCK:
+            if _CACHE is None:
+                _CACHE = _new_cache("tokens")
+    return _CACHE
+
+
+def get_credentials_cache():
+    """user id -> google Credentials, so they are not rebuilt on every call."""
+    global _CREDENTIALS
+    if _CREDENTIALS is None:
+        with _LOCK:
+            if _CREDENTIALS is None:
+                _CREDENTIALS = _new_cache("credentials")
+    return _CREDENTIALS
+
+
+def save_tokens(email, provider, access_token, refresh_token, expires_in):
+    """Stores a login's tokens in the users table and returns the user id."""
+    user = db_module.get_or_create_user(email, provider, access_token, refresh_token, expires_in)
+    if refresh_token is None:
+        # The stored refresh token was kept but not read back; load the row on next use
+        get_cache().delete(user["id"])
+    else:
+        get_cache().set(user["id"], user)
+    get_credentials_cache().delete(user["id"])
+    return user["id"]
+
+
+def save_many_tokens(users):
+    """Bulk save_tokens (see db_module.upsert_users); cached token records are dropped."""
+    affected = db_module.upsert_users(users)
+    get_cache().clear()
+    get_credentials_cache().clear()
+    return affected
+
+
+def get_tokens(user_id):
+    """Returns the token record for a user, from memory when possible."""
+    if user_id is None:
+        return None
+    record = get_cache().get(user_id)
+    if record is None:
+        record = db_module.get_user_by_id(user_id)
+        if record is None:
+            return None
+        get_cache().set(user_id, record)
+    return record
+
+
+def update_tokens(user_id, access_token, refresh_token, token_expiry):
+    """Persists refreshed tokens and updates the cached record."""
+    db_module.update_user_tokens(user_id, access_token, refresh_token, token_expiry)
+    record = get_cache().get(user_id)
+    if record is not None:
+        record = dict(record, access_token=access_token,
+                      refresh_token=refresh_token or record["refresh_token"], token_expiry=token_expiry)
+        get_cache().set(user_id, record)
+    get_credentials_cache().delete(user_id)
+
+
+def forget(user_id):
+    """Drops the cached record, e.g. on logout."""
+    if user_id is not None:
+        get_cache().delete(user_id)
+        get_credentials_cache().delete(user_id)
+
+
+def get_google_credentials(user_id):
+    """Returns google Credentials for a user, built from the stored tokens once."""
+    if user_id is None:
+        return None
+    record = get_tokens(user_id)
+    if not record:
+        return None
+    credentials = get_credentials_cache().get(user_id)
+    # Built before another worker refreshed the tokens
+    if credentials is not None and credentials.token == record["access_token"]:
+        return credentials
+    credentials = build_google_credentials(record)
+    get_credentials_cache().set(user_id, credentials)
+    return credentials
+
+
+def build_google_credentials(record):
+    """google Credentials from a users row and the app's client secrets."""
+    client_config = google_module.get_client_config()
+    client = client_config.get("web") or client_config.get("installed") or {}
+    return google_credentials.Credentials(
+        token=record["access_token"],
+        refresh_token=record["refresh_token"],
+        token_uri=client.get("token_uri"),
+        client_id=client.get("client_id"),
+        client_secret=client.get("client_secret"),
+        scopes=get_config().get_list("GOOGLE", "scopes"),
+        expiry=record["token_expiry"],
+    )
+
+
+def get_microsoft_credentials(user_id):
+    """Returns {"access_token", "refresh_token"} for a user."""
+    record = get_tokens(user_id)
+    if not record:
+        return None
+    return {"access_token": record["access_token"], "refresh_token": record["refresh_token"]}
+
+
+def expires_in(expiry):
+    """Seconds until a naive-UTC expiry datetime, as expected by get_or_create_user."""
+    if expiry is None:
+        return 3600
+    return max(0, int((expiry - datetime.utcnow()).total_seconds()))